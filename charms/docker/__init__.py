@@ -1,4 +1,38 @@
-from .docker import Docker  # noqa
-from .compose import Compose  # noqa
-from .dockeropts import DockerOpts  # noqa
-from .workspace import Workspace  # noqa
+'''
+Python wrappers for the docker CLI and daemon configuration in Juju
+charms.
+
+The public classes are imported on first use rather than with the
+package, so `import charms.docker` stays cheap for hooks that only need
+part of it. DockerOpts, for one, brings in charmhelpers' unitdata.
+'''
+import importlib
+
+# public name: submodule defining it
+_LAZY = {
+    'AsyncCompose': 'aio',
+    'AsyncDocker': 'aio',
+    'Compose': 'compose',
+    'ContainerSpec': 'docker',
+    'ContainerStateCache': 'cache',
+    'Docker': 'docker',
+    'DockerOpts': 'dockeropts',
+    'Workspace': 'workspace',
+}
+
+__all__ = sorted(_LAZY)
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            __name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    # cache it, so later lookups skip this function
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
@@ -0,0 +1,374 @@
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import time
+
+from shlex import split
+
+from . import health, metrics
+from .compose import Compose, ServiceResult
+from .docker import (_event_time, _events_cmd, _filters, _normalize_image,
+                     _parse_ps, _ps_cmd, _run_cmd, _split_image, PullResult)
+from .progress import StalledError
+from .runner import _echo_stderr
+from .streams import LineDecoder
+
+
+async def run(cmd, workspace=None, on_stdout=None, on_stderr=None,
+              idle_timeout=None, capture=True):
+    '''
+    asyncio counterpart of charms.docker.runner.run. The command runs in
+    `workspace` without touching the process wide working directory, so
+    any number of them may be in flight on one event loop.
+
+    :param cmd: - String or argv list of the command to run.
+    :param workspace: - directory to run the command in
+    :param on_stdout: - called with each line of STDOUT as it arrives
+    :param on_stderr: - called with each line of STDERR as it arrives
+    :param idle_timeout: - seconds without output before the command is
+        killed and StalledError raised
+    :param capture: - keep STDOUT to return it
+
+    :returns: STDOUT of command execution
+
+    :usage: await run('docker-compose ps', 'files/workspace')
+    '''
+    argv = split(cmd) if isinstance(cmd, str) else list(cmd)
+    cwd = str(workspace) if workspace is not None else None
+    if metrics.get_recorder() is None:
+        return await _run(argv, cwd, on_stdout, on_stderr, idle_timeout,
+                          capture)
+    name, command = metrics.command_name(argv), ' '.join(argv)
+    started = time.monotonic()
+    try:
+        out = await _run(argv, cwd, on_stdout, on_stderr, idle_timeout,
+                         capture)
+    except subprocess.CalledProcessError as err:
+        metrics.record('aio', name, command, cwd, started, err.returncode,
+                       err.output)
+        raise
+    except Exception:
+        metrics.record('aio', name, command, cwd, started, 1)
+        raise
+    metrics.record('aio', name, command, cwd, started, 0, out)
+    return out
+
+
+async def _run(argv, cwd, on_stdout, on_stderr, idle_timeout, capture):
+    if on_stderr is None and idle_timeout is not None:
+        on_stderr = _echo_stderr
+    streaming = on_stdout or on_stderr or idle_timeout is not None or \
+        not capture
+    proc = await asyncio.create_subprocess_exec(
+        *argv, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE if on_stderr else None,
+        start_new_session=True)
+    try:
+        if not streaming:
+            out, _ = await proc.communicate()
+        else:
+            out = await _stream(proc, argv, on_stdout, on_stderr,
+                                idle_timeout, capture)
+    except BaseException:
+        # including cancellation, eg: by asyncio.wait_for
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        if proc.returncode is None:
+            await proc.wait()
+        raise
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, argv, out)
+    return out
+
+
+async def _pump(stream, callback, sink, activity):
+    loop = asyncio.get_running_loop()
+    decoder = LineDecoder()
+    while True:
+        data = await stream.read(65536)
+        activity[0] = loop.time()
+        if not data:
+            lines = decoder.flush()
+        else:
+            if sink is not None:
+                sink.append(data)
+            lines = decoder.feed(data)
+        if callback is not None:
+            for line in lines:
+                callback(line)
+        if not data:
+            return
+
+
+async def _stream(proc, argv, on_stdout, on_stderr, idle_timeout, capture):
+    loop = asyncio.get_running_loop()
+    chunks = []
+    activity = [loop.time()]
+    pumps = [_pump(proc.stdout, on_stdout, chunks if capture else None,
+                   activity)]
+    if proc.stderr is not None:
+        pumps.append(_pump(proc.stderr, on_stderr, None, activity))
+    done = asyncio.ensure_future(asyncio.gather(*pumps))
+    try:
+        while True:
+            remaining = None
+            if idle_timeout is not None:
+                remaining = activity[0] + idle_timeout - loop.time()
+                if remaining <= 0:
+                    raise StalledError(' '.join(argv), idle_timeout)
+            try:
+                await asyncio.wait_for(asyncio.shield(done), remaining)
+                break
+            except asyncio.TimeoutError:
+                continue
+        await proc.wait()
+    except BaseException:
+        done.cancel()
+        # the pumps may have failed too; retrieve it so it isn't logged
+        done.add_done_callback(lambda f: f.cancelled() or f.exception())
+        raise
+    return b''.join(chunks)
+
+
+async def run_each(cmd, services, workspace=None, parallelism=4,
+                   on_line=None, idle_timeout=None):
+    '''
+    Run `cmd` once per service, suffixed with the service name, with at
+    most `parallelism` commands in flight at a time. Duplicate services are
+    only run once.
+
+    :param on_line: called with each service name to get the line
+        callback for that service's STDOUT and STDERR
+    :param idle_timeout: seconds without output before a command is
+        killed
+
+    :returns: dict of service name to ServiceResult, in the order given
+
+    :usage: await run_each('docker-compose pull', ['web', 'db'], 'files/ws')
+    '''
+    if parallelism < 1:
+        raise ValueError("parallelism must be at least 1")
+    services = list(dict.fromkeys(services))
+    limit = asyncio.Semaphore(parallelism)
+
+    async def one(service):
+        options = {}
+        if on_line is not None:
+            callback = on_line(service)
+            options.update(on_stdout=callback, on_stderr=callback,
+                           capture=False)
+        if idle_timeout is not None:
+            options['idle_timeout'] = idle_timeout
+        async with limit:
+            try:
+                output = await run("{} {}".format(cmd, service), workspace,
+                                   **options)
+            except (subprocess.CalledProcessError, OSError) as err:
+                return ServiceResult(service, error=err)
+            return ServiceResult(service, output=output)
+
+    results = await asyncio.gather(*[one(s) for s in services])
+    return dict((r.service, r) for r in results)
+
+
+class AsyncCompose(Compose):
+    '''
+    Compose, with every command returning an awaitable instead of
+    blocking the caller. The method names and arguments mirror Compose,
+    except that `docker` is an AsyncDocker.
+
+    ex: web = AsyncCompose('files/web')
+    db = AsyncCompose('files/db')
+    await asyncio.gather(web.up(), db.pull())
+    '''
+
+    async def _run(self, cmd, **options):
+        return await run(cmd, self.workspace, **options)
+
+    async def _run_each(self, cmd, services, parallelism, **options):
+        return await run_each(cmd, services, self.workspace, parallelism,
+                              **options)
+
+    async def _drive(self, flow):
+        '''
+        Run a flow shared with Compose, awaiting the calls it yields. See
+        Compose._drive
+        '''
+        result, error = None, None
+        while True:
+            try:
+                if error is None:
+                    fn, args, kwargs = flow.send(result)
+                else:
+                    fn, args, kwargs = flow.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await fn(*args, **kwargs), None
+            except Exception as err:
+                result, error = None, err
+
+    def _client(self):
+        if self.docker is None:
+            self.docker = AsyncDocker()
+        return self.docker
+
+    async def _service_containers(self, service):
+        return await self._client().ps(
+            all=True, filters=self._service_filters(service))
+
+    async def _services_containers(self, services):
+        containers = await asyncio.gather(
+            *[self._service_containers(s) for s in services])
+        return dict((s, [c.id for c in cs])
+                    for s, cs in zip(services, containers))
+
+
+class AsyncDocker:
+    '''
+    asyncio flavour of charms.docker.Docker, driving the docker CLI
+    through asyncio subprocesses. The method names and arguments mirror
+    Docker.
+
+    ex: docker = AsyncDocker()
+    await asyncio.gather(*[docker.pull(i) for i in images])
+    '''
+
+    def __init__(self, socket="unix:///var/run/docker.sock"):
+        '''
+        :param socket: URI to the Docker daemon socket
+            default: unix:///var/run/docker.sock
+        '''
+        self.socket = socket
+
+    async def run(self, image, options=None, commands=None, arg=None):
+        '''
+        Docker Run exposed as a coroutine. See Docker.run, except that a
+        failed run always raises.
+
+        :raises subprocess.CalledProcessError: if `docker run` fails
+        '''
+        cmd = _run_cmd(image, ' '.join(options or []),
+                       ' '.join(commands or []), ' '.join(arg or []))
+        return await run(cmd)
+
+    async def inspect(self, container_id):
+        '''
+        Low level information on a container. See Docker.inspect
+        '''
+        output = await run(['docker', 'inspect', '--type', 'container',
+                            container_id])
+        return json.loads(output.decode('utf-8'))[0]
+
+    async def wait_healthy(self, containers, timeout=60):
+        '''
+        Wait for containers to get healthy, following daemon events. See
+        Docker.wait_healthy
+        '''
+        many = not isinstance(containers, str)
+        names = list(containers) if many else [containers]
+        watch = health.HealthWatch(time.monotonic())
+        since = time.time()
+        for name in names:
+            try:
+                watch.seed(name, await self.inspect(name))
+            except subprocess.CalledProcessError:
+                watch.settle(name, 'missing')
+        if watch.pending:
+            cmd = _events_cmd(_event_time(since),
+                              _event_time(since + timeout),
+                              _filters({'type': 'container',
+                                        'event': health.EVENTS,
+                                        'container': list(watch.pending)}))
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE)
+            try:
+                async for line in proc.stdout:
+                    if line.strip():
+                        watch.feed(json.loads(line.decode('utf-8')))
+                    if not watch.pending:
+                        break
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+        watch.expire()
+        if not many:
+            return watch.results[containers]
+        return dict((name, watch.results[name]) for name in names)
+
+    async def login(self, user, password, email):
+        '''
+        Docker login exposed as a coroutine.
+        '''
+        await run(['docker', 'login', '-u', user, '-p', password,
+                   '-e', email])
+
+    async def logs(self, container_id, raise_on_failure=False):
+        '''
+        Docker logs exposed as a coroutine.
+        '''
+        output = await run(['docker', 'logs', container_id])
+        return output.decode('utf-8', 'replace')
+
+    async def ps(self, all=False, filters=None, limit=None, quiet=False,
+                 count=False):
+        '''
+        List containers as Container records. See Docker.ps
+        '''
+        cmd = _ps_cmd(all, _filters(filters), limit, quiet or count)
+        return _parse_ps(await run(cmd), quiet, count)
+
+    async def pull(self, image):
+        '''
+        Pull an image from the docker hub
+        '''
+        return await run(['docker', 'pull', image])
+
+    async def pull_many(self, images, parallelism=4):
+        '''
+        Pull several images concurrently. See Docker.pull_many
+        '''
+        if parallelism < 1:
+            raise ValueError("parallelism must be at least 1")
+        images = list(images)
+        wanted = {}
+        for image in images:
+            wanted.setdefault(_normalize_image(image), image)
+        limit = asyncio.Semaphore(parallelism)
+
+        async def one(image):
+            async with limit:
+                started = time.monotonic()
+                try:
+                    if await self._has_digest(image):
+                        return PullResult(image, True,
+                                          time.monotonic() - started, None,
+                                          None)
+                    output = await self.pull(image)
+                except (subprocess.CalledProcessError, OSError) as err:
+                    return PullResult(image, False,
+                                      time.monotonic() - started, None, err)
+                return PullResult(image, False, time.monotonic() - started,
+                                  output, None)
+
+        results = await asyncio.gather(*[one(i) for i in wanted.values()])
+        by_ref = dict(zip(wanted, results))
+        return dict((image, by_ref[_normalize_image(image)])
+                    for image in images)
+
+    async def _has_digest(self, image):
+        if '@' not in image:
+            return False
+        digest = _split_image(image)[1]
+        try:
+            output = await run(['docker', 'inspect', '--type', 'image',
+                                '--format', '{{json .RepoDigests}}', image])
+        except subprocess.CalledProcessError:
+            return False
+        return any(ref.partition('@')[2] == digest
+                   for ref in json.loads(output.decode('utf-8')) or [])
@@ -0,0 +1,399 @@
+import json
+import socket
+import struct
+import threading
+
+from http import client as httplib
+from urllib.parse import quote, urlencode, urlsplit
+
+
+# Sentinel so callers can explicitly request "no timeout" with None
+_DEFAULT = object()
+
+STDIN = 0
+STDOUT = 1
+STDERR = 2
+
+
+class APIError(Exception):
+    '''
+    Raised when the Docker Engine API answers a request with an error
+    status, or reports an error inside a streamed response body.
+    '''
+
+    def __init__(self, status, message, method=None, path=None):
+        self.status = status
+        self.message = message
+        self.method = method
+        self.path = path
+        super().__init__("{} {}: {} {}".format(method, path, status, message))
+
+
+class APIConnectionError(ConnectionError):
+    '''
+    Raised when a connection to the daemon socket could not be
+    established at all. Nothing has been sent to the daemon when this is
+    raised, so it is always safe to retry the request elsewhere.
+    '''
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    '''
+    HTTPConnection that speaks to a unix domain socket instead of a TCP
+    endpoint.
+    '''
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class ConnectionPool:
+    '''
+    A small LIFO pool of keep-alive connections. The most recently used
+    connection is handed out first, as it is the least likely to have been
+    closed by the daemon while idle.
+
+    :param factory: callable returning a new, unconnected HTTPConnection
+    :param maxsize: number of idle connections to keep around
+    '''
+
+    def __init__(self, factory, maxsize=4):
+        self.factory = factory
+        self.maxsize = maxsize
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''
+        Return a tuple of (connection, reused).
+        '''
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.factory(), False
+
+    def put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn):
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class Response:
+    '''
+    Thin wrapper around an HTTPResponse that hands its connection back to
+    the pool once the body has been consumed.
+    '''
+
+    def __init__(self, resp, conn, pool):
+        self._resp = resp
+        self._conn = conn
+        self._pool = pool
+        self.status = resp.status
+        self.headers = resp.headers
+        self._body = None
+
+    def _release(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._resp.will_close or not self._resp.isclosed():
+            self._resp.close()
+            self._pool.discard(conn)
+        else:
+            self._pool.put(conn)
+
+    def read(self):
+        if self._body is None:
+            try:
+                self._body = self._resp.read()
+            finally:
+                self._release()
+        return self._body
+
+    def json(self):
+        body = self.read()
+        if not body:
+            return None
+        return json.loads(body.decode('utf-8'))
+
+    def iter_chunks(self, size=8192):
+        '''
+        Yield the body in chunks of at most `size` bytes as they arrive.
+        '''
+        try:
+            while True:
+                chunk = self._resp.read1(size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def iter_json(self):
+        '''
+        Yield decoded objects from a newline delimited JSON stream, such as
+        /events or the progress of /images/create.
+        '''
+        try:
+            while True:
+                line = self._resp.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            self.close()
+
+    def iter_frames(self):
+        '''
+        Yield (stream, payload) tuples from a multiplexed attach/logs
+        stream. Each frame carries an 8 byte header: the stream type
+        (0 stdin, 1 stdout, 2 stderr), three bytes of padding and the
+        big-endian payload size.
+
+        Containers started with a TTY send a raw stream instead, which is
+        reported as STDOUT.
+        '''
+        try:
+            header = self._read_exactly(8)
+            if not header:
+                return
+            if header[0] not in (STDIN, STDOUT, STDERR) or \
+                    header[1:4] != b'\x00\x00\x00':
+                yield STDOUT, header
+                for chunk in self._iter_raw():
+                    yield STDOUT, chunk
+                return
+            while header:
+                if len(header) < 8:
+                    raise APIError(self.status, 'truncated stream frame')
+                stream, size = struct.unpack('>BxxxL', header)
+                payload = self._read_exactly(size)
+                if len(payload) < size:
+                    raise APIError(self.status, 'truncated stream frame')
+                yield stream, payload
+                header = self._read_exactly(8)
+        finally:
+            self.close()
+
+    def _iter_raw(self, size=8192):
+        while True:
+            chunk = self._resp.read1(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def _read_exactly(self, size):
+        buf = b''
+        while len(buf) < size:
+            chunk = self._resp.read(size - len(buf))
+            if not chunk:
+                break
+            buf += chunk
+        return buf
+
+    def close(self):
+        '''
+        Release the underlying connection. A partially consumed body can
+        not be reused, so the connection is dropped in that case.
+        '''
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class APIClient:
+    '''
+    Minimal HTTP/1.1 client for the Docker Engine API. Connections are
+    kept alive and reused from a pool, so a hook making dozens of calls
+    pays for a single connect instead of a docker CLI fork per call.
+
+    ex: api = APIClient("unix:///var/run/docker.sock")
+    api.get_json('/containers/json', params={'all': True})
+
+    :param base_url: unix:// or tcp:// URI of the daemon socket
+    :param timeout: socket timeout in seconds for non streaming requests
+    :param pool_size: number of idle keep-alive connections to retain
+    :param version: pin requests to an API version, eg: '1.24'.
+        default: None, use the daemon's current version
+    '''
+
+    def __init__(self, base_url="unix:///var/run/docker.sock", timeout=60,
+                 pool_size=4, version=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.version = version
+        self.pool = ConnectionPool(self._connection_factory(base_url),
+                                   maxsize=pool_size)
+
+    def _connection_factory(self, base_url):
+        url = urlsplit(base_url)
+        if url.scheme in ('unix', 'http+unix'):
+            path = url.path or url.netloc
+
+            def factory():
+                return UnixHTTPConnection(path, timeout=self.timeout)
+        elif url.scheme in ('tcp', 'http'):
+            host = url.hostname or 'localhost'
+            port = url.port or 2375
+
+            def factory():
+                return httplib.HTTPConnection(host, port,
+                                              timeout=self.timeout)
+        else:
+            raise ValueError("Unsupported docker socket: {}".format(base_url))
+        return factory
+
+    def url(self, path, params=None):
+        '''
+        Build the request target for `path`, with the optional version
+        prefix and query string.
+        '''
+        if self.version:
+            path = '/v{}{}'.format(self.version, path)
+        if params:
+            query = urlencode(_encode_params(params))
+            if query:
+                path = '{}?{}'.format(path, query)
+        return path
+
+    def request(self, method, path, params=None, body=None, headers=None,
+                stream=False, timeout=_DEFAULT):
+        '''
+        Issue a request and return a Response. Non streaming responses
+        are read eagerly so that the connection goes straight back into
+        the pool.
+
+        :param method: HTTP verb
+        :param path: API path, eg: /containers/json
+        :param params: dict of query parameters. Lists and dicts are JSON
+            encoded, booleans sent as 1/0 and None values dropped.
+        :param body: dict to send as JSON, or raw bytes
+        :param headers: extra request headers
+        :param stream: leave the body unread, for followed logs or events
+        :param timeout: override the socket timeout, None disables it
+        '''
+        target = self.url(path, params)
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        if timeout is _DEFAULT:
+            timeout = self.timeout
+
+        conn, reused = self.pool.get()
+        try:
+            resp = self._send(conn, method, target, body, headers, timeout)
+        except (httplib.RemoteDisconnected, ConnectionResetError,
+                BrokenPipeError):
+            self.pool.discard(conn)
+            if not reused:
+                raise
+            # The daemon closed the idle keep-alive connection under us,
+            # retry once on a fresh one.
+            conn = self.pool.factory()
+            try:
+                resp = self._send(conn, method, target, body, headers,
+                                  timeout)
+            except BaseException:
+                self.pool.discard(conn)
+                raise
+        except BaseException:
+            self.pool.discard(conn)
+            raise
+
+        response = Response(resp, conn, self.pool)
+        if response.status >= 400:
+            raise _api_error(response, method, path)
+        if not stream:
+            response.read()
+        return response
+
+    def _send(self, conn, method, target, body, headers, timeout):
+        conn.timeout = timeout
+        if conn.sock is None:
+            try:
+                conn.connect()
+            except OSError as exc:
+                raise APIConnectionError(
+                    "Unable to connect to {}: {}".format(self.base_url, exc))
+        else:
+            conn.sock.settimeout(timeout)
+        conn.request(method, target, body=body, headers=headers)
+        return conn.getresponse()
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def get_json(self, path, **kwargs):
+        return self.get(path, **kwargs).json()
+
+    def post_json(self, path, **kwargs):
+        return self.post(path, **kwargs).json()
+
+    def close(self):
+        self.pool.close()
+
+
+def quote_path(value):
+    '''
+    Quote a value for interpolation into an API path, such as an image
+    reference containing slashes.
+    '''
+    return quote(value, safe='')
+
+
+def _encode_params(params):
+    encoded = []
+    for key, value in params.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = '1' if value else '0'
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        encoded.append((key, value))
+    return encoded
+
+
+def _api_error(response, method, path):
+    body = response.read()
+    message = body.decode('utf-8', 'replace').strip()
+    try:
+        message = json.loads(message).get('message', message)
+    except (ValueError, AttributeError):
+        pass
+    return APIError(response.status, message, method, path)
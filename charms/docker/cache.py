@@ -0,0 +1,334 @@
+import subprocess
+import threading
+import time
+
+from .api import APIError, quote_path
+from .containers import Container
+from .docker import Docker
+
+
+# Container events that only move the container to a new state
+_STATE_ACTIONS = {
+    'start': 'running',
+    'restart': 'running',
+    'unpause': 'running',
+    'pause': 'paused',
+    'die': 'exited',
+    'stop': 'exited',
+}
+
+_IMAGE_REFRESH = ('pull', 'tag', 'untag', 'import', 'load', 'build')
+_NETWORK_REFRESH = ('create', 'connect', 'disconnect')
+
+_NS = 1000000000
+
+
+class ContainerStateCache:
+    '''
+    In memory view of the containers, images and networks known to a
+    daemon. It is seeded with a single listing and then kept current from
+    the daemon's event stream, so status checks become dict lookups rather
+    than repeated `docker ps` or inspect calls.
+
+    Containers are tracked through the Docker object's own backend. Image
+    and network state is read from the Engine API.
+
+    ex: cache = ContainerStateCache(Docker(backend='api')).start()
+    cache.get('web').state
+    > 'running'
+    cache.by_label('com.docker.compose.service', 'web')
+    > [Container(id='6f137adb5d27...', name='web', ...)]
+
+    :param docker: Docker instance to follow. default: Docker(backend='api')
+    :param window: seconds each events request stays open before it is
+        renewed. Bounds how long stop() takes.
+    :param reconnect_delay: seconds to wait before reconnecting after the
+        event stream fails
+    '''
+
+    def __init__(self, docker=None, window=5.0, reconnect_delay=1.0):
+        self.docker = docker or Docker(backend='api')
+        self.window = window
+        self.reconnect_delay = reconnect_delay
+        self.last_error = None
+        self._since_ns = None
+        self._lock = threading.RLock()
+        self._containers = {}
+        self._names = {}
+        self._label_keys = {}
+        self._label_pairs = {}
+        self._images = {}
+        self._image_refs = {}
+        self._networks = {}
+        self._network_names = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def since(self):
+        '''
+        Timestamp, as a 'seconds.nanoseconds' string, from which events
+        will be replayed on the next (re)connect.
+        '''
+        if self._since_ns is None:
+            return None
+        return '{}.{:09d}'.format(self._since_ns // _NS, self._since_ns % _NS)
+
+    def seed(self):
+        '''
+        Replace the cache contents with a full listing. Events from the
+        moment the listing started are replayed afterwards, so nothing
+        that happens during the listing is missed.
+        '''
+        started = time.time()
+        containers = self.docker.ps(all=True)
+        images = self.docker.api.get_json('/images/json') or []
+        networks = self.docker.api.get_json('/networks') or []
+        with self._lock:
+            for index in (self._containers, self._names, self._label_keys,
+                          self._label_pairs, self._images, self._image_refs,
+                          self._networks, self._network_names):
+                index.clear()
+            for container in containers:
+                self._add_container(container)
+            for image in images:
+                self._add_image(image)
+            for network in networks:
+                self._add_network(network)
+            self._since_ns = int(started * _NS)
+        return self
+
+    def start(self):
+        '''
+        Seed the cache, if that has not happened yet, and follow events in
+        a background thread.
+        '''
+        if self._since_ns is None:
+            self.seed()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._follow,
+                                        name='ContainerStateCache')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        '''
+        Stop following events. Returns once the current events request has
+        ended, at most `window` seconds later.
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _follow(self):
+        filters = {'type': ['container', 'image', 'network']}
+        while not self._stop.is_set():
+            until_ns = int((time.time() + self.window) * _NS)
+            until = '{}.{:09d}'.format(until_ns // _NS, until_ns % _NS)
+            try:
+                for event in self.docker.events(since=self.since, until=until,
+                                                filters=filters):
+                    self.apply(event)
+            except (OSError, ValueError, APIError,
+                    subprocess.CalledProcessError) as err:
+                self.last_error = err
+                self._stop.wait(self.reconnect_delay)
+                continue
+            with self._lock:
+                self._since_ns = max(self._since_ns or 0, until_ns)
+            if time.time() * _NS < until_ns:
+                # The daemon ended the stream early, don't spin on it
+                self._stop.wait(self.reconnect_delay)
+
+    def apply(self, event):
+        '''
+        Update the cache from a single daemon event, as yielded by
+        Docker.events. Events are idempotent, so replays are harmless.
+        '''
+        kind = event.get('Type')
+        action = event.get('Action') or event.get('status') or ''
+        actor = event.get('Actor') or {}
+        ident = actor.get('ID') or event.get('id')
+        if kind == 'container':
+            self._container_event(action, ident)
+        elif kind == 'image':
+            self._image_event(action, ident)
+        elif kind == 'network':
+            self._network_event(action, ident)
+        stamp = event.get('timeNano')
+        if stamp:
+            with self._lock:
+                self._since_ns = max(self._since_ns or 0, stamp)
+
+    def _container_event(self, action, ident):
+        if action == 'destroy':
+            with self._lock:
+                self._remove_container(ident)
+            return
+        with self._lock:
+            current = self._containers.get(ident)
+            if current is not None:
+                if action in _STATE_ACTIONS:
+                    self._replace(current._replace(
+                        state=_STATE_ACTIONS[action]))
+                    return
+                if action.startswith('health_status'):
+                    health = action.partition(':')[2].strip()
+                    self._replace(current._replace(health=health))
+                    return
+                if action != 'rename':
+                    return
+            elif action not in _STATE_ACTIONS and action != 'create':
+                return
+        # New containers and renames need the full record
+        try:
+            container = Container.from_inspect(self.docker.inspect(ident))
+        except (APIError, subprocess.CalledProcessError):
+            with self._lock:
+                self._remove_container(ident)
+            return
+        with self._lock:
+            self._replace(container)
+
+    def _image_event(self, action, ident):
+        if action == 'delete':
+            with self._lock:
+                self._remove_image(ident)
+            return
+        if action not in _IMAGE_REFRESH:
+            return
+        try:
+            image = self.docker.api.get_json(
+                '/images/{}/json'.format(quote_path(ident)))
+        except APIError:
+            with self._lock:
+                self._remove_image(ident)
+            return
+        with self._lock:
+            self._remove_image(image['Id'])
+            self._add_image(image)
+
+    def _network_event(self, action, ident):
+        if action == 'destroy':
+            with self._lock:
+                self._remove_network(ident)
+            return
+        if action not in _NETWORK_REFRESH:
+            return
+        try:
+            network = self.docker.api.get_json(
+                '/networks/{}'.format(quote_path(ident)))
+        except APIError:
+            with self._lock:
+                self._remove_network(ident)
+            return
+        with self._lock:
+            self._remove_network(network['Id'])
+            self._add_network(network)
+
+    def _replace(self, container):
+        self._remove_container(container.id)
+        self._add_container(container)
+
+    def _add_container(self, container):
+        self._containers[container.id] = container
+        for name in container.names:
+            self._names[name] = container.id
+        for key, value in container.labels.items():
+            self._label_keys.setdefault(key, set()).add(container.id)
+            self._label_pairs.setdefault((key, value), set()).add(
+                container.id)
+
+    def _remove_container(self, ident):
+        container = self._containers.pop(ident, None)
+        if container is None:
+            return
+        for name in container.names:
+            if self._names.get(name) == ident:
+                del self._names[name]
+        for key, value in container.labels.items():
+            for index, k in ((self._label_keys, key),
+                             (self._label_pairs, (key, value))):
+                ids = index.get(k)
+                if ids is not None:
+                    ids.discard(ident)
+                    if not ids:
+                        del index[k]
+
+    def _add_image(self, image):
+        self._images[image['Id']] = image
+        for ref in (image.get('RepoTags') or []) + \
+                (image.get('RepoDigests') or []):
+            self._image_refs[ref] = image['Id']
+
+    def _remove_image(self, ident):
+        ident = self._image_refs.get(ident, ident)
+        image = self._images.pop(ident, None)
+        if image is None:
+            return
+        for ref in (image.get('RepoTags') or []) + \
+                (image.get('RepoDigests') or []):
+            if self._image_refs.get(ref) == ident:
+                del self._image_refs[ref]
+
+    def _add_network(self, network):
+        self._networks[network['Id']] = network
+        self._network_names[network.get('Name')] = network['Id']
+
+    def _remove_network(self, ident):
+        ident = self._network_names.get(ident, ident)
+        network = self._networks.pop(ident, None)
+        if network is not None and \
+                self._network_names.get(network.get('Name')) == ident:
+            del self._network_names[network.get('Name')]
+
+    def get(self, key, default=None):
+        '''
+        Look up a container by full ID or name.
+        '''
+        with self._lock:
+            ident = self._names.get(key, key)
+            return self._containers.get(ident, default)
+
+    def by_label(self, key, value=None):
+        '''
+        Containers carrying the label `key`, optionally with `value`.
+        '''
+        with self._lock:
+            if value is None:
+                ids = self._label_keys.get(key, ())
+            else:
+                ids = self._label_pairs.get((key, value), ())
+            return [self._containers[i] for i in ids]
+
+    def containers(self):
+        with self._lock:
+            return list(self._containers.values())
+
+    def image(self, ref, default=None):
+        '''
+        Look up an image by ID, tag or digest. Untagged references are
+        taken to mean :latest.
+        '''
+        with self._lock:
+            ident = self._image_refs.get(ref)
+            if ident is None and '@' not in ref and \
+                    ':' not in ref.rpartition('/')[2]:
+                ident = self._image_refs.get('{}:latest'.format(ref))
+            return self._images.get(ident or ref, default)
+
+    def network(self, key, default=None):
+        '''
+        Look up a network by ID or name.
+        '''
+        with self._lock:
+            ident = self._network_names.get(key, key)
+            return self._networks.get(ident, default)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._containers)
@@ -1,9 +1,160 @@
+import os
+import subprocess
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .manifest import _hash_file, AppliedState, BuildManifest, config_hash
+from .progress import BuildProgress
 from .runner import run
 from .workspace import Workspace
 
 
+class ServiceResult:
+    '''
+    Outcome of running a docker-compose command for a single service, as
+    returned when a list of services is handed to Compose.
+
+    :param service: name of the service
+    :param output: STDOUT of the command, if it succeeded
+    :param error: the exception raised, if it failed
+    :param skipped: True if the command was not run, as nothing changed
+    '''
+
+    def __init__(self, service, output=None, error=None, skipped=False):
+        self.service = service
+        self.output = output
+        self.error = error
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        state = 'ok' if self.ok else repr(self.error)
+        if self.skipped:
+            state = 'skipped'
+        return "<ServiceResult {}: {}>".format(self.service, state)
+
+
+class UpPlan(namedtuple('UpPlan', ['added', 'changed', 'removed',
+                                   'unchanged'])):
+    '''
+    Difference between the services of a compose file and those applied by
+    the last Compose.up(changed_only=True), as lists of service names.
+
+    :param added: services that were never applied
+    :param changed: services whose definition changed since
+    :param removed: services no longer in the compose file
+    :param unchanged: services left alone
+    '''
+    __slots__ = ()
+
+    @property
+    def empty(self):
+        return not (self.added or self.changed or self.removed)
+
+
+class ScaleResult(namedtuple('ScaleResult', ['service', 'started',
+                                             'retired', 'error',
+                                             'rolled_back'])):
+    '''
+    Outcome of a rolling Compose.scale.
+
+    :param service: name of the service
+    :param started: IDs of the containers started, and kept. After a
+        failure, those the rollback could not remove
+    :param retired: IDs of the containers removed
+    :param error: the exception that stopped the roll, if it failed
+    :param rolled_back: True if the containers started by the roll were
+        removed again because of the failure, and the retired ones
+        replaced
+    '''
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _is_many(service):
+    return isinstance(service, (list, tuple, set, frozenset))
+
+
+def _progress(on_progress, stall_timeout, many, service=None):
+    '''
+    Runner options reporting build steps to `on_progress` and killing
+    builds that stall, for a single command or for each of many.
+    '''
+    options = {}
+    if on_progress is not None:
+        if many:
+            options['on_line'] = lambda s: BuildProgress(on_progress, s)
+        else:
+            callback = BuildProgress(on_progress, service)
+            options.update(on_stdout=callback, on_stderr=callback,
+                           capture=False)
+    if stall_timeout is not None:
+        options['idle_timeout'] = stall_timeout
+    return options
+
+
+def _gate(results, health, timeout):
+    '''
+    Fail the ServiceResult of each service whose containers did not all
+    get healthy.
+    '''
+    for service, checks in health.items():
+        failed = [h for h in checks if not h.ok]
+        if not checks:
+            results[service].error = RuntimeError(
+                "{} has no containers".format(service))
+        elif any(h.status == 'timeout' for h in failed):
+            results[service].error = TimeoutError(
+                "{} not healthy after {}s".format(service, timeout))
+        elif failed:
+            results[service].error = RuntimeError(
+                "{} did not get healthy: {}".format(service, ', '.join(
+                    "{} {}".format(h.container, h.status) for h in failed)))
+
+
+def _batch(count, kept, started, retiring, window, surge):
+    '''
+    Number of replicas to start and to retire in the next batch of a
+    rolling scale, never running more than `count` + `surge` at once.
+    Replicas are started before old ones are retired while there is room.
+    '''
+    need = count - kept - started
+    room = count + surge - (kept + started + retiring)
+    if need > 0 and room > 0:
+        return min(window, need, room), 0
+    return 0, min(window, retiring)
+
+
+def _unhealthy(health, timeout):
+    '''
+    The error for a batch of replicas that did not all get healthy, or
+    None.
+    '''
+    failed = [h for h in health.values() if not h.ok]
+    if any(h.status == 'timeout' for h in failed):
+        return TimeoutError("replicas not healthy after {}s: {}".format(
+            timeout, ', '.join(h.container for h in failed)))
+    if failed:
+        return RuntimeError("replicas did not get healthy: {}".format(
+            ', '.join("{} {}".format(h.container, h.status)
+                      for h in failed)))
+    return None
+
+
+def _step(fn, *args, **kwargs):
+    # a call made on behalf of a flow, see Compose._drive
+    return fn, args, kwargs
+
+
 class Compose:
-    def __init__(self, workspace, strict=True):
+    def __init__(self, workspace, strict=True, docker=None):
         '''
         Object to manage working with Docker-Compose on the CLI. exposes
         a natural language for performing common tasks with docker in
@@ -11,13 +162,99 @@ class Compose:
 
         :param workspace:  Define the CWD for docker-compose execution
 
-        :param strict: - Enable/disable workspace validation
+        :param strict: - Enable/disable workspace validation, and checking
+            service names against the compose file before running
+            docker-compose
+
+        :param docker: Docker used to look up the containers of services,
+            eg: to wait for them to get healthy. default: a Docker on the
+            default socket, created on first use
         '''
         self.workspace = Workspace(workspace)
+        self.strict = strict
+        self.docker = docker
         if strict:
             self.workspace.validate()
 
-    def build(self, service=None, force_rm=True, no_cache=False, pull=False):
+    def _check(self, service):
+        '''
+        Raise ValueError for service names the compose file does not
+        define, rather than spawning docker-compose only to have it fail.
+        '''
+        if not service or not self.strict or \
+                self.workspace.compose_file is None:
+            return
+        names = list(service) if _is_many(service) else [service]
+        unknown = self.workspace.project.unknown(names)
+        if unknown:
+            raise ValueError("No such service: {}".format(
+                ', '.join(unknown)))
+
+    def _run(self, cmd, **options):
+        return run(cmd, self.workspace, **options)
+
+    def _drive(self, flow):
+        '''
+        Run a flow: a generator holding logic shared with AsyncCompose,
+        which yields each call it needs made (see _step) and is sent back
+        its result, or thrown the exception it raised. Here the calls
+        block; AsyncCompose awaits them instead.
+        '''
+        result, error = None, None
+        while True:
+            try:
+                if error is None:
+                    fn, args, kwargs = flow.send(result)
+                else:
+                    fn, args, kwargs = flow.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = fn(*args, **kwargs), None
+            except Exception as err:
+                result, error = None, err
+
+    def _run_each(self, cmd, services, parallelism, on_line=None,
+                  idle_timeout=None):
+        '''
+        Run `cmd` once per service, suffixed with the service name, at
+        most `parallelism` at a time on a thread pool, and return a dict of
+        service name to ServiceResult in the order given. Each command goes
+        through run(), so the Executor's concurrency limit, timeout and
+        metrics apply. Failures are collected rather than raised.
+
+        :param on_line: called with each service name to get the line
+            callback for that service's STDOUT and STDERR
+        :param idle_timeout: seconds without output before a command is
+            killed
+        '''
+        if parallelism < 1:
+            raise ValueError("parallelism must be at least 1")
+        services = list(dict.fromkeys(services))
+        if not services:
+            return {}
+
+        def one(service):
+            options = {}
+            if on_line is not None:
+                callback = on_line(service)
+                options.update(on_stdout=callback, on_stderr=callback,
+                               capture=False)
+            if idle_timeout is not None:
+                options['idle_timeout'] = idle_timeout
+            try:
+                output = self._run("{} {}".format(cmd, service), **options)
+            except (subprocess.SubprocessError, OSError) as err:
+                return ServiceResult(service, error=err)
+            return ServiceResult(service, output=output)
+
+        with ThreadPoolExecutor(max_workers=min(parallelism,
+                                                len(services))) as pool:
+            return dict((r.service, r) for r in pool.map(one, services))
+
+    def build(self, service=None, force_rm=True, no_cache=False, pull=False,
+              parallelism=4, skip_unchanged=False, on_progress=None,
+              stall_timeout=None):
         '''
         Build or rebuild services.
 
@@ -25,11 +262,25 @@ class Compose:
         change a service's Dockerfile or the contents of its build directory
         you can invoke this method to rebuild it.
 
-        :param service: if provided will rebuild scoped to that service
+        :param service: if provided will rebuild scoped to that service.
+            A list of services are built concurrently, and a dict of
+            ServiceResult keyed by service is returned.
         :param force_rm: Always remove intermediate containers.
         :param no_cache: Do not use cache when building the image
         :param pull: Always attempt to pull a newer version of the image
+        :param parallelism: number of concurrent builds for a list of
+            services
+        :param skip_unchanged: only build services whose build context or
+            build configuration changed since their last successful build,
+            as recorded in the unit's BuildManifest. Returns None if there
+            was nothing to build. Ignored with no_cache or pull.
+        :param on_progress: called with a charms.docker.progress.Progress
+            for each build step as it starts. The build output is then not
+            kept, and b'' is returned in its place.
+        :param stall_timeout: seconds without build output before the build
+            is killed and charms.docker.progress.StalledError raised
         '''
+        self._check(service)
         cmd = "docker-compose build"
 
         if force_rm:
@@ -38,10 +289,57 @@ class Compose:
             cmd = "{} --no-cache".format(cmd)
         if pull:
             cmd = "{} --pull".format(cmd)
+        if skip_unchanged and not (no_cache or pull):
+            return self._drive(self._build_changed(
+                cmd, service, parallelism, on_progress, stall_timeout))
+        if _is_many(service):
+            return self._run_each(cmd, service, parallelism,
+                                  **_progress(on_progress, stall_timeout,
+                                              True))
         if service:
             cmd = "{} {}".format(cmd, service)
 
-        run(cmd, self.workspace)
+        return self._run(cmd, **_progress(on_progress, stall_timeout, False,
+                                          service))
+
+    def _build_plan(self, service):
+        '''
+        Return the BuildManifest, the services to build, and all services
+        considered, for a build of `service` with skip_unchanged.
+        '''
+        builds = self.workspace.project.builds()
+        if service is not None:
+            wanted = list(service) if _is_many(service) else [service]
+            builds = dict((s, builds[s]) for s in wanted if s in builds)
+        manifest = BuildManifest(self.workspace)
+        changed = manifest.changed(builds)
+        # refresh the file digest cache of services that are up to date
+        manifest.commit(s for s in builds if s not in changed)
+        return manifest, changed, list(builds)
+
+    def _build_results(self, manifest, results, considered):
+        manifest.commit(s for s, r in results.items() if r.ok)
+        return dict((s, results.get(s) or ServiceResult(s, skipped=True))
+                    for s in considered)
+
+    def _build_changed(self, cmd, service, parallelism, on_progress=None,
+                       stall_timeout=None):
+        manifest, changed, considered = self._build_plan(service)
+        if _is_many(service):
+            results = {}
+            if changed:
+                results = yield _step(
+                    self._run_each, cmd, changed, parallelism,
+                    **_progress(on_progress, stall_timeout, True))
+            return self._build_results(manifest, results, considered)
+        if not changed:
+            return None
+        output = yield _step(self._run,
+                             "{} {}".format(cmd, ' '.join(changed)),
+                             **_progress(on_progress, stall_timeout, False,
+                                         service))
+        manifest.commit(changed)
+        return output
 
     def kill(self, service=None):
         '''
@@ -49,35 +347,50 @@ class Compose:
 
         :param service: if defined will only kill that service.
         '''
+        self._check(service)
         if service:
             cmd = "docker-compose kill {}".format(service)
         else:
             cmd = "docker-compose kill"
-        run(cmd, self.workspace)
+        return self._run(cmd)
 
-    def pull(self, service=None):
+    def pull(self, service=None, parallelism=4):
         '''
         Pulls service images
 
         :param service: if defined, only pulls the image for specified service.
+            A list of services are pulled concurrently, and a dict of
+            ServiceResult keyed by service is returned.
+        :param parallelism: number of concurrent pulls for a list of services
         '''
+        self._check(service)
+        if _is_many(service):
+            return self._run_each("docker-compose pull", service, parallelism)
         if service:
             cmd = "docker-compose pull {}".format(service)
         else:
             cmd = "docker-compose pull"
-        run(cmd, self.workspace)
+        return self._run(cmd)
 
-    def restart(self, service=None):
+    def restart(self, service=None, parallelism=4):
         '''
         Restart services
 
         :param service: if defined, only restarts the specified service.
+            A list of services are restarted concurrently, and a dict of
+            ServiceResult keyed by service is returned.
+        :param parallelism: number of concurrent restarts for a list of
+            services
         '''
+        self._check(service)
+        if _is_many(service):
+            return self._run_each("docker-compose restart", service,
+                                  parallelism)
         if service:
             cmd = "docker-compose restart {}".format(service)
         else:
             cmd = "docker-compose restart"
-        run(cmd, self.workspace)
+        return self._run(cmd)
 
     def rm(self, service=None):
         '''
@@ -85,21 +398,125 @@ class Compose:
 
         :param service: if defined only the specified service.
         '''
+        self._check(service)
         if service:
             cmd = "docker-compose rm -f {}".format(service)
         else:
             cmd = "docker-compose rm -f"
-        run(cmd, self.workspace)
+        return self._run(cmd)
 
-    def scale(self, service, count):
+    def scale(self, service, count, rolling=False, window=1, surge=1,
+              recreate=True, timeout=60):
         '''
         Set number of containers to run for a service.
 
+        A rolling scale gets there in batches of `window` replicas instead,
+        starting each batch with `docker-compose up --scale`, waiting for
+        it to get healthy (see Docker.wait_healthy) and only then removing
+        as many old replicas. Up to `surge` replicas over `count` may run
+        meanwhile, so with a surge there is no dip in capacity. If a batch
+        fails, every replica the roll started is removed and the number of
+        replicas restored: old replicas that were already retired are
+        replaced from the current definition of the service.
+
+        compose.scale('web', 6, rolling=True, window=2, surge=2)
+        > ScaleResult(service='web', started=['4a1c...', ...], ...)
+
         :param service: Service to scale as defined in docker-compose.yml
         :param count: number of containers to scale
+        :param rolling: scale in batches gated on health, and return a
+            ScaleResult
+        :param window: number of replicas started or retired per batch
+        :param surge: number of replicas allowed over `count` during the
+            roll. With 0, old replicas are retired before their
+            replacements start
+        :param recreate: replace every existing replica, eg: to roll out a
+            new image. Otherwise only the difference to `count` is started
+            or retired
+        :param timeout: seconds each batch is given to get healthy
         '''
+        self._check(service)
+        if rolling:
+            if window < 1 or surge < 0:
+                raise ValueError("window must be at least 1 and surge "
+                                 "not negative")
+            return self._drive(self._scale_rolling(
+                service, count, window, surge, recreate, timeout))
         cmd = "docker-compose scale {}={}".format(service, count)
-        run(cmd, self.workspace)
+        return self._run(cmd)
+
+    def _scale_cmd(self, service, count):
+        return ("docker-compose up -d --no-deps --no-recreate --scale {}={} "
+                "{}").format(service, count, service)
+
+    def _scale_rolling(self, service, count, window, surge, recreate,
+                       timeout):
+        old = [c.id for c in (yield _step(self._service_containers,
+                                          service))]
+        kept = [] if recreate else old[:count]
+        retiring = [c for c in old if c not in kept]
+        started, retired = [], []
+        try:
+            while True:
+                add, drop = _batch(count, len(kept), len(started),
+                                   len(retiring), window, surge)
+                if add:
+                    known = set(old) | set(started)
+                    yield _step(self._run, self._scale_cmd(
+                        service, len(kept) + len(started) + len(retiring) +
+                        add))
+                    batch = [c.id for c in (yield _step(
+                        self._service_containers, service))
+                        if c.id not in known]
+                    started.extend(batch)
+                    health = {}
+                    if batch:
+                        health = yield _step(self._client().wait_healthy,
+                                             batch, timeout)
+                    error = _unhealthy(health, timeout)
+                    if error is None and len(batch) < add:
+                        error = RuntimeError(
+                            "{} of {} replicas started".format(len(batch),
+                                                               add))
+                    if error is not None:
+                        raise error
+                    # retire as many old replicas as were started
+                    drop = min(len(retiring), len(kept) + len(started) +
+                               len(retiring) - count)
+                elif not drop:
+                    break
+                if drop > 0:
+                    yield _step(self._run, "docker rm -f {}".format(
+                        ' '.join(retiring[:drop])))
+                    retired.extend(retiring[:drop])
+                    del retiring[:drop]
+        except Exception as err:
+            # eg: a failed or timed out command, or an APIError of the
+            # client; each undo is tried even if the other one fails
+            removed = restored = True
+            try:
+                # a failed or timed out scale may have started replicas
+                # the roll has not seen yet
+                current = yield _step(self._service_containers, service)
+                started = [c.id for c in current if c.id not in old]
+            except Exception:
+                pass
+            if started:
+                try:
+                    yield _step(self._run, "docker rm -f {}".format(
+                        ' '.join(started)))
+                except Exception:
+                    removed = False
+            if retired:
+                try:
+                    yield _step(self._run, self._scale_cmd(service,
+                                                           len(old)))
+                except Exception:
+                    restored = False
+            return ScaleResult(service, [] if removed else started,
+                               retired, err,
+                               bool(started) and removed and restored)
+        return ScaleResult(service, started, retired, None, False)
 
     def start(self, service):
         '''
@@ -107,8 +524,9 @@ class Compose:
 
         :param service: Service to start
         '''
+        self._check(service)
         cmd = "docker-compose start {}".format(service)
-        run(cmd, self.workspace)
+        return self._run(cmd)
 
     def stop(self, service, timeout=10):
         '''
@@ -117,17 +535,243 @@ class Compose:
         :param service: Service to stop.
         :param timeout: specify a shutdown timeout in seconds.
         '''
+        self._check(service)
         cmd = "docker-compose stop -t {} {}".format(timeout, service)
-        run(cmd, self.workspace)
+        return self._run(cmd)
 
-    def up(self, service=None):
+    def up(self, service=None, parallelism=4, changed_only=False):
         '''
         Convenience method that wraps `docker-compose up`
 
-        :param service: if defined only launches the specified service
+        :param service: if defined only launches the specified service.
+            A list of services are launched concurrently, and a dict of
+            ServiceResult keyed by service is returned. Services sharing a
+            dependency that is not yet running may race to create it, so
+            start shared dependencies first.
+        :param parallelism: number of concurrent launches for a list of
+            services
+        :param changed_only: converge the whole project declaratively:
+            only services whose definition in the compose file, env files,
+            interpolated variables, last recorded build or local image ID
+            changed since the previous up(changed_only=True) are brought
+            up, and the containers of
+            services dropped from the file are removed. Returns the UpPlan
+            that was applied. Cannot be combined with `service`.
         '''
+        if changed_only:
+            if service is not None:
+                raise ValueError("changed_only applies to the whole project")
+            return self._drive(self._up_changed())
+        self._check(service)
+        if _is_many(service):
+            return self._run_each("docker-compose up -d", service,
+                                  parallelism)
         if service:
             cmd = "docker-compose up -d {}".format(service)
         else:
             cmd = "docker-compose up -d"
-        run(cmd, self.workspace)
+        return self._run(cmd)
+
+    def up_waves(self, service=None, parallelism=4, timeout=300):
+        '''
+        Bring services up in dependency order, as given by depends_on,
+        links and volumes_from in the compose file. Services are grouped
+        into waves (see Project.waves); each wave is launched concurrently,
+        and the next one only once every container of the wave passes its
+        healthcheck, or runs if it has none (see wait_healthy).
+
+        Dependency cycles are reported before anything is started. A wave
+        that fails to launch or to get healthy stops the rollout, and the
+        services of later waves are returned as skipped.
+
+        compose.up_waves()
+        > {'db': <ServiceResult db: ok>, 'web': <ServiceResult web: ok>}
+
+        :param service: a service or list of services to bring up, along
+            with everything they depend on. default: all services
+        :param parallelism: number of concurrent launches within a wave
+        :param timeout: seconds each wave is given to get healthy
+        :returns: dict of ServiceResult keyed by service, in start order
+        '''
+        return self._drive(self._up_waves(service, parallelism, timeout))
+
+    def _up_waves(self, service, parallelism, timeout):
+        results = {}
+        failed = False
+        for wave in self._waves(service):
+            if failed:
+                results.update((s, ServiceResult(s, skipped=True))
+                               for s in wave)
+                continue
+            started = yield _step(self._run_each,
+                                  "docker-compose up -d --no-deps", wave,
+                                  parallelism)
+            results.update(started)
+            launched = [s for s in wave if started[s].ok]
+            if launched:
+                health = yield from self._wait_healthy(launched, timeout)
+                _gate(results, health, timeout)
+            failed = not all(results[s].ok for s in wave)
+        return results
+
+    def _waves(self, service):
+        '''
+        The waves to bring `service` up in, raising DependencyCycleError
+        before anything is started.
+        '''
+        self._check(service)
+        names = None
+        if service:
+            names = list(service) if _is_many(service) else [service]
+        return self.workspace.project.waves(names)
+
+    def wait_healthy(self, services, timeout=60):
+        '''
+        Wait for the containers of services to pass their healthchecks, or
+        to run when they have none. See Docker.wait_healthy, which follows
+        the daemon's events rather than polling.
+
+        compose.wait_healthy(['db', 'cache'])
+        > {'db': [HealthResult(container='6f13...', status='healthy',
+                               duration=3.1)], 'cache': [...]}
+
+        :param services: a service or list of services
+        :param timeout: seconds to wait for all of them
+        :returns: dict of service to the HealthResult of each of its
+            containers. A service without containers maps to [].
+        '''
+        return self._drive(self._wait_healthy(services, timeout))
+
+    def _wait_healthy(self, services, timeout):
+        names = list(services) if _is_many(services) else [services]
+        self._check(names)
+        found = yield _step(self._services_containers, names)
+        ids = [cid for s in names for cid in found[s]]
+        health = {}
+        if ids:
+            health = yield _step(self._client().wait_healthy, ids, timeout)
+        return dict((s, [health[cid] for cid in found[s]]) for s in names)
+
+    def _client(self):
+        if self.docker is None:
+            from .docker import Docker
+            self.docker = Docker()
+        return self.docker
+
+    def _service_filters(self, service):
+        return {'label': [
+            'com.docker.compose.project={}'.format(
+                self.workspace.project_name),
+            'com.docker.compose.service={}'.format(service)]}
+
+    def _service_containers(self, service):
+        return self._client().ps(all=True,
+                                 filters=self._service_filters(service))
+
+    def _services_containers(self, services):
+        # IDs of the containers of each service
+        return dict((s, [c.id for c in self._service_containers(s)])
+                    for s in services)
+
+    def plan(self):
+        '''
+        Compare the services of the compose file with those applied by the
+        last up(changed_only=True), without changing anything.
+
+        compose.plan()
+        > UpPlan(added=['cache'], changed=['web'], removed=[],
+                 unchanged=['db'])
+        '''
+        return self._drive(self._plan())
+
+    def _plan(self):
+        image_ids = yield from self._image_ids()
+        return self._up_plan(image_ids)[0]
+
+    def _pulled_images(self):
+        # images of the services that only run one, so that a pull of a
+        # newer image counts as a change
+        return sorted(set(svc.image for svc in self.workspace.project
+                          if svc.image and not svc.build))
+
+    def _image_id_cmd(self, image):
+        return "docker image inspect --format {{{{.Id}}}} {}".format(image)
+
+    def _image_ids(self, images=None):
+        ids = {}
+        for image in self._pulled_images() if images is None else images:
+            try:
+                output = yield _step(self._run, self._image_id_cmd(image))
+                ids[image] = output.strip().decode() or None
+            except (subprocess.CalledProcessError, OSError):
+                # not pulled yet
+                ids[image] = None
+        return ids
+
+    def _up_plan(self, image_ids):
+        '''
+        The UpPlan, the AppliedState and the hash of every service. A hash
+        covers the service's definition, the values of the variables it
+        interpolates, the contents of its env files, the fingerprint of
+        its last build and the ID of the image it runs.
+        '''
+        builds = BuildManifest(self.workspace).entries
+        env = self.workspace.environment()
+        hashes = {}
+        for name, svc in self.workspace.project.services.items():
+            config = dict(svc.config)
+            built = (builds.get(name) or {}).get('fingerprint')
+            if built and config.get('build'):
+                # a rebuilt image means the containers are stale as well
+                config['build'] = [config['build'], built]
+            env_files = {}
+            for path in svc.env_files:
+                try:
+                    env_files[path] = _hash_file(
+                        os.path.join(self.workspace.path, path))
+                except FileNotFoundError:
+                    env_files[path] = None
+            hashes[name] = config_hash({
+                'config': config,
+                'variables': dict((v, env.get(v)) for v in svc.variables),
+                'env_files': env_files,
+                'image': image_ids.get(svc.image) if not svc.build else None,
+            })
+        state = AppliedState(self.workspace)
+        applied = state.services
+        plan = UpPlan(
+            added=[s for s in hashes if s not in applied],
+            changed=[s for s in hashes
+                     if s in applied and applied[s] != hashes[s]],
+            removed=[s for s in applied if s not in hashes],
+            unchanged=[s for s in hashes if applied.get(s) == hashes[s]])
+        return plan, state, hashes
+
+    def _orphans_cmd(self, service):
+        return ("docker ps --all --quiet --no-trunc"
+                " --filter label=com.docker.compose.project={}"
+                " --filter label=com.docker.compose.service={}").format(
+                    self.workspace.project_name, service)
+
+    def _up_changed(self):
+        image_ids = yield from self._image_ids()
+        plan, state, hashes = self._up_plan(image_ids)
+        targets = plan.added + plan.changed
+        if targets:
+            yield _step(self._run, "docker-compose up -d {}".format(
+                ' '.join(targets)))
+            missing = [i for i, image_id in image_ids.items()
+                       if image_id is None]
+            if missing:
+                # pulled by the up, record what it started
+                image_ids.update((yield from self._image_ids(missing)))
+                hashes = self._up_plan(image_ids)[2]
+        ids = []
+        for service in plan.removed:
+            output = yield _step(self._run, self._orphans_cmd(service))
+            ids.extend(output.split())
+        if ids:
+            yield _step(self._run, "docker rm -f {}".format(
+                ' '.join(i.decode('utf-8') for i in ids)))
+        state.commit(hashes)
+        return plan
@@ -0,0 +1,183 @@
+import datetime
+
+from collections import namedtuple
+
+
+_FIELDS = ['id', 'name', 'names', 'image', 'command', 'created', 'state',
+           'status', 'labels', 'ports', 'health']
+
+
+class Container(namedtuple('Container', _FIELDS)):
+    '''
+    A row of `docker ps`, with the same shape whichever backend produced
+    it.
+
+    :param id: full container ID
+    :param name: primary container name, without the leading slash
+    :param names: every name of the container, including link aliases
+    :param image: image the container was created from
+    :param command: command the container runs
+    :param created: creation time in seconds since the epoch, or None
+    :param state: running, exited, created, paused, restarting or dead
+    :param status: human readable status, eg: Up 3 minutes
+    :param labels: dict of container labels
+    :param ports: list of dicts with IP, PrivatePort, PublicPort and Type
+    :param health: starting, healthy or unhealthy, or None when the
+        container has no healthcheck
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_api(cls, obj):
+        '''
+        Build a Container from an entry of the /containers/json response.
+        '''
+        names = [n.lstrip('/') for n in obj.get('Names') or []]
+        return cls(id=obj['Id'],
+                   name=_primary_name(names),
+                   names=names,
+                   image=obj.get('Image'),
+                   command=obj.get('Command'),
+                   created=obj.get('Created'),
+                   state=obj.get('State') or _state(obj.get('Status')),
+                   status=obj.get('Status'),
+                   labels=obj.get('Labels') or {},
+                   ports=obj.get('Ports') or [],
+                   health=_health(obj.get('Status')))
+
+    @classmethod
+    def from_cli(cls, obj):
+        '''
+        Build a Container from a line of `docker ps --format '{{json .}}'`.
+        '''
+        names = [n for n in (obj.get('Names') or '').split(',') if n]
+        return cls(id=obj['ID'],
+                   name=_primary_name(names),
+                   names=names,
+                   image=obj.get('Image'),
+                   command=(obj.get('Command') or '').strip('"'),
+                   created=_created(obj.get('CreatedAt')),
+                   state=obj.get('State') or _state(obj.get('Status')),
+                   status=obj.get('Status'),
+                   labels=_labels(obj.get('Labels')),
+                   ports=_ports(obj.get('Ports')),
+                   health=_health(obj.get('Status')))
+
+    @classmethod
+    def from_inspect(cls, obj):
+        '''
+        Build a Container from the output of `docker inspect`.
+        '''
+        config = obj.get('Config') or {}
+        state = obj.get('State') or {}
+        name = (obj.get('Name') or '').lstrip('/')
+        ports = []
+        bindings = (obj.get('NetworkSettings') or {}).get('Ports') or {}
+        for spec, published in sorted(bindings.items()):
+            private, _, proto = spec.partition('/')
+            for binding in published or [{}]:
+                port = {'PrivatePort': _port(private), 'Type': proto}
+                if binding.get('HostPort'):
+                    port['IP'] = binding.get('HostIp')
+                    port['PublicPort'] = _port(binding['HostPort'])
+                ports.append(port)
+        return cls(id=obj['Id'],
+                   name=name or None,
+                   names=[name] if name else [],
+                   image=config.get('Image'),
+                   command=' '.join((config.get('Entrypoint') or []) +
+                                    (config.get('Cmd') or [])),
+                   created=_created_iso(obj.get('Created')),
+                   state=state.get('Status'),
+                   status=state.get('Status'),
+                   labels=config.get('Labels') or {},
+                   ports=ports,
+                   health=(state.get('Health') or {}).get('Status'))
+
+
+def _primary_name(names):
+    # Link aliases are reported as other_container/alias
+    for name in names:
+        if '/' not in name:
+            return name
+    return names[0] if names else None
+
+
+def _state(status):
+    if not status:
+        return None
+    if status.startswith('Up'):
+        return 'paused' if '(Paused)' in status else 'running'
+    for prefix, state in (('Exited', 'exited'), ('Created', 'created'),
+                          ('Restarting', 'restarting'), ('Dead', 'dead'),
+                          ('Removal', 'removing')):
+        if status.startswith(prefix):
+            return state
+    return None
+
+
+def _health(status):
+    # eg: Up 3 minutes (healthy), Up 2 seconds (health: starting)
+    if not status or not status.endswith(')'):
+        return None
+    for health in ('unhealthy', 'healthy', 'starting'):
+        if status.endswith('{})'.format(health)):
+            return health
+    return None
+
+
+def _created_iso(value):
+    # eg: 2016-03-23T06:29:35.123456789Z
+    if not value:
+        return None
+    try:
+        stamp = datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+    return int(stamp.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def _created(value):
+    # eg: 2016-03-23 06:29:35 +0000 UTC
+    if not value:
+        return None
+    try:
+        stamp = datetime.datetime.strptime(value[:25], '%Y-%m-%d %H:%M:%S %z')
+    except ValueError:
+        return None
+    return int(stamp.timestamp())
+
+
+def _labels(value):
+    labels = {}
+    for pair in (value or '').split(','):
+        if pair:
+            key, _, val = pair.partition('=')
+            labels[key] = val
+    return labels
+
+
+def _ports(value):
+    # eg: 0.0.0.0:8000->80/tcp, 443/tcp
+    ports = []
+    for mapping in (value or '').split(','):
+        mapping = mapping.strip()
+        if not mapping:
+            continue
+        public, _, private = mapping.rpartition('->')
+        private, _, proto = private.partition('/')
+        port = {'PrivatePort': _port(private), 'Type': proto or 'tcp'}
+        if public:
+            ip, _, public_port = public.rpartition(':')
+            port['IP'] = ip
+            port['PublicPort'] = _port(public_port)
+        ports.append(port)
+    return ports
+
+
+def _port(value):
+    try:
+        return int(value)
+    except ValueError:
+        # ranges such as 8000-8010 are kept as reported
+        return value
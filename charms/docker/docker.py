@@ -1,30 +1,205 @@
-import os
+import base64
+import datetime
+import json
+import socket
 import subprocess
+import time
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
 from shlex import split
 
+from . import health, metrics, progress, streams
+from .api import (_DEFAULT, APIClient, APIConnectionError, APIError,
+                  quote_path, STDOUT)
+from .containers import Container
+from .progress import StalledError
+from .runner import get_executor
 from .workspace import Workspace
 
 
+BACKENDS = ('cli', 'api', 'auto')
+
+
+class PullResult(namedtuple('PullResult', ['image', 'skipped', 'duration',
+                                           'output', 'error'])):
+    '''
+    Outcome of pulling a single image with Docker.pull_many.
+
+    :param image: the image reference, as given
+    :param skipped: True if the image was pinned by digest and already
+        present, so the registry was not contacted
+    :param duration: seconds spent on the image, including the local
+        digest check
+    :param output: output of the pull, if one was made and succeeded
+    :param error: the exception raised, if it failed
+    '''
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Ping(namedtuple('Ping', ['ok', 'api_version', 'latency', 'error'])):
+    '''
+    Result of probing the daemon's /_ping endpoint.
+
+    :param ok: True if the daemon answered OK
+    :param api_version: API version reported by the daemon, eg: '1.24'
+    :param latency: round trip time in milliseconds
+    :param error: the exception raised when the daemon did not answer
+    '''
+    __slots__ = ()
+
+
+class ContainerSpec(namedtuple('ContainerSpec', ['image', 'name', 'command',
+                                                 'env', 'labels',
+                                                 'options'])):
+    '''
+    A container to launch with Docker.run_many.
+
+    ContainerSpec('redis:3', name='cache-0', env={'MAXMEMORY': '64mb'},
+                  labels={'juju-unit': 'cache/0'}, options=['--restart',
+                                                            'always'])
+
+    :param image: image to run, eg: ubuntu:latest
+    :param name: container name, or None for a generated one
+    :param command: command to run, as a string or argv list
+    :param env: dict of environment variables
+    :param labels: dict of container labels
+    :param options: list of further `docker run` options, eg:
+        ['-v', '/tmp:/tmp']
+    '''
+    __slots__ = ()
+
+    def __new__(cls, image, name=None, command=None, env=None, labels=None,
+                options=None):
+        return super().__new__(cls, image, name, command, env, labels,
+                               options)
+
+    def argv(self):
+        '''
+        The `docker run` options, image and command as a list, detached.
+        '''
+        options = []
+        for option in self.options or []:
+            options.extend(split(option))
+        if not any(o in ('-d', '--detach') or o.startswith('--detach=')
+                   for o in options):
+            options.insert(0, '-d')
+        if self.name:
+            options.extend(['--name', self.name])
+        for key, value in sorted((self.env or {}).items()):
+            options.extend(['-e', '{}={}'.format(key, value)])
+        for key, value in sorted((self.labels or {}).items()):
+            options.extend(['--label', '{}={}'.format(key, value)])
+        command = self.command or []
+        if isinstance(command, str):
+            command = split(command)
+        return options, [self.image] + list(command)
+
+
+class RunResult(namedtuple('RunResult', ['spec', 'container_id', 'error',
+                                         'rolled_back'])):
+    '''
+    Outcome of launching a single ContainerSpec with Docker.run_many.
+
+    :param spec: the ContainerSpec
+    :param container_id: ID of the started container, if it started
+    :param error: the exception raised, if it failed, or if removing it
+        during a rollback failed
+    :param rolled_back: True if the container was started, then removed
+        because another spec failed
+    '''
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None and not self.rolled_back
+
+
 class Docker:
     '''
     Wrapper class to communicate with the Docker daemon on behalf of
     a charmer. Provides stateless operations of a running docker daemon
     '''
 
-    def __init__(self, socket="unix:///var/run/docker.sock", workspace=None):
+    def __init__(self, socket="unix:///var/run/docker.sock", workspace=None,
+                 backend='cli'):
         '''
         :param socket: URI to the Docker daemon socket
             default: unix:///var/run/docker.sock
 
         :param workspace: Path to directory containing a Dockerfile
             default: None
+
+        :param backend: How to reach the daemon. 'cli' forks the docker
+            client for every call, 'api' speaks HTTP to the socket over
+            pooled keep-alive connections, and 'auto' uses the API but
+            falls back to the CLI when the socket can not be reached.
+            default: cli
         '''
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend: {}".format(backend))
         self.socket = socket
+        self.backend = backend
+        self._api = None
+        self._auth = None
+        self._ping = None
+        self._ping_at = 0
         if workspace:
             self.workspace = Workspace(workspace)
 
-    def running(self):
+    @property
+    def api(self):
+        '''
+        Lazily constructed APIClient bound to this daemon's socket.
+        '''
+        if self._api is None:
+            self._api = APIClient(self.socket)
+        return self._api
+
+    def _dispatch(self, api_call, cli_call):
+        if self.backend == 'cli':
+            return cli_call()
+        try:
+            return api_call()
+        except APIConnectionError:
+            if self.backend == 'auto':
+                return cli_call()
+            raise
+
+    @metrics.instrument
+    def ping(self, timeout=500, ttl=1.0):
+        '''
+        Probe the daemon's /_ping endpoint over its unix or tcp socket,
+        whatever the backend. The result is cached for `ttl` seconds, so
+        hooks can gate every step on daemon readiness cheaply.
+
+        docker.ping()
+        > Ping(ok=True, api_version='1.24', latency=0.41, error=None)
+
+        :param timeout: connect and read timeout in milliseconds
+        :param ttl: seconds to reuse the last result for, 0 to always probe
+        '''
+        start = time.monotonic()
+        if self._ping is not None and start - self._ping_at < ttl:
+            return self._ping
+        try:
+            resp = self.api.get('/_ping', timeout=timeout / 1000.0)
+            latency = (time.monotonic() - start) * 1000
+            result = Ping(resp.read().strip() == b'OK',
+                          resp.headers.get('Api-Version'), latency, None)
+        except (OSError, HTTPException, APIError) as err:
+            latency = (time.monotonic() - start) * 1000
+            result = Ping(False, None, latency, err)
+        self._ping = result
+        self._ping_at = start
+        return result
+
+    def running(self, timeout=500, ttl=1.0):
         '''
         Predicate method to determine if the daemon we are talking to is
         actually online and recieving events.
@@ -32,11 +207,15 @@ class Docker:
         ex: bootstrap = Docker(socket="unix:///var/run/docker-boostrap.sock")
         bootstrap.running()
         > True
+
+        :param timeout: connect and read timeout in milliseconds
+        :param ttl: seconds to reuse the last result for
         '''
-        # TODO: Add TCP:// support for running check
-        return os.path.isfile(self.socket)
+        return self.ping(timeout, ttl).ok
 
-    def run(self, image, options=[], commands=[], arg=[]):
+    @metrics.instrument
+    def run(self, image, options=None, commands=None, arg=None,
+            raise_on_failure=False):
         '''
         Docker Run exposed as a method. This wont be as natural as the
         command line docker experience.
@@ -44,55 +223,867 @@ class Docker:
         Docker CLI output example:
         Usage:	docker run [OPTIONS] IMAGE [COMMAND] [ARG...]
 
+        When talking to the API, the common run options (-d, --name, -e,
+        -l, -v, -p, --rm, --restart, --net, --privileged, -w, -u,
+        --entrypoint, -h) are translated into a container config. Anything
+        else is handed to the CLI.
+
         :param image: string of the container to pull from the registry,
                         eg: ubuntu:latest
         :param options:  array of string  options, eg: ['-d', '-v /tmp:/tmp']
         :param commands:  array of string commands, eg: ['ls']
         :param arg:  array of string command args, eg: ['-al']
+        :param raise_on_failure: raise the error of a failed run, rather
+            than printing it and returning None
         '''
-        options = ' '.join(options)
-        command = ' '.join(commands)
-        args = ' '.join(arg)
-        cmd = "docker run {0} {1} {2} {3}".format(
-            options, image, command, args)
+        options = ' '.join(options or [])
+        command = ' '.join(commands or [])
+        args = ' '.join(arg or [])
 
+        def cli():
+            cmd = _run_cmd(image, options, command, args)
+            try:
+                return subprocess.check_output(cmd)
+            except subprocess.CalledProcessError as expect:
+                if raise_on_failure:
+                    raise
+                print("Error: ", expect.returncode, expect.output)
+
+        config = _run_config(split(options))
+        if config is None:
+            return cli()
+
+        def api():
+            cmd = split(command) + split(args)
+            try:
+                return self._api_run(image, config, cmd)
+            except APIError as expect:
+                if raise_on_failure:
+                    raise
+                print("Error: ", expect.status, expect.message)
+
+        return self._dispatch(api, cli)
+
+    @metrics.instrument
+    def run_many(self, specs, parallelism=4, rollback=False):
+        '''
+        Launch several containers, detached, at most `parallelism` at a
+        time. Failures are collected rather than raised.
+
+        specs = [ContainerSpec('worker', name='worker-{}'.format(i),
+                               labels={'juju-unit': 'workers/0'})
+                 for i in range(50)]
+        results = docker.run_many(specs, parallelism=8, rollback=True)
+        [r.container_id for r in results]
+        > ['6f137adb5d27...', ...]
+
+        :param specs: list of ContainerSpec, or dicts of its fields
+        :param parallelism: number of concurrent launches
+        :param rollback: if any spec fails, remove (forcefully) the
+            containers that did start, so the batch is all or nothing. If
+            that fails too, their results carry the error of the removal
+            and rolled_back stays False
+        :returns: list of RunResult, in the order of `specs`
+        '''
+        if parallelism < 1:
+            raise ValueError("parallelism must be at least 1")
+        specs = [ContainerSpec(**spec) if isinstance(spec, dict) else spec
+                 for spec in specs]
+        if not specs:
+            return []
+
+        def one(spec):
+            try:
+                return RunResult(spec, self._run_spec(spec), None, False)
+            except (subprocess.CalledProcessError, APIError, OSError,
+                    HTTPException) as err:
+                return RunResult(spec, None, err, False)
+
+        with ThreadPoolExecutor(max_workers=min(parallelism,
+                                                len(specs))) as pool:
+            results = list(pool.map(one, specs))
+        if rollback and any(r.error is not None for r in results):
+            started = [r.container_id for r in results if r.container_id]
+            try:
+                if started:
+                    self.rm(started, force=True)
+            except (subprocess.CalledProcessError, APIError, OSError,
+                    HTTPException) as err:
+                # the started containers may still be there
+                results = [r._replace(error=err) if r.container_id else r
+                           for r in results]
+            else:
+                results = [r._replace(rolled_back=bool(r.container_id))
+                           for r in results]
+        return results
+
+    def _run_spec(self, spec):
+        options, command = spec.argv()
+
+        def cli():
+            output = subprocess.check_output(['docker', 'run'] + options +
+                                             command)
+            return output.decode('utf-8').strip()
+
+        config = _run_config(options)
+        if config is None:
+            return cli()
+        return self._dispatch(
+            lambda: self._api_run(command[0], config, command[1:]), cli)
+
+    @metrics.instrument
+    def rm(self, container_ids, force=False, volumes=False):
+        '''
+        Remove containers.
+
+        :param container_ids: name or ID of a container, or a list of them
+        :param force: kill running containers first
+        :param volumes: remove their anonymous volumes too
+        '''
+        if isinstance(container_ids, str):
+            container_ids = [container_ids]
+        container_ids = list(container_ids)
+
+        def cli():
+            cmd = ['docker', 'rm']
+            if force:
+                cmd.append('--force')
+            if volumes:
+                cmd.append('--volumes')
+            subprocess.check_call(cmd + container_ids)
+
+        def api():
+            for container_id in container_ids:
+                self.api.delete(
+                    '/containers/{}'.format(quote_path(container_id)),
+                    params={'force': force or None, 'v': volumes or None})
+
+        return self._dispatch(api, cli)
+
+    def _api_run(self, image, config, cmd):
+        config = dict(config)
+        detach = config.pop('Detach')
+        auto_remove = config['HostConfig'].get('AutoRemove')
+        name = config.pop('Name', None)
+        config['Image'] = image
+        if cmd:
+            config['Cmd'] = cmd
+        params = {'name': name}
+        try:
+            created = self.api.post_json('/containers/create',
+                                         params=params, body=config)
+        except APIError as err:
+            if err.status != 404:
+                raise
+            # Mirror the CLI, which pulls missing images on demand
+            self._api_pull(image)
+            created = self.api.post_json('/containers/create',
+                                         params=params, body=config)
+        container_id = created['Id']
+        path = '/containers/{}'.format(container_id)
+        self.api.post(path + '/start')
+        if detach:
+            return container_id
+        # Attached runs block until the container exits, like the CLI.
+        # Logs are fetched before an auto removed container disappears.
+        logs = self.api.get(path + '/logs',
+                            params={'stdout': True, 'stderr': True,
+                                    'follow': True},
+                            stream=True, timeout=None)
+        output = b''.join(payload for stream, payload in logs.iter_frames()
+                          if stream == STDOUT)
         try:
-            subprocess.check_output(split(cmd))
-        except subprocess.CalledProcessError as expect:
-            print("Error: ", expect.returncode, expect.output)
+            status = self.api.post_json(path + '/wait', timeout=None)
+        except APIError as err:
+            if not (auto_remove and err.status == 404):
+                raise
+            status = {'StatusCode': 0}
+        if status.get('StatusCode'):
+            raise APIError(status['StatusCode'], output.decode('utf-8',
+                                                               'replace'),
+                           'POST', path + '/wait')
+        return output
 
+    @metrics.instrument
+    def events(self, since=None, until=None, filters=None):
+        '''
+        Generator of daemon events, as dicts in the Engine API format:
+        {'Type': 'container', 'Action': 'start', 'Actor': {...},
+        'time': ..., 'timeNano': ...}
+
+        Without `until` the stream follows new events until the generator
+        is closed.
+
+        :param since: replay events since this unix timestamp, datetime,
+            or 'seconds.nanoseconds' string
+        :param until: stop at this unix timestamp or datetime
+        :param filters: dict of event filters, eg: type, event, container
+            or label. Values may be a string or a list of strings.
+        '''
+        since = _unix_time(since)
+        until = _unix_time(until)
+        filters = _filters(filters)
+
+        def cli():
+            cmd = _events_cmd(since, until, filters)
+            lines = _stream_process(cmd, 1048576)
+            return (json.loads(line.text) for line in lines
+                    if line.stream == 'stdout' and line.text.strip())
+
+        def api():
+            params = {'since': since, 'until': until,
+                      'filters': filters or None}
+            resp = self.api.get('/events', params=params, stream=True,
+                                timeout=None)
+            return resp.iter_json()
+
+        return self._dispatch(api, cli)
+
+    @metrics.instrument
+    def inspect(self, container_id):
+        '''
+        Return the low level information on a container, as a dict in the
+        format of `docker inspect`.
+
+        :param container_id: - name or UUID of the container
+        '''
+        def cli():
+            cmd = ['docker', 'inspect', '--type', 'container', container_id]
+            return json.loads(subprocess.check_output(cmd).decode('utf-8'))[0]
+
+        def api():
+            return self.api.get_json(
+                '/containers/{}/json'.format(quote_path(container_id)))
+
+        return self._dispatch(api, cli)
+
+    @metrics.instrument
+    def wait_healthy(self, containers, timeout=60):
+        '''
+        Wait for containers to pass their healthcheck, or merely to run
+        when they have none, following the daemon's start, die and
+        health_status events rather than polling. Returns as soon as every
+        container is settled, or after `timeout` seconds.
+
+        docker.wait_healthy(['web', 'db'], timeout=30)
+        > {'web': HealthResult(container='web', status='healthy',
+                               duration=4.2), ...}
+
+        :param containers: name or ID of a container, or a list of them
+        :param timeout: seconds to wait for the containers
+        :returns: a HealthResult, or for a list a dict of HealthResult
+            keyed by container. Failures are reported in the results
+            rather than raised.
+        '''
+        many = not isinstance(containers, str)
+        names = list(containers) if many else [containers]
+        watch = health.HealthWatch(time.monotonic())
+        # replay events from before the inspect calls, so a container
+        # settling in between is not missed
+        since = time.time()
+        for name in names:
+            try:
+                watch.seed(name, self.inspect(name))
+            except (subprocess.CalledProcessError, APIError):
+                watch.settle(name, 'missing')
+        if watch.pending:
+            events = self.events(
+                since=_event_time(since), until=_event_time(since + timeout),
+                filters={'type': 'container', 'event': health.EVENTS,
+                         'container': list(watch.pending)})
+            try:
+                for event in events:
+                    watch.feed(event)
+                    if not watch.pending:
+                        break
+            finally:
+                events.close()
+        watch.expire()
+        if not many:
+            return watch.results[containers]
+        return dict((name, watch.results[name]) for name in names)
+
+    @metrics.instrument
     def login(self, user, password, email):
         '''
         Docker login exposed as a method.
 
+        Through the API the credentials are verified with the registry and
+        kept on this instance for later pulls. Unlike the CLI, they are
+        not written to the docker client's config file.
+
         :param user:  Username in the registry
         :param password: - Password for the registry
         :param email: - Email address on account (dockerhub)
         '''
-        cmd = ['docker', 'login', '-u', user, '-p', password, '-e', email]
-        subprocess.check_call(cmd)
+        def cli():
+            cmd = ['docker', 'login', '-u', user, '-p', password, '-e', email]
+            subprocess.check_call(cmd)
+
+        def api():
+            auth = {'username': user, 'password': password, 'email': email}
+            self.api.post('/auth', body=auth)
+            self._auth = auth
 
-    def logs(self, container_id, raise_on_failure=False):
+        return self._dispatch(api, cli)
+
+    @metrics.instrument
+    def logs(self, container_id, raise_on_failure=False, stream=False,
+             follow=False, since=None, tail=None, timestamps=False,
+             max_line=65536):
         '''
         Docker logs exposed as a method.
 
+        By default the whole log is read and returned as a string. With
+        `stream` (or `follow`) a generator of LogLine(stream, text) tuples
+        is returned instead, yielding lines as they arrive with stdout and
+        stderr kept apart. Only the current partial line is buffered, so
+        memory is bounded by `max_line` rather than the size of the log.
+
+        for line in docker.logs('web', follow=True, tail=100):
+            if line.stream == 'stderr':
+                hookenv.log(line.text)
+
         :param container_id: - UUID for the container to fetch logs
+        :param stream: - return a generator of LogLine tuples
+        :param follow: - keep streaming new output, implies stream
+        :param since: - only logs after this unix timestamp or datetime
+        :param tail: - only this many lines from the end of the logs
+        :param timestamps: - prefix each line with its RFC3339 timestamp
+        :param max_line: - longest line, in characters, held in memory
+            before it is split
+        '''
+        stream = stream or follow
+        since = _unix_time(since)
+
+        def cli():
+            cmd = ['docker', 'logs']
+            if follow:
+                cmd.append('--follow')
+            if since is not None:
+                cmd.extend(['--since', str(since)])
+            if tail is not None:
+                cmd.extend(['--tail', str(tail)])
+            if timestamps:
+                cmd.append('--timestamps')
+            cmd.append(container_id)
+            if stream:
+                return _stream_process(cmd, max_line)
+            return subprocess.check_output(cmd)
+
+        def api():
+            params = {'stdout': True, 'stderr': True, 'follow': follow or None,
+                      'since': since, 'tail': tail,
+                      'timestamps': timestamps or None}
+            resp = self.api.get(
+                '/containers/{}/logs'.format(quote_path(container_id)),
+                params=params, stream=True,
+                timeout=None if follow else _DEFAULT)
+            if stream:
+                return streams.iter_frames(resp.iter_frames(), max_line)
+            return b''.join(payload for _, payload in resp.iter_frames())
+
+        output = self._dispatch(api, cli)
+        if stream:
+            return output
+        return output.decode('utf-8', 'replace')
+
+    @metrics.instrument
+    def stats(self, containers, size=120):
+        '''
+        Start sampling the resource usage of containers from the daemon's
+        stats stream, about once a second, and return the running
+        charms.docker.stats.StatsSampler. Stop it when done, or use it as a
+        context manager.
+
+        with docker.stats(['web/0', 'web/1']) as sampler:
+            time.sleep(30)
+            busy = sampler.aggregate('web/0', 'cpu_percent').p95 > 80
+
+        :param containers: names or IDs of the containers
+        :param size: number of samples kept per container and metric
         '''
-        cmd = ['docker', 'logs', container_id]
-        output = subprocess.check_output(cmd)
+        from .stats import StatsSampler
+        return StatsSampler(containers, self, size).start()
 
-        return output.decode('ascii', 'ignore')
+    @metrics.instrument
+    def tail_many(self, containers, since=None, tail=None, follow=True,
+                  pattern=None, buffer=1000, delay=0.5, max_line=65536):
+        '''
+        Follow the logs of several containers at once, as a single
+        generator of TaggedLine(container, time, stream, text) tuples in
+        timestamp order. One `docker logs --timestamps` process is started
+        per container when the first line is asked for, and all of them
+        are read on one selector; closing the generator kills them.
+        Errors of `docker logs`, such as an unknown container, arrive as
+        stderr lines of that container.
+
+        for line in docker.tail_many(['web', 'db'], since=started,
+                                     pattern=r'ERROR|WARN'):
+            hookenv.log('{}: {}'.format(line.container, line.text))
 
-    def ps(self):
+        :param containers: names or IDs of the containers
+        :param since: only logs after this unix timestamp or datetime
+        :param tail: only this many lines from the end of each log
+        :param follow: keep streaming new output. Otherwise the generator
+            ends with the logs
+        :param pattern: regex, as str or bytes, that lines must match. It is
+            applied to the raw bytes, so other lines are never decoded
+        :param buffer: most lines buffered per container. A container with
+            a full buffer is not read until the consumer catches up
+        :param delay: most seconds a line is held back, waiting for earlier
+            lines of quieter containers
+        :param max_line: longest line, in bytes, held in memory before it
+            is split
         '''
-        return a string of docker status output
+        cmd = ['docker', 'logs', '--timestamps']
+        if follow:
+            cmd.append('--follow')
+        since = _unix_time(since)
+        if since is not None:
+            cmd.extend(['--since', str(since)])
+        if tail is not None:
+            cmd.extend(['--tail', str(tail)])
+        containers = list(containers)
+
+        def lines():
+            # started here rather than up front, so the finally below
+            # always gets to kill them, even if a later Popen fails
+            procs = {}
+            try:
+                for name in containers:
+                    procs[name] = subprocess.Popen(cmd + [name],
+                                                   stdout=subprocess.PIPE,
+                                                   stderr=subprocess.PIPE)
+                for line in streams.merge_logs(procs, pattern, buffer, delay,
+                                               max_line):
+                    yield line
+            finally:
+                for proc in procs.values():
+                    if proc.poll() is None:
+                        proc.kill()
+                    proc.wait()
+                    proc.stdout.close()
+                    proc.stderr.close()
+
+        return lines()
+
+    @metrics.instrument
+    def ps(self, all=False, filters=None, limit=None, quiet=False,
+           count=False):
         '''
-        cmd = ['docker', 'ps']
-        return subprocess.check_output(cmd)
+        List containers as Container records. Filtering and limiting is
+        done by the daemon, so only matching rows are sent back.
+
+        docker.ps(filters={'label': 'juju-unit=web/0', 'status': 'running'})
+        > [Container(id='6f137adb5d27...', name='web', ...)]
+
+        :param all: include stopped containers
+        :param filters: dict of daemon side filters, eg: label, name, status
+            or ancestor. Values may be a string or a list of strings.
+        :param limit: only the `limit` most recently created containers,
+            in any state
+        :param quiet: return only the list of container IDs
+        :param count: return only the number of matching containers
+        '''
+        filters = _filters(filters)
+
+        def cli():
+            cmd = _ps_cmd(all, filters, limit, quiet or count)
+            return _parse_ps(subprocess.check_output(cmd), quiet, count)
+
+        def api():
+            params = {'all': all or None, 'limit': limit,
+                      'filters': filters or None}
+            rows = self.api.get_json('/containers/json', params=params)
+            if count:
+                return len(rows)
+            if quiet:
+                return [row['Id'] for row in rows]
+            return [Container.from_api(row) for row in rows]
+
+        return self._dispatch(api, cli)
 
-    def pull(self, image):
+    @metrics.instrument
+    def pull(self, image, on_progress=None, stall_timeout=None):
         '''
         Pull an image from the docker hub
+
+        With `on_progress`, the pull is reported layer by layer as it
+        happens instead of its output being collected, and None is
+        returned. The API backend reports bytes transferred, the CLI only
+        the status changes of each layer.
+
+        docker.pull('nginx', on_progress=lambda p: hookenv.status_set(
+            'maintenance', '{} {}'.format(p.id, p.status)),
+            stall_timeout=120)
+
+        :param on_progress: called with a charms.docker.progress.Progress
+            for every progress message
+        :param stall_timeout: seconds without progress before the pull is
+            abandoned and charms.docker.progress.StalledError raised
+        '''
+        def cli():
+            cmd = ['docker', 'pull', image]
+            if on_progress is None and stall_timeout is None:
+                return subprocess.check_output(cmd)
+            callback = None
+            if on_progress is not None:
+                def callback(line):
+                    if line.strip():
+                        on_progress(progress.pull_line(line))
+            output = get_executor().run(cmd, on_stdout=callback,
+                                        idle_timeout=stall_timeout,
+                                        capture=on_progress is None)
+            return None if on_progress is not None else output
+
+        return self._dispatch(
+            lambda: self._api_pull(image, on_progress, stall_timeout), cli)
+
+    @metrics.instrument
+    def pull_many(self, images, parallelism=4):
         '''
-        cmd = ['docker', 'pull', image]
-        return subprocess.check_output(cmd)
+        Pull several images concurrently, at most `parallelism` at a time.
+        References are deduplicated, with an untagged reference being the
+        same as :latest, and references pinned by digest
+        (repo@sha256:...) are skipped when the image is already present
+        locally with that digest. Failures are collected rather than
+        raised.
+
+        docker.pull_many(['redis:3', 'nginx@sha256:4f2d...', 'redis:3'])
+        > {'redis:3': PullResult(image='redis:3', skipped=False, ...),
+           'nginx@sha256:4f2d...': PullResult(..., skipped=True, ...)}
+
+        :param images: iterable of image references
+        :param parallelism: number of concurrent pulls
+        :returns: dict of image reference to PullResult, in the order given
+        '''
+        if parallelism < 1:
+            raise ValueError("parallelism must be at least 1")
+        images = list(images)
+        wanted = {}
+        for image in images:
+            wanted.setdefault(_normalize_image(image), image)
+        if not wanted:
+            return {}
+
+        def one(image):
+            started = time.monotonic()
+            try:
+                if self._has_digest(image):
+                    return PullResult(image, True,
+                                      time.monotonic() - started, None, None)
+                output = self.pull(image)
+            except (subprocess.CalledProcessError, APIError, OSError,
+                    HTTPException) as err:
+                return PullResult(image, False, time.monotonic() - started,
+                                  None, err)
+            return PullResult(image, False, time.monotonic() - started,
+                              output, None)
+
+        workers = min(parallelism, len(wanted))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(one, wanted.values()))
+        by_ref = dict(zip(wanted, results))
+        return dict((image, by_ref[_normalize_image(image)])
+                    for image in images)
+
+    def _has_digest(self, image):
+        '''
+        True if `image` is pinned by digest and present locally with it.
+        '''
+        if '@' not in image:
+            return False
+        digest = _split_image(image)[1]
+
+        def cli():
+            cmd = ['docker', 'inspect', '--type', 'image', '--format',
+                   '{{json .RepoDigests}}', image]
+            try:
+                output = subprocess.check_output(cmd,
+                                                 stderr=subprocess.DEVNULL)
+            except subprocess.CalledProcessError:
+                return []
+            return json.loads(output.decode('utf-8')) or []
+
+        def api():
+            try:
+                info = self.api.get_json(
+                    '/images/{}/json'.format(quote_path(image)))
+            except APIError as err:
+                if err.status == 404:
+                    return []
+                raise
+            return info.get('RepoDigests') or []
+
+        return any(ref.partition('@')[2] == digest
+                   for ref in self._dispatch(api, cli))
+
+    def _api_pull(self, image, on_progress=None, stall_timeout=None):
+        repo, tag = _split_image(image)
+        headers = {}
+        if self._auth:
+            encoded = json.dumps(self._auth).encode('utf-8')
+            headers['X-Registry-Auth'] = \
+                base64.urlsafe_b64encode(encoded).decode('ascii')
+        output = []
+        try:
+            resp = self.api.post('/images/create',
+                                 params={'fromImage': repo, 'tag': tag},
+                                 headers=headers, stream=True,
+                                 timeout=stall_timeout)
+            for message in resp.iter_json():
+                if 'error' in message:
+                    raise APIError(500, message['error'], 'POST',
+                                   '/images/create')
+                if on_progress is not None:
+                    on_progress(progress.pull_message(message))
+                else:
+                    output.append(json.dumps(message).encode('utf-8'))
+        except (socket.timeout, TimeoutError) as err:
+            if stall_timeout is None:
+                raise
+            raise StalledError('docker pull {}'.format(image),
+                               stall_timeout) from err
+        if on_progress is not None:
+            return None
+        return b'\n'.join(output)
+
+
+def _stream_process(cmd, max_line):
+    '''
+    Return a generator of the output of `cmd` as LogLine tuples. The
+    process starts with the first line asked for, so a generator that is
+    never consumed leaves nothing behind, and closing it early kills the
+    process.
+    '''
+    def lines():
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        done = False
+        try:
+            for line in streams.iter_pipes(proc, max_line):
+                yield line
+            done = True
+        finally:
+            if not done and proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    return lines()
+
+
+def _events_cmd(since, until, filters):
+    cmd = ['docker', 'events', '--format', '{{json .}}']
+    if since is not None:
+        cmd.extend(['--since', str(since)])
+    if until is not None:
+        cmd.extend(['--until', str(until)])
+    for key, values in filters.items():
+        for value in values:
+            cmd.extend(['--filter', '{}={}'.format(key, value)])
+    return cmd
+
+
+def _event_time(value):
+    # the seconds.nanoseconds form, finer than the whole seconds of
+    # _unix_time
+    return '{:.9f}'.format(value)
+
+
+def _ps_cmd(all, filters, limit, quiet):
+    cmd = ['docker', 'ps', '--no-trunc']
+    if all:
+        cmd.append('--all')
+    for key, values in filters.items():
+        for value in values:
+            cmd.extend(['--filter', '{}={}'.format(key, value)])
+    if limit is not None:
+        cmd.extend(['--last', str(limit)])
+    if quiet:
+        cmd.append('--quiet')
+    else:
+        cmd.extend(['--format', '{{json .}}'])
+    return cmd
+
+
+def _parse_ps(output, quiet, count):
+    output = output.decode('utf-8')
+    if quiet or count:
+        ids = output.split()
+        return len(ids) if count else ids
+    return [Container.from_cli(json.loads(line))
+            for line in output.splitlines() if line.strip()]
+
+
+def _filters(filters):
+    '''
+    Normalise a filters dict to the {key: [values]} form the daemon
+    expects.
+    '''
+    normalised = {}
+    for key, values in (filters or {}).items():
+        if isinstance(values, str):
+            values = [values]
+        normalised[key] = list(values)
+    return normalised
+
+
+def _unix_time(value):
+    '''
+    Normalise a datetime or number to integer seconds since the epoch.
+    Strings are passed through untouched, for the seconds.nanoseconds form
+    the daemon also accepts.
+    '''
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp())
+    return int(value)
+
+
+def _run_cmd(image, options, command, args):
+    '''
+    Build the argv for `docker run` from the space joined options,
+    command and args strings.
+    '''
+    cmd = "docker run {0} {1} {2} {3}".format(options, image, command, args)
+    return split(cmd)
+
+
+def _normalize_image(image):
+    repo, tag = _split_image(image)
+    return '{}{}{}'.format(repo, '@' if '@' in image else ':', tag)
+
+
+def _split_image(image):
+    '''
+    Split an image reference into the repository and tag (or digest)
+    parts, taking care of registries with a port such as
+    localhost:5000/app.
+
+    _split_image('localhost:5000/app')
+    > ('localhost:5000/app', 'latest')
+    '''
+    if '@' in image:
+        repo, digest = image.split('@', 1)
+        return repo, digest
+    slash = image.rfind('/')
+    colon = image.rfind(':')
+    if colon > slash:
+        return image[:colon], image[colon + 1:]
+    return image, 'latest'
+
+
+# docker run flags which take a value, mapped to the name used below
+_RUN_VALUE_OPTS = {
+    '--name': 'name', '-e': 'env', '--env': 'env', '-l': 'label',
+    '--label': 'label', '-v': 'volume', '--volume': 'volume',
+    '-p': 'publish', '--publish': 'publish', '--restart': 'restart',
+    '--net': 'network', '--network': 'network', '-w': 'workdir',
+    '--workdir': 'workdir', '-u': 'user', '--user': 'user',
+    '--entrypoint': 'entrypoint', '-h': 'hostname', '--hostname': 'hostname',
+}
+
+_RUN_FLAGS = {
+    '-d': 'detach', '--detach': 'detach', '--rm': 'rm',
+    '--privileged': 'privileged', '-t': 'tty', '--tty': 'tty',
+    '-i': 'interactive', '--interactive': 'interactive',
+}
+
+
+def _run_config(tokens):
+    '''
+    Translate tokenized `docker run` options into an Engine API container
+    config. Returns None if an option is not understood, so the caller can
+    defer to the CLI.
+    '''
+    config = {'Detach': False, 'Env': [], 'Labels': {}, 'HostConfig': {}}
+    host = config['HostConfig']
+    tokens = list(tokens)
+    while tokens:
+        token = tokens.pop(0)
+        value = None
+        if token.startswith('--') and '=' in token:
+            token, value = token.split('=', 1)
+        if token in _RUN_FLAGS:
+            if value is not None and value not in ('true', 'false'):
+                return None
+            enabled = value != 'false'
+            flag = _RUN_FLAGS[token]
+            if flag == 'detach':
+                config['Detach'] = enabled
+            elif flag == 'rm':
+                host['AutoRemove'] = enabled
+            elif flag == 'privileged':
+                host['Privileged'] = enabled
+            elif flag == 'tty':
+                config['Tty'] = enabled
+            elif flag == 'interactive':
+                config['OpenStdin'] = enabled
+            continue
+        if token not in _RUN_VALUE_OPTS:
+            return None
+        if value is None:
+            if not tokens:
+                return None
+            value = tokens.pop(0)
+        opt = _RUN_VALUE_OPTS[token]
+        if opt == 'name':
+            config['Name'] = value
+        elif opt == 'env':
+            config['Env'].append(value)
+        elif opt == 'label':
+            key, _, val = value.partition('=')
+            config['Labels'][key] = val
+        elif opt == 'volume':
+            host.setdefault('Binds', []).append(value)
+        elif opt == 'publish':
+            if not _publish(config, value):
+                return None
+        elif opt == 'restart':
+            name, _, retries = value.partition(':')
+            policy = {'Name': name}
+            if retries:
+                policy['MaximumRetryCount'] = int(retries)
+            host['RestartPolicy'] = policy
+        elif opt == 'network':
+            host['NetworkMode'] = value
+        elif opt == 'workdir':
+            config['WorkingDir'] = value
+        elif opt == 'user':
+            config['User'] = value
+        elif opt == 'entrypoint':
+            config['Entrypoint'] = split(value)
+        elif opt == 'hostname':
+            config['Hostname'] = value
+    return config
+
+
+def _publish(config, value):
+    '''
+    Add a -p mapping of the form [ip:][host_port:]container_port[/proto].
+    Returns False, adding nothing, for port ranges, IPv6 addresses and
+    anything else the CLI expands for us.
+    '''
+    value, _, proto = value.partition('/')
+    parts = value.split(':')
+    if len(parts) > 3 or proto not in ('', 'tcp', 'udp', 'sctp') or \
+            not parts[-1].isdigit() or \
+            (len(parts) > 1 and parts[-2] and not parts[-2].isdigit()) or \
+            (len(parts) == 3 and not parts[0]):
+        return False
+    container_port = '{}/{}'.format(parts[-1], proto or 'tcp')
+    binding = {}
+    if len(parts) == 3:
+        binding = {'HostIp': parts[0], 'HostPort': parts[1]}
+    elif len(parts) == 2:
+        binding = {'HostPort': parts[0]}
+    config.setdefault('ExposedPorts', {})[container_port] = {}
+    bindings = config['HostConfig'].setdefault('PortBindings', {})
+    bindings.setdefault(container_port, []).append(binding)
+    return True
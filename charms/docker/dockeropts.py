@@ -1,6 +1,89 @@
+import copy
+import hashlib
+import os
+import re
+import tempfile
+
+from collections import namedtuple
+from contextlib import contextmanager
+
 from charmhelpers.core import unitdata
 
 
+class RenderResult(namedtuple('RenderResult', ['changed', 'added', 'removed',
+                                               'modified', 'fingerprint'])):
+    '''
+    Outcome of DockerOpts.render.
+
+    :param changed: True if the defaults file was rewritten
+    :param added: sorted list of flags that were not set before
+    :param removed: sorted list of flags that are no longer set
+    :param modified: sorted list of flags whose values changed
+    :param fingerprint: sha256 of the rendered flags
+    '''
+    __slots__ = ()
+
+    @property
+    def restart_needed(self):
+        '''
+        True when the daemon's effective flags differ from what the file
+        held before. A rewrite that only reorders flags does not count.
+        '''
+        return bool(self.added or self.removed or self.modified)
+
+
+class _Option:
+    '''
+    A single daemon flag: an ordered set of values (a dict with None
+    values, for O(1) add, remove and contains), an optional strict value
+    rendered verbatim, or neither for a flag only option.
+    '''
+    __slots__ = ('values', 'strict')
+
+    def __init__(self, values=None, strict=None):
+        self.values = dict.fromkeys(values) if values is not None else None
+        self.strict = strict
+
+    @property
+    def flag(self):
+        return self.values is None
+
+    def dump(self):
+        values = list(self.values) if self.values is not None else None
+        return {'values': values, 'strict': self.strict}
+
+    @classmethod
+    def load(cls, raw):
+        return cls(raw.get('values'), raw.get('strict'))
+
+
+class _ReadOnly:
+    # mutating methods of the dict and lists handed out by DockerOpts.data
+
+    def _refuse(self, *args, **kwargs):
+        raise TypeError("DockerOpts.data is read-only, use add() and "
+                        "remove(), or assign a whole dict to data")
+
+
+class _ReadOnlyDict(_ReadOnly, dict):
+    __setitem__ = __delitem__ = __ior__ = _ReadOnly._refuse
+    clear = pop = popitem = setdefault = update = _ReadOnly._refuse
+
+
+class _ReadOnlyList(_ReadOnly, list):
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _ReadOnly._refuse
+    append = clear = extend = insert = pop = remove = _ReadOnly._refuse
+    reverse = sort = _ReadOnly._refuse
+
+
+# Version of the docker_opts record written to the unit's data store
+_FORMAT = 2
+
+
+def _split_values(value):
+    return [x.strip() for x in value.split(',')]
+
+
 class DockerOpts:
     '''
     DockerOptsManager - A Python class for managing the DEFAULT docker
@@ -11,22 +94,126 @@ class DockerOpts:
 
     THe underlying data-provider is backed by a SQLITE database on each unit,
     tracking the dictionary, provided from the 'charmhelpers' python package.
+    Records written by older releases, which kept strict values under a
+    `<key>-strict` entry, are migrated when they are loaded.
 
     Summary:
     opts = DockerOpts()
     opts.add('bip', '192.168.22.2')
     opts.to_s()
+
+    Many changes can be batched into a single write:
+    with opts.transaction():
+        opts.add('label', 'foo')
+        opts.remove('label', 'bar')
     '''
 
     def __init__(self, opts_path=None):
         self.db = unitdata.kv()
-        if not self.db.get('docker_opts'):
-            self.data = {}
-        else:
-            self.data = self.db.get('docker_opts')
+        self._depth = 0
+        self._dirty = False
+        self._opts = {}
+        stored = self.db.get('docker_opts')
+        if isinstance(stored, dict) and stored.get('version') == _FORMAT:
+            for key, raw in stored['opts'].items():
+                self._opts[key] = _Option.load(raw)
+        elif stored:
+            self.data = stored
+            self.__save()
 
     def __save(self):
-        self.db.set('docker_opts', self.data)
+        if self._depth:
+            # defer to the end of the outermost transaction
+            self._dirty = True
+            return
+        opts = dict((k, o.dump()) for k, o in self._opts.items())
+        self.db.set('docker_opts', {'version': _FORMAT, 'opts': opts})
+
+    @property
+    def data(self):
+        '''
+        The options in the original dictionary layout: a list of values
+        per key, None for flag only options, and strict values under
+        `<key>-strict`.
+
+        Unlike in older releases this is a read-only snapshot, as the
+        options are no longer kept in this layout: changing it in place
+        raises TypeError rather than being silently lost. Use add() and
+        remove(), or assign a dict in that layout to replace every option.
+        '''
+        data = {}
+        for key, opt in self._opts.items():
+            if opt.flag:
+                data[key] = None
+            elif opt.values:
+                data[key] = _ReadOnlyList(opt.values)
+            if opt.strict is not None:
+                data['{}-strict'.format(key)] = opt.strict
+        return _ReadOnlyDict(data)
+
+    @data.setter
+    def data(self, data):
+        opts = {}
+        strict = {}
+        for key, value in data.items():
+            # Strict values were the only plain strings in this layout
+            if key.endswith('-strict') and isinstance(value, str):
+                strict[key[:-len('-strict')]] = value
+            else:
+                opts[key] = _Option(value)
+        for key, value in strict.items():
+            opt = opts.setdefault(key, _Option([]))
+            opt.strict = value
+            # add(strict=True) used to store the split values as well
+            if opt.values is not None and \
+                    list(opt.values) == _split_values(value):
+                opt.values = {}
+        self._opts = opts
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Apply any number of adds and removes in memory and write them to
+        the unit's data store once, when the block exits. If the block
+        raises, the options are rolled back to where they were when it was
+        entered. Transactions may be nested; only the outermost one writes.
+
+        with opts.transaction():
+            opts.add('insecure-registry', 'a:5000')
+            opts.add('insecure-registry', 'b:5000')
+        '''
+        snapshot = copy.deepcopy(self._opts)
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._opts = snapshot
+            self._depth -= 1
+            if not self._depth:
+                self._dirty = False
+            raise
+        self._depth -= 1
+        if not self._depth and self._dirty:
+            self._dirty = False
+            self.__save()
+
+    batch = transaction
+
+    def add_many(self, items):
+        '''
+        Add several options with a single write. Accepts a dict of key to
+        value, or an iterable of (key, value) or (key, value, strict)
+        tuples.
+
+        opts.add_many({'bip': '192.168.22.2', 'tlsverify': None})
+        opts.add_many([('label', 'foo'), ('cluster-store', 'consul://a',
+                                          True)])
+        '''
+        if isinstance(items, dict):
+            items = items.items()
+        with self.transaction():
+            for item in items:
+                self.add(*item)
 
     def add(self, key, value, strict=False):
         '''
@@ -41,28 +228,30 @@ class DockerOpts:
         opts.add('flagonly', None)
         opts.add('cluster-store', 'consul://a:4001,b:4001,c:4001/swarm', strict=True)
         '''
-        if strict:
-            self.data['{}-strict'.format(key)] = value
-
-        if value:
-            values = [x.strip() for x in value.split(',')]
-            # handle updates
-            if key in self.data and self.data[key] is not None:
-                item_data = self.data[key]
-                for c in values:
-                    c = c.strip()
-                    if c not in item_data:
-                        item_data.append(c)
-                self.data[key] = item_data
-            else:
+        opt = self._opts.get(key)
+        if strict and value:
+            # handle strict values, rendered exactly as given
+            if opt is None:
+                opt = self._opts[key] = _Option([])
+            opt.strict = value
+        elif value:
+            if opt is None:
                 # handle new
-                self.data[key] = values
+                opt = self._opts[key] = _Option([])
+            elif opt.flag:
+                opt.values = {}
+            # handle updates, the dict keeps insertion order and ignores
+            # values that are already present
+            for c in _split_values(value):
+                opt.values[c] = None
         else:
             # handle flagonly
-            self.data[key] = None
+            if opt is None:
+                opt = self._opts[key] = _Option()
+            opt.values = None
         self.__save()
 
-    def remove(self, key, value):
+    def remove(self, key, value=None):
         '''
         Remove a flag value from the DockerOpts manager
         Assuming the data is currently {'foo': ['bar', 'baz']}
@@ -70,12 +259,45 @@ class DockerOpts:
         d.remove('foo', 'bar')
         > {'foo': ['baz']}
 
+        Removing a value that is not set is a no-op. Without a value, the
+        whole flag is removed.
+
         :params key:
         :params value:
         '''
-        self.data[key].remove(value)
+        opt = self._opts.get(key)
+        if opt is None:
+            return
+        if value is None:
+            del self._opts[key]
+        else:
+            if opt.values:
+                opt.values.pop(value, None)
+            if opt.strict == value:
+                opt.strict = None
+            if not opt.values and opt.values is not None and \
+                    opt.strict is None:
+                del self._opts[key]
         self.__save()
 
+    def contains(self, key, value=None):
+        '''
+        Predicate for a flag being set, or having a particular value.
+
+        d.contains('foo', 'bar')
+        > True
+        '''
+        opt = self._opts.get(key)
+        if opt is None:
+            return False
+        if value is None:
+            return True
+        return (opt.values is not None and value in opt.values) or \
+            opt.strict == value
+
+    def __contains__(self, key):
+        return key in self._opts
+
     def to_s(self):
         '''
         Render the flags to a single string, prepared for the Docker
@@ -85,16 +307,112 @@ class DockerOpts:
         > "--foo=bar --foo=baz"
         '''
         flags = []
-        for key in self.data:
-            if self.data[key] == None:
+        for key, opt in self._opts.items():
+            if opt.flag:
                 # handle flagonly
                 flags.append("--{}".format(key))
-            elif '-strict' in key:
-                # handle strict values
-                proper_key = key.rstrip('-strict')
-                flags.append("--{}={}".format(proper_key, self.data[key]))
             else:
                 # handle multiopt and typical flags
-                for item in self.data[key]:
+                for item in opt.values:
                     flags.append("--{}={}".format(key, item))
+            if opt.strict is not None:
+                # handle strict values
+                flags.append("--{}={}".format(key, opt.strict))
         return ' '.join(flags)
+
+    def render(self, path='/etc/default/docker', variable='DOCKER_OPTS'):
+        '''
+        Write the flags into the `variable=` line of the Docker defaults
+        file, leaving the rest of the file alone. The file is replaced
+        atomically, and only when its content would change. The returned
+        RenderResult lists which flags changed, so the daemon is only
+        restarted when it has to be:
+
+        result = opts.render()
+        if result.restart_needed:
+            host.service_restart('docker')
+
+        :param path: the defaults file. default: /etc/default/docker
+        :param variable: the shell variable holding the daemon flags
+        '''
+        flags = self.to_s()
+        line = '{}="{}"'.format(variable, _shell_quote(flags))
+        pattern = re.compile(r'^\s*(?:export\s+)?{}=(.*)$'.format(
+            re.escape(variable)))
+
+        try:
+            with open(path) as f:
+                original = f.read()
+        except FileNotFoundError:
+            original = None
+
+        lines = (original or '').splitlines()
+        previous = ''
+        for i, current in enumerate(lines):
+            match = pattern.match(current)
+            if match:
+                previous = _shell_unquote(match.group(1).strip())
+                lines[i] = line
+                break
+        else:
+            lines.append(line)
+        content = '\n'.join(lines) + '\n'
+
+        old, new = _flag_map(previous), _flag_map(flags)
+        added = sorted(set(new) - set(old))
+        removed = sorted(set(old) - set(new))
+        modified = sorted(k for k in set(old) & set(new) if old[k] != new[k])
+        fingerprint = hashlib.sha256(flags.encode('utf-8')).hexdigest()
+
+        changed = content != original
+        if changed:
+            _atomic_write(path, content)
+        return RenderResult(changed, added, removed, modified, fingerprint)
+
+
+def _flag_map(flags):
+    '''
+    Map a rendered flags string to {key: sorted values}, so that two
+    renderings can be compared regardless of flag order. Flags are split
+    on the `--` that starts each one, as values may contain spaces.
+    '''
+    found = {}
+    for flag in re.split(r'(?:^|\s+)--(?=\S)', flags):
+        if not flag.strip():
+            continue
+        key, sep, value = flag.partition('=')
+        found.setdefault(key, []).append(value if sep else None)
+    return dict((k, sorted(v, key=str)) for k, v in found.items())
+
+
+def _shell_quote(value):
+    # escape for the inside of a double quoted shell string
+    return re.sub(r'([\\"$`])', r'\\\1', value)
+
+
+def _shell_unquote(value):
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        return re.sub(r'\\([\\"$`])', r'\1', value[1:-1])
+    if len(value) > 1 and value[0] == value[-1] == "'":
+        return value[1:-1]
+    return value
+
+
+def _atomic_write(path, content):
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.docker-opts-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
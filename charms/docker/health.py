@@ -0,0 +1,97 @@
+import time
+
+from collections import namedtuple
+
+
+# event actions that can settle a container, for daemon side filtering
+EVENTS = ['start', 'die', 'health_status']
+
+
+class HealthResult(namedtuple('HealthResult', ['container', 'status',
+                                               'duration'])):
+    '''
+    Outcome of waiting for a single container with Docker.wait_healthy.
+
+    :param container: the name or ID the container was given as
+    :param status: 'healthy', or 'running' for a container without a
+        healthcheck, when it got there. Otherwise 'unhealthy', 'died',
+        'missing' when it could not be inspected, or 'timeout'
+    :param duration: seconds from the start of the wait until the status
+        was reached
+    '''
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.status in ('healthy', 'running')
+
+
+class HealthWatch:
+    '''
+    Follows containers on their way to healthy: first from their inspect
+    output, then from the daemon's container events. Shared by the
+    blocking and asyncio flavours of wait_healthy, which only differ in
+    how they read the events.
+
+    :param started: time.monotonic() at the start of the wait
+    '''
+
+    def __init__(self, started):
+        self.started = started
+        self.results = {}
+        # full container ID: (name or ID as given, has a healthcheck)
+        self.pending = {}
+
+    def seed(self, container, obj):
+        '''
+        Settle `container` from its `docker inspect` output if it already
+        is healthy or has already failed, else watch it for events.
+        '''
+        state = obj.get('State') or {}
+        test = ((obj.get('Config') or {}).get('Healthcheck') or {}).get('Test')
+        checked = bool(test) and test[0] != 'NONE'
+        health = (state.get('Health') or {}).get('Status')
+        if state.get('Dead') or state.get('Status') == 'exited':
+            self.settle(container, 'died')
+        elif checked and health in ('healthy', 'unhealthy'):
+            self.settle(container, health)
+        elif not checked and state.get('Running'):
+            self.settle(container, 'running')
+        else:
+            self.pending[obj['Id']] = (container, checked)
+
+    def feed(self, event):
+        '''
+        Settle the container a daemon event is about, if it does.
+        '''
+        actor = event.get('Actor') or {}
+        watched = self.pending.get(actor.get('ID') or event.get('id'))
+        if watched is None:
+            return
+        container, checked = watched
+        # eg: health_status: healthy
+        action, _, health = (event.get('Action') or '').partition(':')
+        if action == 'die':
+            self.settle(container, 'died')
+        elif action == 'health_status' and health.strip() in ('healthy',
+                                                               'unhealthy'):
+            self.settle(container, health.strip())
+        elif action == 'start' and not checked:
+            self.settle(container, 'running')
+
+    def expire(self):
+        '''
+        Settle the containers still pending as timed out.
+        '''
+        for container, _ in list(self.pending.values()):
+            self.settle(container, 'timeout')
+
+    def settle(self, container, status):
+        '''
+        Record `status` as the outcome for `container` and stop watching it.
+        '''
+        self.results[container] = HealthResult(
+            container, status, time.monotonic() - self.started)
+        for cid, (name, _) in list(self.pending.items()):
+            if name == container:
+                del self.pending[cid]
@@ -0,0 +1,306 @@
+import hashlib
+import json
+import os
+import re
+import stat
+
+
+# Always sent to the daemon, whatever .dockerignore says
+_ALWAYS_INCLUDED = ('Dockerfile', '.dockerignore')
+
+
+class DockerIgnore:
+    '''
+    Matcher for .dockerignore patterns, following the rules of the docker
+    client: patterns are matched against slash separated paths relative to
+    the build context, `*` and `?` do not cross a slash, `**` matches any
+    number of directories, a pattern matching a directory excludes all of
+    its contents, and the last matching pattern wins, so `!pattern`
+    re-includes files excluded earlier.
+
+    ignore = DockerIgnore(['*.pyc', 'build', '!build/keep'])
+    ignore.matches('build/out.o')
+    > True
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            exclusion = pattern.startswith('!')
+            if exclusion:
+                pattern = pattern[1:].strip()
+            pattern = os.path.normpath(pattern).lstrip('/')
+            if pattern in ('', '.'):
+                continue
+            self.patterns.append((_translate(pattern), pattern.count('/') + 1,
+                                  exclusion))
+
+    @classmethod
+    def load(cls, context):
+        '''
+        Read the .dockerignore at the root of a build context, if any.
+        '''
+        try:
+            with open(os.path.join(context, '.dockerignore')) as f:
+                return cls(f.read().splitlines())
+        except FileNotFoundError:
+            return cls([])
+
+    @property
+    def has_exceptions(self):
+        return any(exclusion for _, _, exclusion in self.patterns)
+
+    def matches(self, path):
+        '''
+        True if the slash separated relative `path` is excluded from the
+        build context.
+        '''
+        parts = path.split('/')
+        matched = False
+        for regex, depth, exclusion in self.patterns:
+            match = regex.match(path)
+            if not match and len(parts) > depth:
+                # the pattern may match one of the parent directories
+                match = regex.match('/'.join(parts[:depth]))
+            if match:
+                matched = not exclusion
+        return matched
+
+
+def _translate(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            i += 2
+            if pattern.startswith('/', i):
+                # **/ matches zero or more directories
+                i += 1
+                regex += '(?:.*/)?'
+            else:
+                regex += '.*'
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('^') or body.startswith('!'):
+                    body = '^' + body[1:]
+                regex += '[{}]'.format(body.replace('\\', '\\\\'))
+                i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile('^{}$'.format(regex))
+
+
+def fingerprint(context, cache=None, ignore=None):
+    '''
+    Merkle hash of a docker build context. Each file is hashed by content
+    and executable bit, and each directory by the sorted names and hashes
+    of its children, so any change to what would be sent to the daemon
+    changes the result. Files excluded by .dockerignore do not count.
+
+    Hashing is incremental: `cache` maps relative paths to
+    [mtime_ns, size, digest], and files whose mtime and size are unchanged
+    are not read again. The cache is updated in place, and entries for
+    files that are gone are dropped.
+
+    fingerprint('files/web')
+    > 'a3f1...'
+
+    :param context: path to the build context directory
+    :param cache: dict of previously seen file digests
+    :param ignore: DockerIgnore to apply, default: the context's own
+    '''
+    if cache is None:
+        cache = {}
+    if ignore is None:
+        ignore = DockerIgnore.load(context)
+    seen = set()
+    digest = _hash_dir(context, '', ignore, cache, seen,
+                       prune=not ignore.has_exceptions)
+    for stale in set(cache) - seen:
+        del cache[stale]
+    return digest
+
+
+def _hash_dir(root, rel, ignore, cache, seen, prune):
+    entries = []
+    try:
+        names = sorted(os.listdir(os.path.join(root, rel)))
+    except FileNotFoundError:
+        return None
+    for name in names:
+        path = '{}/{}'.format(rel, name) if rel else name
+        full = os.path.join(root, path)
+        try:
+            st = os.lstat(full)
+        except FileNotFoundError:
+            continue
+        excluded = ignore.matches(path) and path not in _ALWAYS_INCLUDED
+        if stat.S_ISDIR(st.st_mode):
+            if excluded and prune:
+                continue
+            child = _hash_dir(root, path, ignore, cache, seen, prune)
+            if child is not None and (not excluded or child != _EMPTY):
+                entries.append('d {} {}'.format(name, child))
+            continue
+        if excluded:
+            continue
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(full).encode('utf-8', 'surrogateescape')
+            entries.append('l {} {}'.format(
+                name, hashlib.sha256(target).hexdigest()))
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        seen.add(path)
+        cached = cache.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            digest = cached[2]
+        else:
+            digest = _hash_file(full)
+            cache[path] = [st.st_mtime_ns, st.st_size, digest]
+        kind = 'x' if st.st_mode & 0o111 else 'f'
+        entries.append('{} {} {}'.format(kind, name, digest))
+    return hashlib.sha256('\n'.join(entries).encode(
+        'utf-8', 'surrogateescape')).hexdigest()
+
+
+_EMPTY = hashlib.sha256(b'').hexdigest()
+
+
+def _hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class BuildManifest:
+    '''
+    Fingerprints of each service's build inputs as of its last successful
+    build, persisted in the unit's data store between hook runs. A
+    service's fingerprint covers the hash of its build context and its
+    build configuration (dockerfile, args, target).
+
+    manifest = BuildManifest('files/workspace')
+    changed = manifest.changed({'web': {'context': 'web'}})
+    ... build the changed services ...
+    manifest.commit(changed)
+
+    :param workspace: the compose workspace the build contexts are relative
+        to
+    :param db: key/value store, default: charmhelpers' unitdata.kv()
+    '''
+    KEY = 'docker_build_manifest'
+
+    def __init__(self, workspace, db=None):
+        if db is None:
+            from charmhelpers.core import unitdata
+            db = unitdata.kv()
+        self.db = db
+        self.workspace = os.path.abspath(str(workspace))
+        stored = self.db.get(self.KEY) or {}
+        self.entries = stored.get(self.workspace) or {}
+        self._pending = {}
+
+    def fingerprint(self, service, build):
+        '''
+        Fingerprint the build inputs of `service`, reusing the file digests
+        from its last recorded build where the files are untouched.
+
+        :param build: the service's `build` entry from the compose file,
+            either the context path or a dict with context, dockerfile,
+            args and so on
+        '''
+        if isinstance(build, str):
+            build = {'context': build}
+        context = os.path.join(self.workspace, build.get('context') or '.')
+        files = dict((self.entries.get(service) or {}).get('files') or {})
+        config = dict(build, context=fingerprint(context, files))
+        digest = hashlib.sha256(json.dumps(
+            config, sort_keys=True).encode('utf-8')).hexdigest()
+        self._pending[service] = {'fingerprint': digest, 'files': files}
+        return digest
+
+    def changed(self, services):
+        '''
+        Return the names of the services whose build inputs differ from
+        their last recorded build, or that have never been recorded.
+
+        :param services: dict of service name to `build` entry
+        '''
+        changed = []
+        for service, build in services.items():
+            digest = self.fingerprint(service, build)
+            recorded = self.entries.get(service) or {}
+            if recorded.get('fingerprint') != digest:
+                changed.append(service)
+        return changed
+
+    def commit(self, services):
+        '''
+        Record the fingerprints taken for `services` as built.
+        '''
+        for service in services:
+            if service in self._pending:
+                self.entries[service] = self._pending.pop(service)
+        stored = self.db.get(self.KEY) or {}
+        stored[self.workspace] = self.entries
+        self.db.set(self.KEY, stored)
+
+
+def config_hash(config):
+    '''
+    sha256 of a service definition from the compose file, independent of
+    key order.
+    '''
+    return hashlib.sha256(json.dumps(
+        config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class AppliedState:
+    '''
+    Config hashes of the compose services as of the last successful
+    Compose.up(changed_only=True), persisted in the unit's data store
+    between hook runs.
+
+    :param workspace: the compose workspace
+    :param db: key/value store, default: charmhelpers' unitdata.kv()
+    '''
+    KEY = 'docker_compose_applied'
+
+    def __init__(self, workspace, db=None):
+        if db is None:
+            from charmhelpers.core import unitdata
+            db = unitdata.kv()
+        self.db = db
+        self.workspace = os.path.abspath(str(workspace))
+        stored = self.db.get(self.KEY) or {}
+        self.services = dict(stored.get(self.workspace) or {})
+
+    def commit(self, services):
+        '''
+        Replace the recorded state with `services`, a dict of service name
+        to config hash.
+        '''
+        self.services = dict(services)
+        stored = self.db.get(self.KEY) or {}
+        stored[self.workspace] = self.services
+        self.db.set(self.KEY, stored)
@@ -0,0 +1,271 @@
+import bisect
+import functools
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+
+
+class CommandEvent(namedtuple('CommandEvent', ['source', 'name', 'command',
+                                               'workspace', 'duration',
+                                               'exit_code', 'output_size'])):
+    '''
+    Timing of a single command, as handed to the recorder.
+
+    :param source: 'runner' for docker-compose commands, 'aio' for those
+        of AsyncCompose and AsyncDocker, 'docker' for Docker methods
+    :param name: low cardinality name of the command, eg: 'docker-compose
+        up' or 'Docker.pull'
+    :param command: the full command line, or the method name
+    :param workspace: directory the command ran in, or None
+    :param duration: wall clock seconds
+    :param exit_code: 0 on success, the exit status of a failed process,
+        or 1 for any other error
+    :param output_size: bytes of output, or None when the result is not
+        output, eg: the containers returned by Docker.ps
+    '''
+    __slots__ = ()
+
+
+# None is the no-op default: instrumented calls cost one global lookup
+_recorder = None
+
+
+def get_recorder():
+    return _recorder
+
+
+def set_recorder(recorder):
+    '''
+    Install an object with a `record(event)` method to receive a
+    CommandEvent for every runner.run and aio.run call and Docker method.
+    Pass None to turn instrumentation off again. Returns the previous
+    recorder.
+
+    histogram = Histogram()
+    set_recorder(histogram)
+    '''
+    global _recorder
+    previous, _recorder = _recorder, recorder
+    return previous
+
+
+def command_name(argv):
+    '''
+    The program and its subcommand, eg: 'docker-compose up' for
+    ['docker-compose', 'up', '-d', 'web'].
+    '''
+    if not argv:
+        return ''
+    name = [os.path.basename(argv[0])]
+    for arg in argv[1:]:
+        if not arg.startswith('-'):
+            name.append(arg)
+            break
+    return ' '.join(name)
+
+
+def _exit_code(err):
+    if isinstance(err, subprocess.CalledProcessError):
+        return err.returncode
+    return 1
+
+
+def _size(result):
+    # only command output has a size: len() of eg: a list of containers
+    # would count rows
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    if isinstance(result, str):
+        return len(result.encode('utf-8'))
+    return None
+
+
+def record(source, name, command, workspace, started, exit_code=0,
+           output=None):
+    '''
+    Build a CommandEvent for a call that began at `started`, a
+    time.monotonic() reading, and hand it to the recorder, if any.
+    '''
+    recorder = _recorder
+    if recorder is None:
+        return
+    recorder.record(CommandEvent(source, name, command, workspace,
+                                 time.monotonic() - started, exit_code,
+                                 _size(output)))
+
+
+def instrument(method):
+    '''
+    Decorator timing a Docker method. For methods that return an iterator
+    the time covers setting up the stream, not consuming it.
+    '''
+    name = 'Docker.{}'.format(method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _recorder is None:
+            return method(self, *args, **kwargs)
+        workspace = getattr(self, 'workspace', None)
+        workspace = str(workspace) if workspace is not None else None
+        started = time.monotonic()
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception as err:
+            record('docker', name, method.__name__, workspace, started,
+                   _exit_code(err))
+            raise
+        record('docker', name, method.__name__, workspace, started, 0,
+               result)
+        return result
+    return wrapper
+
+
+# Seconds, suited to anything from `docker ps` to a long image build
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0, 120.0, 300.0, 600.0)
+
+
+class _Series:
+    __slots__ = ('buckets', 'count', 'sum', 'failures', 'output_bytes')
+
+    def __init__(self, size):
+        self.buckets = [0] * size
+        self.count = 0
+        self.sum = 0.0
+        self.failures = 0
+        self.output_bytes = 0
+
+
+class Histogram:
+    '''
+    In memory recorder aggregating command durations into histograms, per
+    source, command name and workspace, together with failure counts and
+    output sizes. Safe to share between threads.
+
+    histogram = Histogram()
+    set_recorder(histogram)
+    ... hook work ...
+    write_textfile(histogram, '/var/lib/node_exporter/textfile/juju.prom')
+
+    :param buckets: ascending upper bounds, in seconds
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        key = (event.source, event.name, event.workspace or '')
+        index = bisect.bisect_left(self.bounds, event.duration)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(len(self.bounds))
+            if index < len(self.bounds):
+                series.buckets[index] += 1
+            series.count += 1
+            series.sum += event.duration
+            if event.exit_code:
+                series.failures += 1
+            if event.output_size:
+                series.output_bytes += event.output_size
+
+    def snapshot(self):
+        '''
+        Return {(source, name, workspace): dict} with the cumulative
+        `buckets` as (bound, count) pairs, and the `count`, `sum`,
+        `failures` and `output_bytes` of each series.
+        '''
+        with self._lock:
+            snapshot = {}
+            for key, series in self._series.items():
+                cumulative, total = [], 0
+                for bound, n in zip(self.bounds, series.buckets):
+                    total += n
+                    cumulative.append((bound, total))
+                snapshot[key] = {'buckets': cumulative,
+                                 'count': series.count,
+                                 'sum': series.sum,
+                                 'failures': series.failures,
+                                 'output_bytes': series.output_bytes}
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _labels(key, **extra):
+    source, name, workspace = key
+    pairs = [('source', source), ('command', name), ('workspace', workspace)]
+    pairs.extend(sorted(extra.items()))
+    return '{{{}}}'.format(','.join('{}="{}"'.format(k, _label(v))
+                                    for k, v in pairs))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def to_prometheus(histogram, prefix='charms_docker'):
+    '''
+    Render a Histogram in the Prometheus text exposition format.
+    '''
+    snapshot = sorted(histogram.snapshot().items())
+    duration = '{}_command_duration_seconds'.format(prefix)
+    failures = '{}_command_failures_total'.format(prefix)
+    output = '{}_command_output_bytes_total'.format(prefix)
+    lines = ['# HELP {} Time spent in docker and docker-compose '
+             'commands.'.format(duration),
+             '# TYPE {} histogram'.format(duration)]
+    for key, series in snapshot:
+        for bound, count in series['buckets']:
+            lines.append('{}_bucket{} {}'.format(
+                duration, _labels(key, le=_number(bound)), count))
+        lines.append('{}_bucket{} {}'.format(
+            duration, _labels(key, le='+Inf'), series['count']))
+        lines.append('{}_sum{} {}'.format(duration, _labels(key),
+                                           _number(series['sum'])))
+        lines.append('{}_count{} {}'.format(duration, _labels(key),
+                                             series['count']))
+    lines.append('# HELP {} Commands that failed.'.format(failures))
+    lines.append('# TYPE {} counter'.format(failures))
+    for key, series in snapshot:
+        lines.append('{}{} {}'.format(failures, _labels(key),
+                                      series['failures']))
+    lines.append('# HELP {} Output returned by commands.'.format(output))
+    lines.append('# TYPE {} counter'.format(output))
+    for key, series in snapshot:
+        lines.append('{}{} {}'.format(output, _labels(key),
+                                      series['output_bytes']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(histogram, path, prefix='charms_docker'):
+    '''
+    Write a Histogram to `path` for node_exporter's textfile collector.
+    The file is replaced atomically, so the collector never reads it half
+    written; its name must end in .prom to be picked up.
+    '''
+    content = to_prometheus(histogram, prefix)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
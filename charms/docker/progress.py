@@ -0,0 +1,105 @@
+import re
+
+from collections import namedtuple
+
+
+class Progress(namedtuple('Progress', ['kind', 'id', 'status', 'current',
+                                       'total', 'text'])):
+    '''
+    A single progress event of a pull or a build, as handed to the
+    `on_progress` callback of Docker.pull and Compose.build.
+
+    :param kind: 'pull' or 'build'
+    :param id: the layer of a pull, or the service of a build. None for
+        events about the whole pull, such as its digest
+    :param status: eg: 'Downloading', 'Pull complete' or, for builds,
+        'Step'
+    :param current: bytes transferred so far, or the build step number,
+        when known
+    :param total: total bytes of the layer, or the number of build steps,
+        when known
+    :param text: the line or message the event was parsed from
+    '''
+    __slots__ = ()
+
+
+class StalledError(TimeoutError):
+    '''
+    Raised when a pull or build produced no output for `stall_timeout`
+    seconds, after the transfer or process has been abandoned.
+    '''
+
+    def __init__(self, what, seconds):
+        self.what = what
+        self.seconds = seconds
+        super().__init__("{} stalled: no progress for {}s".format(
+            what, seconds))
+
+
+_LAYER = re.compile(r'^([0-9a-f]{12}): (.*)$')
+
+
+def pull_message(message):
+    '''
+    Progress event for a message of the /images/create JSON stream.
+    '''
+    detail = message.get('progressDetail') or {}
+    status = message.get('status') or ''
+    return Progress('pull', message.get('id'), status,
+                    detail.get('current'), detail.get('total'),
+                    message.get('progress') or status)
+
+
+def pull_line(line):
+    '''
+    Progress event for a line of `docker pull` output, which reports
+    layer status changes (without progress bars) when not on a TTY.
+    '''
+    line = line.rstrip()
+    match = _LAYER.match(line)
+    if match:
+        return Progress('pull', match.group(1), match.group(2), None, None,
+                        line)
+    return Progress('pull', None, line.partition(':')[0], None, None, line)
+
+
+# eg: Step 3/10 : RUN make, or Step 3 : RUN make with older clients
+_STEP = re.compile(r'^Step (\d+)(?:/(\d+))? : (.*)$')
+# eg: #7 [web 2/4] RUN make, as printed by BuildKit
+_BUILDKIT_STEP = re.compile(r'^#\d+ \[(?:(\S+) )?(\d+)/(\d+)\] (.*)$')
+_BUILDING = re.compile(r'^Building (\S+)$')
+
+
+class BuildProgress:
+    '''
+    Line callback for `docker-compose build` output that reports each
+    build step to `callback` as a Progress event. Only the name of the
+    service being built is kept between lines.
+
+    :param callback: called with a Progress for every step
+    :param service: the service being built, when known up front
+    '''
+
+    def __init__(self, callback, service=None):
+        self.callback = callback
+        self.service = service
+
+    def __call__(self, line):
+        line = line.rstrip()
+        building = _BUILDING.match(line)
+        if building:
+            self.service = building.group(1)
+            return
+        step = _STEP.match(line)
+        if step:
+            total = step.group(2)
+            self.callback(Progress('build', self.service, 'Step',
+                                   int(step.group(1)),
+                                   int(total) if total else None,
+                                   step.group(3)))
+            return
+        step = _BUILDKIT_STEP.match(line)
+        if step:
+            self.callback(Progress('build', step.group(1) or self.service,
+                                   'Step', int(step.group(2)),
+                                   int(step.group(3)), step.group(4)))
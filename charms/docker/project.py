@@ -0,0 +1,270 @@
+import re
+
+
+# $VAR or ${VAR}, ${VAR:-default} and the like; $$ is a literal $
+_VARIABLE = re.compile(
+    r'\$(?:\{([A-Za-z_][A-Za-z0-9_]*)|([A-Za-z_][A-Za-z0-9_]*))')
+
+
+class DependencyCycleError(ValueError):
+    '''
+    Raised when services depend on each other in a cycle, so they can not
+    be started in order.
+
+    :param cycle: the services on the cycle, the first repeated at the end
+    '''
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super().__init__("Dependency cycle between services: {}".format(
+            ' -> '.join(cycle)))
+
+
+class Service:
+    '''
+    A service definition from a compose file.
+
+    :param name: name of the service
+    :param config: the service's mapping from the compose file
+    '''
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config or {}
+
+    def __repr__(self):
+        return "<Service {}>".format(self.name)
+
+    @property
+    def image(self):
+        return self.config.get('image')
+
+    @property
+    def build(self):
+        '''
+        The build configuration as a dict with at least a context, or None
+        for services that only run an image.
+        '''
+        build = self.config.get('build')
+        if not build:
+            return None
+        if isinstance(build, str):
+            return {'context': build}
+        return dict(build)
+
+    @property
+    def depends_on(self):
+        # a list, or a mapping of service to condition from version 2.1 on
+        return list(self.config.get('depends_on') or [])
+
+    @property
+    def links(self):
+        # eg: db, db:database
+        return [link.partition(':')[0]
+                for link in self.config.get('links') or []]
+
+    @property
+    def dependencies(self):
+        '''
+        Every service this one needs started first: depends_on, links and
+        volumes_from, in that order, without duplicates.
+        '''
+        deps = self.depends_on + self.links
+        for source in self.config.get('volumes_from') or []:
+            # eg: web, web:ro, container:name:ro
+            if not source.startswith('container:'):
+                deps.append(source.partition(':')[0])
+        return list(dict.fromkeys(deps))
+
+    @property
+    def volumes(self):
+        '''
+        Volume entries as given, short syntax strings or long syntax
+        dicts.
+        '''
+        return list(self.config.get('volumes') or [])
+
+    @property
+    def networks(self):
+        # a list, or a mapping of network to aliases and addresses
+        return list(self.config.get('networks') or [])
+
+    @property
+    def env_files(self):
+        '''
+        Paths of the service's env_file entries, relative to the compose
+        file.
+        '''
+        env_file = self.config.get('env_file')
+        if not env_file:
+            return []
+        if isinstance(env_file, str):
+            return [env_file]
+        # the compose spec also allows {path: ..., required: ...}
+        return [f['path'] if isinstance(f, dict) else f for f in env_file]
+
+    @property
+    def variables(self):
+        '''
+        Sorted names of the environment variables docker-compose
+        interpolates into the service's definition, eg: TAG for
+        `image: nginx:${TAG}`.
+        '''
+        found = set()
+        pending = [self.config]
+        while pending:
+            value = pending.pop()
+            if isinstance(value, dict):
+                pending.extend(value.keys())
+                pending.extend(value.values())
+            elif isinstance(value, list):
+                pending.extend(value)
+            elif isinstance(value, str):
+                for match in _VARIABLE.finditer(value.replace('$$', '')):
+                    found.add(match.group(1) or match.group(2))
+        return sorted(found)
+
+    @property
+    def healthcheck(self):
+        '''
+        The healthcheck mapping, or None if the service has none or
+        disables it.
+        '''
+        check = self.config.get('healthcheck')
+        if not check or check.get('disable'):
+            return None
+        return check
+
+
+class Project:
+    '''
+    Parsed model of a compose file, for both the version 1 layout and the
+    `services:` layout of later versions and of the compose spec, which
+    may leave out `version:` (`version` is then None).
+
+    project = Project.load('files/workspace/docker-compose.yml')
+    project.services['web'].depends_on
+    > ['db']
+    project.unknown(['web', 'wbe'])
+    > ['wbe']
+
+    :param doc: the compose file's top level mapping
+    '''
+
+    def __init__(self, doc):
+        doc = doc or {}
+        services = doc.get('services')
+        if isinstance(services, dict) or ('services' in doc and
+                                          'version' in doc):
+            # the compose spec makes version optional
+            self.version = str(doc['version']) if 'version' in doc else None
+            services = doc['services'] or {}
+            self.volumes = list(doc.get('volumes') or [])
+            self.networks = list(doc.get('networks') or [])
+        else:
+            self.version = '1'
+            services = doc
+            self.volumes = []
+            self.networks = []
+        self.services = dict((name, Service(name, config))
+                             for name, config in services.items())
+
+    @classmethod
+    def load(cls, path):
+        import yaml
+
+        with open(path) as f:
+            return cls(yaml.safe_load(f))
+
+    def __contains__(self, name):
+        return name in self.services
+
+    def __iter__(self):
+        return iter(self.services.values())
+
+    def __len__(self):
+        return len(self.services)
+
+    @property
+    def names(self):
+        return list(self.services)
+
+    def config(self):
+        '''
+        The raw service mappings, keyed by service name.
+        '''
+        return dict((name, svc.config) for name, svc in self.services.items())
+
+    def builds(self):
+        '''
+        Build configurations of the services that have one, keyed by
+        service name.
+        '''
+        return dict((svc.name, svc.build) for svc in self if svc.build)
+
+    def images(self):
+        '''
+        Images of the services that name one, keyed by service name.
+        '''
+        return dict((svc.name, svc.image) for svc in self if svc.image)
+
+    def unknown(self, names):
+        '''
+        The entries of `names` that are not services of this project.
+        '''
+        return [name for name in names if name not in self.services]
+
+    def waves(self, names=None):
+        '''
+        Group services into waves that can be started in order: every
+        service depends only on services of earlier waves, so each wave
+        can start in parallel once the previous one is ready. Services
+        keep their compose file order within a wave.
+
+        project.waves()
+        > [['db', 'cache'], ['api'], ['web']]
+
+        :param names: services to start, along with everything they depend
+            on. default: every service
+        :raises DependencyCycleError: if the dependencies form a cycle
+        :raises ValueError: for unknown services and dependencies
+        '''
+        stack = list(self.services if names is None else names)
+        unknown = self.unknown(stack)
+        if unknown:
+            raise ValueError("No such service: {}".format(', '.join(unknown)))
+        pending = {}
+        while stack:
+            name = stack.pop()
+            if name in pending:
+                continue
+            deps = self.services[name].dependencies
+            for dep in deps:
+                if dep not in self.services:
+                    raise ValueError("Service {} depends on undefined "
+                                     "service {}".format(name, dep))
+            pending[name] = set(deps)
+            stack.extend(deps)
+        waves = []
+        while pending:
+            ready = [name for name in self.services
+                     if name in pending and not pending[name]]
+            if not ready:
+                raise DependencyCycleError(_find_cycle(pending))
+            waves.append(ready)
+            for name in ready:
+                del pending[name]
+            for deps in pending.values():
+                deps.difference_update(ready)
+        return waves
+
+
+def _find_cycle(pending):
+    # Every pending service still waits on another pending one, so
+    # following any of them must come back round
+    path = []
+    name = sorted(pending)[0]
+    while name not in path:
+        path.append(name)
+        name = sorted(pending[name])[0]
+    return path[path.index(name):] + [name]
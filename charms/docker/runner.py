@@ -1,31 +1,255 @@
 from contextlib import contextmanager
 from shlex import split
-from subprocess import check_output
 import os
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
 
+from . import metrics
+from .progress import StalledError
+from .streams import LineDecoder
 
-def run(cmd, workspace):
+
+class Executor:
+    '''
+    Runs commands as child processes on behalf of Compose. Each process
+    is given its own working directory, so nothing process wide changes
+    and any number of threads may share one Executor.
+
+    Every process leads its own process group, so a timeout takes down
+    whatever it spawned as well (docker-compose forks helpers of its own).
+
+    ex = Executor(max_concurrency=4)
+    ex.run(['docker-compose', 'pull'], cwd='files/workspace', timeout=300,
+           on_stdout=hookenv.log)
+
+    :param max_concurrency: most processes in flight at once; further
+        calls block until one finishes. default: unlimited
+    :param timeout: default per-call timeout in seconds. default: none
+    :param kill_grace: seconds between SIGTERM and SIGKILL when a process
+        group times out
+    :param max_line: longest line, in characters, handed to a callback
+        in one piece
+    '''
+
+    def __init__(self, max_concurrency=None, timeout=None, kill_grace=2.0,
+                 max_line=65536):
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.timeout = timeout
+        self.kill_grace = kill_grace
+        self.max_line = max_line
+        self._limit = None
+        if max_concurrency is not None:
+            self._limit = threading.BoundedSemaphore(max_concurrency)
+
+    def run(self, argv, cwd=None, timeout=None, on_stdout=None,
+            on_stderr=None, env=None, idle_timeout=None, capture=True):
+        '''
+        Run `argv` to completion and return its STDOUT.
+
+        :param argv: list of the program and its arguments
+        :param cwd: directory to run the command in
+        :param timeout: seconds before the process group is killed and
+            subprocess.TimeoutExpired raised. default: the Executor's
+        :param on_stdout: called with each decoded line of STDOUT, without
+            the newline, as it arrives
+        :param on_stderr: likewise for STDERR. Without it STDERR is
+            inherited rather than captured, unless idle_timeout is set:
+            then it is read to watch for activity and echoed to ours.
+        :param env: environment of the process. default: ours
+        :param idle_timeout: seconds without any output before the process
+            group is killed and charms.docker.progress.StalledError raised
+        :param capture: keep STDOUT to return it. Turn off, along with a
+            callback, to bound memory for chatty commands; b'' is returned.
+
+        :raises subprocess.CalledProcessError: on a non-zero exit
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        if self._limit is not None:
+            self._limit.acquire()
+        try:
+            return self._run(list(argv), cwd, timeout, on_stdout, on_stderr,
+                             env, idle_timeout, capture)
+        finally:
+            if self._limit is not None:
+                self._limit.release()
+
+    def _run(self, argv, cwd, timeout, on_stdout, on_stderr, env,
+             idle_timeout=None, capture=True):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if on_stderr is None and idle_timeout is not None:
+            # progress often only goes to STDERR, eg: BuildKit builds
+            on_stderr = _echo_stderr
+        stderr = subprocess.PIPE if on_stderr else None
+        proc = subprocess.Popen(argv, cwd=cwd, env=env,
+                                stdout=subprocess.PIPE, stderr=stderr,
+                                start_new_session=True)
+        try:
+            out = self._collect(proc, deadline, timeout, idle_timeout,
+                                on_stdout, on_stderr, capture)
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            try:
+                proc.wait(remaining)
+            except subprocess.TimeoutExpired:
+                raise subprocess.TimeoutExpired(argv, timeout)
+        except BaseException:
+            self._kill(proc)
+            raise
+        finally:
+            for pipe in (proc.stdout, proc.stderr):
+                if pipe is not None:
+                    pipe.close()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, argv, out)
+        return out
+
+    def _collect(self, proc, deadline, timeout, idle_timeout, on_stdout,
+                 on_stderr, capture):
+        chunks = []
+        sel = selectors.DefaultSelector()
+        sel.register(proc.stdout, selectors.EVENT_READ,
+                     (on_stdout, LineDecoder(self.max_line),
+                      chunks if capture else None))
+        if proc.stderr is not None:
+            sel.register(proc.stderr, selectors.EVENT_READ,
+                         (on_stderr, LineDecoder(self.max_line), None))
+        active = time.monotonic()
+        try:
+            while sel.get_map():
+                remaining = None
+                now = time.monotonic()
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise subprocess.TimeoutExpired(proc.args, timeout)
+                if idle_timeout is not None:
+                    idle = active + idle_timeout - now
+                    if idle <= 0:
+                        raise StalledError(' '.join(proc.args), idle_timeout)
+                    remaining = idle if remaining is None else \
+                        min(remaining, idle)
+                for key, _ in sel.select(remaining):
+                    callback, decoder, sink = key.data
+                    data = os.read(key.fd, 65536)
+                    active = time.monotonic()
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        lines = decoder.flush()
+                    else:
+                        if sink is not None:
+                            sink.append(data)
+                        lines = decoder.feed(data)
+                    if callback is not None:
+                        for line in lines:
+                            callback(line)
+        finally:
+            sel.close()
+        return b''.join(chunks)
+
+    def _kill(self, proc):
+        # the whole group, as children may outlive the leader and still
+        # hold the pipes
+        try:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGTERM)
+                try:
+                    proc.wait(self.kill_grace)
+                except subprocess.TimeoutExpired:
+                    pass
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        if proc.poll() is None:
+            proc.wait()
+
+
+def _echo_stderr(line):
+    print(line, file=sys.stderr)
+
+
+_executor = Executor()
+
+
+def get_executor():
+    '''
+    The Executor that run() hands commands to.
+    '''
+    return _executor
+
+
+def set_executor(executor):
+    '''
+    Replace the Executor that run() hands commands to, eg: to cap how many
+    docker-compose processes a charm runs at once, or to record commands
+    in tests. Returns the previous one.
+
+    set_executor(Executor(max_concurrency=2, timeout=600))
+    '''
+    global _executor
+    previous, _executor = _executor, executor
+    return previous
+
+
+def run(cmd, workspace, timeout=None, on_stdout=None, on_stderr=None,
+        idle_timeout=None, capture=True):
     '''
     wrapper for executing the commands generated by the class members.
-    commands are passed through shlex.parse for convenience.
+    commands are passed through shlex.parse for convenience. The command
+    runs in the workspace, without changing our own working directory.
 
     :param cmd: - String of the command to run. eg: echo "hello world".
+    :param workspace: - directory to run the command in
+    :param timeout: - seconds before the command is killed
+    :param on_stdout: - called with each line of STDOUT as it arrives
+    :param on_stderr: - called with each line of STDERR as it arrives
+    :param idle_timeout: - seconds without output before the command is
+        killed
+    :param capture: - keep STDOUT to return it
 
     :returns: STDOUT of command execution
 
     :usage: c.run('docker-compose ps')
     '''
-    with chdir("{}".format(workspace)):
-        out = check_output(split(cmd))
-        return out
+    argv = split(cmd) if isinstance(cmd, str) else list(cmd)
+    cwd = "{}".format(workspace)
+    options = {'timeout': timeout, 'on_stdout': on_stdout,
+               'on_stderr': on_stderr}
+    if idle_timeout is not None or not capture:
+        options.update(idle_timeout=idle_timeout, capture=capture)
+    if metrics.get_recorder() is None:
+        return get_executor().run(argv, cwd=cwd, **options)
+    name, command = metrics.command_name(argv), ' '.join(argv)
+    started = time.monotonic()
+    try:
+        out = get_executor().run(argv, cwd=cwd, **options)
+    except subprocess.CalledProcessError as err:
+        metrics.record('runner', name, command, cwd, started, err.returncode,
+                       err.output)
+        raise
+    except Exception:
+        metrics.record('runner', name, command, cwd, started, 1)
+        raise
+    metrics.record('runner', name, command, cwd, started, 0, out)
+    return out
 
 
 # This is helpful for setting working directory context
 @contextmanager
 def chdir(path):
     '''Change the current working directory to a different directory to run
-    commands and return to the previous directory after the command is done.'''
+    commands and return to the previous directory after the command is done,
+    or raised. This changes the directory of the whole process; run() does
+    not use it.'''
     old_dir = os.getcwd()
     os.chdir(path)
-    yield
-    os.chdir(old_dir)
+    try:
+        yield
+    finally:
+        os.chdir(old_dir)
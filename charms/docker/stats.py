@@ -0,0 +1,377 @@
+import bisect
+import json
+import math
+import re
+import subprocess
+import threading
+import time
+
+from array import array
+from collections import namedtuple
+
+from . import streams
+from .api import APIError, quote_path
+
+
+# Metrics kept for every container, in the order of Sample's fields
+METRICS = ('cpu_percent', 'memory', 'memory_percent', 'net_rx', 'net_tx',
+           'block_read', 'block_write')
+
+
+class Sample(namedtuple('Sample', ('time',) + METRICS)):
+    '''
+    Resource usage of a container at one point in time.
+
+    :param time: when the sample was taken, in seconds since the epoch
+    :param cpu_percent: CPU use, where 100 is one full core
+    :param memory: memory in use, in bytes, not counting the page cache
+    :param memory_percent: memory in use as a percentage of the limit
+    :param net_rx: bytes received over all networks, since the start
+    :param net_tx: bytes sent over all networks, since the start
+    :param block_read: bytes read from block devices, since the start
+    :param block_write: bytes written to block devices, since the start
+    '''
+    __slots__ = ()
+
+
+class Aggregate(namedtuple('Aggregate', ['count', 'p50', 'p95', 'max'])):
+    '''
+    Summary of one metric over a window of samples. The percentiles and
+    max are None when the window holds no samples.
+    '''
+    __slots__ = ()
+
+
+class Ring:
+    '''
+    Fixed size ring buffer of floats. The values live in a preallocated
+    array, so a full buffer costs 8 bytes a value and appending never
+    allocates.
+
+    ring = Ring(3)
+    for value in (1, 2, 3, 4):
+        ring.append(value)
+    ring.values()
+    > array('d', [2.0, 3.0, 4.0])
+
+    :param size: number of values kept, older ones are overwritten
+    '''
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self._data = array('d', bytes(8 * size))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value):
+        self._data[self._next] = value
+        self._next = (self._next + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def values(self, last=None):
+        '''
+        The `last` most recent values (default: all of them), oldest
+        first, as an array.
+        '''
+        count = self._count if last is None else min(last, self._count)
+        start = (self._next - count) % self.size
+        if start + count <= self.size:
+            return self._data[start:start + count]
+        return self._data[start:] + self._data[:self._next]
+
+
+def _percentile(ordered, q):
+    # nearest rank, on values sorted ascending
+    return ordered[max(1, math.ceil(q / 100.0 * len(ordered))) - 1]
+
+
+class _Series:
+    '''
+    The rings of a single container: one per metric, plus the sample
+    times to select windows by.
+    '''
+
+    def __init__(self, size):
+        self.times = Ring(size)
+        self.rings = dict((metric, Ring(size)) for metric in METRICS)
+        self.latest = None
+
+    def add(self, sample):
+        self.times.append(sample.time)
+        for metric in METRICS:
+            self.rings[metric].append(getattr(sample, metric))
+        self.latest = sample
+
+    def window(self, seconds):
+        '''
+        Number of the most recent samples within `seconds` of the latest.
+        '''
+        if seconds is None or self.latest is None:
+            return len(self.times)
+        times = self.times.values()
+        return len(times) - bisect.bisect_left(times,
+                                               self.latest.time - seconds)
+
+
+class StatsSampler:
+    '''
+    Collects resource usage of containers from the daemon's stats stream
+    in a background thread, keeping the last `size` samples of every
+    metric in a Ring per container. Aggregates are computed from the
+    rings on demand, so status checks and scaling decisions do not have to
+    run `docker stats` themselves.
+
+    With the CLI backend a single `docker stats` process follows every
+    container; with the API each container has its own stats request.
+
+    ex: sampler = docker.stats(['web', 'db'], size=120)
+    sampler.aggregate('web', 'cpu_percent', window=60)
+    > Aggregate(count=60, p50=12.5, p95=48.0, max=71.2)
+    sampler.rate('web', 'net_rx', window=60)
+    > 53812.4
+    sampler.stop()
+
+    :param containers: names or IDs of the containers to follow
+    :param docker: Docker instance to read stats through
+    :param size: number of samples kept per container
+    '''
+
+    def __init__(self, containers, docker, size=120):
+        self.containers = list(containers)
+        self.docker = docker
+        self.size = size
+        self.last_error = None
+        self._series = dict((name, _Series(size))
+                            for name in self.containers)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        '''
+        Start following the stats streams.
+        '''
+        self._stop.clear()
+
+        def api():
+            # open every request up front, so an unreachable daemon is
+            # reported here and can fall back to the CLI
+            opened = []
+            try:
+                for name in self.containers:
+                    resp = self.docker.api.get(
+                        '/containers/{}/stats'.format(quote_path(name)),
+                        params={'stream': True}, stream=True, timeout=None)
+                    opened.append((self._follow_api, (name, resp)))
+            except BaseException:
+                for _, (_, resp) in opened:
+                    resp.close()
+                raise
+            return opened
+
+        def cli():
+            self._proc = subprocess.Popen(
+                ['docker', 'stats', '--format', '{{json .}}'] +
+                self.containers, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            return [(self._follow_cli, (self._proc,))]
+
+        for target, args in self.docker._dispatch(api, cli):
+            thread = threading.Thread(target=target, args=args,
+                                      name='StatsSampler')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        '''
+        Stop following the stats streams. The samples are kept. API
+        requests end with their next sample, about a second later.
+        '''
+        self._stop.set()
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+        for thread in self._threads:
+            thread.join(timeout)
+        if self._proc is not None:
+            self._proc.wait()
+            self._proc.stdout.close()
+            self._proc.stderr.close()
+            self._proc = None
+        self._threads = []
+
+    def _follow_cli(self, proc):
+        for line in streams.iter_pipes(proc):
+            if line.stream != 'stdout':
+                self.last_error = line.text
+                continue
+            # every refresh starts by clearing the screen
+            start = line.text.find('{')
+            if start < 0:
+                continue
+            try:
+                obj = json.loads(line.text[start:])
+            except ValueError as err:
+                self.last_error = err
+                continue
+            name = obj.get('Container')
+            if name not in self._series:
+                name = next((c for c in self.containers
+                             if c in (obj.get('Name'), obj.get('ID'))), None)
+            sample = sample_from_cli(obj)
+            if name is not None and sample is not None:
+                self.apply(name, sample)
+
+    def _follow_api(self, name, resp):
+        try:
+            for obj in resp.iter_json():
+                if self._stop.is_set():
+                    break
+                sample = sample_from_api(obj)
+                if sample is not None:
+                    self.apply(name, sample)
+        except (OSError, ValueError, APIError) as err:
+            self.last_error = err
+        finally:
+            resp.close()
+
+    def apply(self, container, sample):
+        '''
+        Record a Sample of `container`.
+        '''
+        with self._lock:
+            self._series[container].add(sample)
+
+    def latest(self, container):
+        '''
+        The most recent Sample of `container`, or None before the first.
+        '''
+        with self._lock:
+            return self._series[container].latest
+
+    def values(self, container, metric, window=None):
+        '''
+        Values of a metric over the last `window` seconds (default: every
+        sample kept), oldest first, as an array.
+        '''
+        with self._lock:
+            series = self._series[container]
+            return series.rings[metric].values(series.window(window))
+
+    def aggregate(self, container, metric, window=None):
+        '''
+        Median, 95th percentile and max of a metric over the last `window`
+        seconds, as an Aggregate.
+        '''
+        ordered = sorted(self.values(container, metric, window))
+        if not ordered:
+            return Aggregate(0, None, None, None)
+        return Aggregate(len(ordered), _percentile(ordered, 50),
+                         _percentile(ordered, 95), ordered[-1])
+
+    def rate(self, container, metric, window=None):
+        '''
+        Per second growth of a counter, such as net_rx or block_write,
+        over the last `window` seconds. None with fewer than two samples.
+        '''
+        with self._lock:
+            series = self._series[container]
+            count = series.window(window)
+            times = series.times.values(count)
+            values = series.rings[metric].values(count)
+        if count < 2 or times[-1] <= times[0]:
+            return None
+        return (values[-1] - values[0]) / (times[-1] - times[0])
+
+
+_SIZE = re.compile(r'^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$')
+_UNITS = {
+    '': 1, 'b': 1,
+    'kb': 1000, 'mb': 1000 ** 2, 'gb': 1000 ** 3, 'tb': 1000 ** 4,
+    'kib': 1024, 'mib': 1024 ** 2, 'gib': 1024 ** 3, 'tib': 1024 ** 4,
+}
+
+
+def _size(text):
+    '''
+    Bytes of a size as printed by `docker stats`, eg: 1.5MiB or 648kB.
+    '''
+    match = _SIZE.match(text)
+    if not match or match.group(2).lower() not in _UNITS:
+        raise ValueError("Unknown size: {}".format(text))
+    return float(match.group(1)) * _UNITS[match.group(2).lower()]
+
+
+def _pair(text):
+    # eg: 648B / 1.2kB
+    first, _, second = text.partition('/')
+    return _size(first), _size(second)
+
+
+def sample_from_cli(obj, now=None):
+    '''
+    Sample from a line of `docker stats --format '{{json .}}'`, or None
+    for a container that is not running.
+    '''
+    try:
+        memory = _pair(obj['MemUsage'])[0]
+        rx, tx = _pair(obj['NetIO'])
+        read, write = _pair(obj['BlockIO'])
+        return Sample(time.time() if now is None else now,
+                      float(obj['CPUPerc'].rstrip('%')), memory,
+                      float(obj['MemPerc'].rstrip('%')), rx, tx, read, write)
+    except (KeyError, ValueError):
+        # '--' for every value of a stopped container
+        return None
+
+
+def sample_from_api(obj, now=None):
+    '''
+    Sample from an object of the /containers/{id}/stats stream, with CPU
+    and memory figured the way `docker stats` does. None for a container
+    that is not running.
+    '''
+    cpu = obj.get('cpu_stats') or {}
+    pre = obj.get('precpu_stats') or {}
+    mem = obj.get('memory_stats') or {}
+    if not mem.get('usage'):
+        return None
+    cpu_delta = (cpu.get('cpu_usage', {}).get('total_usage', 0) -
+                 pre.get('cpu_usage', {}).get('total_usage', 0))
+    system_delta = (cpu.get('system_cpu_usage', 0) -
+                    pre.get('system_cpu_usage', 0))
+    cpus = cpu.get('online_cpus') or \
+        len(cpu.get('cpu_usage', {}).get('percpu_usage') or []) or 1
+    cpu_percent = 0.0
+    if cpu_delta > 0 and system_delta > 0:
+        cpu_percent = cpu_delta / system_delta * cpus * 100
+    # the page cache: inactive_file with cgroup v2, cache with v1
+    detail = mem.get('stats') or {}
+    memory = mem['usage'] - detail.get('inactive_file',
+                                       detail.get('cache', 0))
+    limit = mem.get('limit') or 0
+    networks = (obj.get('networks') or {}).values()
+    blkio = (obj.get('blkio_stats') or {}).get(
+        'io_service_bytes_recursive') or []
+    return Sample(
+        time.time() if now is None else now, cpu_percent, memory,
+        memory / limit * 100 if limit else 0.0,
+        sum(n.get('rx_bytes', 0) for n in networks),
+        sum(n.get('tx_bytes', 0) for n in networks),
+        sum(e.get('value', 0) for e in blkio
+            if e.get('op', '').lower() == 'read'),
+        sum(e.get('value', 0) for e in blkio
+            if e.get('op', '').lower() == 'write'))
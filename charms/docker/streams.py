@@ -0,0 +1,270 @@
+import calendar
+import codecs
+import os
+import re
+import selectors
+import time
+
+from collections import deque, namedtuple
+from itertools import count
+
+
+# Names of the STDOUT and STDERR stream types of multiplexed frames, as
+# numbered in charms.docker.api. Not imported from there, so that
+# streaming process output does not load the HTTP client.
+STREAM_NAMES = {1: 'stdout', 2: 'stderr'}
+
+
+class LogLine(namedtuple('LogLine', ['stream', 'text'])):
+    '''
+    A single line of container output.
+
+    :param stream: 'stdout' or 'stderr'
+    :param text: decoded line, without the trailing newline
+    '''
+    __slots__ = ()
+
+
+class TaggedLine(namedtuple('TaggedLine', ['container', 'time', 'stream',
+                                           'text'])):
+    '''
+    A line of container output from Docker.tail_many.
+
+    :param container: name or ID of the container, as it was given
+    :param time: when the daemon logged the line, in seconds since the
+        epoch, or None if it could not be parsed
+    :param stream: 'stdout' or 'stderr'
+    :param text: decoded line, without the timestamp and trailing newline
+    '''
+    __slots__ = ()
+
+
+class LineDecoder:
+    '''
+    Incrementally decodes UTF-8 bytes and splits them into lines. Only the
+    trailing partial line is held between calls, and that is cut at
+    `max_line` characters, so memory is bounded by the line length rather
+    than the size of the stream. Invalid bytes are replaced, not dropped.
+
+    d = LineDecoder()
+    d.feed(b'caf\\xc3')
+    > []
+    d.feed(b'\\xa9\\nnext')
+    > ['café']
+    d.flush()
+    > ['next']
+    '''
+
+    def __init__(self, max_line=65536):
+        self.max_line = max_line
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._partial = ''
+
+    def feed(self, data):
+        text = self._partial + self._decoder.decode(data)
+        lines = text.split('\n')
+        self._partial = lines.pop()
+        while len(self._partial) > self.max_line:
+            lines.append(self._partial[:self.max_line])
+            self._partial = self._partial[self.max_line:]
+        return lines
+
+    def flush(self):
+        text = self._partial + self._decoder.decode(b'', final=True)
+        self._partial = ''
+        return [text] if text else []
+
+
+def iter_frames(frames, max_line=65536):
+    '''
+    Turn (stream, payload) frames, as produced by Response.iter_frames,
+    into LogLine tuples, decoding stdout and stderr independently.
+    '''
+    decoders = {}
+    for stream, payload in frames:
+        name = STREAM_NAMES.get(stream, 'stdout')
+        if name not in decoders:
+            decoders[name] = LineDecoder(max_line)
+        for line in decoders[name].feed(payload):
+            yield LogLine(name, line)
+    for name, decoder in decoders.items():
+        for line in decoder.flush():
+            yield LogLine(name, line)
+
+
+def iter_pipes(proc, max_line=65536, chunk_size=65536):
+    '''
+    Yield LogLine tuples from the stdout and stderr pipes of a Popen
+    object as soon as complete lines arrive on either of them. Returns
+    once both pipes reach EOF; the caller is responsible for waiting on
+    the process.
+    '''
+    sel = selectors.DefaultSelector()
+    decoders = {}
+    for name in ('stdout', 'stderr'):
+        pipe = getattr(proc, name)
+        if pipe is not None:
+            sel.register(pipe, selectors.EVENT_READ, name)
+            decoders[name] = LineDecoder(max_line)
+    try:
+        while sel.get_map():
+            for key, _ in sel.select():
+                data = os.read(key.fd, chunk_size)
+                decoder = decoders[key.data]
+                if not data:
+                    sel.unregister(key.fileobj)
+                    lines = decoder.flush()
+                else:
+                    lines = decoder.feed(data)
+                for line in lines:
+                    yield LogLine(key.data, line)
+    finally:
+        sel.close()
+
+
+def _log_time(stamp):
+    '''
+    (seconds, nanoseconds) since the epoch of an RFC3339 timestamp as
+    printed by `docker logs --timestamps`, or None. The fraction has its
+    trailing zeros trimmed, so the text does not sort by time.
+    '''
+    whole, _, frac = stamp.rstrip(b'Z').partition(b'.')
+    try:
+        seconds = calendar.timegm(time.strptime(whole.decode('ascii'),
+                                                '%Y-%m-%dT%H:%M:%S'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    return seconds, int((frac + b'000000000')[:9] or 0)
+
+
+class _Pipe:
+    '''
+    Splits the output of one pipe into raw lines, holding at most
+    `max_line` bytes of a partial line.
+    '''
+
+    def __init__(self, container, stream, max_line):
+        self.container = container
+        self.stream = stream
+        self.max_line = max_line
+        self.partial = b''
+
+    def feed(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        while len(self.partial) > self.max_line:
+            lines.append(self.partial[:self.max_line])
+            self.partial = self.partial[self.max_line:]
+        return lines
+
+    def flush(self):
+        lines = [self.partial] if self.partial else []
+        self.partial = b''
+        return lines
+
+
+def merge_logs(procs, pattern=None, buffer=1000, delay=0.5,
+               max_line=65536, chunk_size=65536):
+    '''
+    Follow `docker logs --timestamps` processes on a single selector and
+    yield their lines as TaggedLine tuples, merged in timestamp order.
+
+    A line is held back until every other container has a line buffered,
+    has finished, or `delay` seconds have passed, as a quiet container may
+    yet print something earlier. Once a container has `buffer` lines
+    buffered its pipes are no longer read, so a slow consumer throttles
+    the processes rather than growing memory, and lines are released
+    without waiting until it drains. Lines not matching `pattern` are
+    dropped before they are decoded.
+
+    :param procs: dict of container to its Popen object
+    :param pattern: regex, as str or bytes, searched for in the raw bytes
+        of each line
+    :param buffer: most lines buffered per container
+    :param delay: most seconds a line is held back to order it
+    :param max_line: longest line, in bytes, before it is split
+    '''
+    if isinstance(pattern, str):
+        pattern = pattern.encode('utf-8')
+    search = re.compile(pattern).search if pattern is not None else None
+    # per container: buffered (sort key, arrival order, arrival time,
+    # stream, raw message, timestamp) entries, the timestamp of its last
+    # line, and its open pipes
+    buffers = dict((name, deque()) for name in procs)
+    last = dict((name, None) for name in procs)
+    pipes = dict((name, {}) for name in procs)
+    paused = set()
+    order = count()
+    sel = selectors.DefaultSelector()
+    for name, proc in procs.items():
+        for stream in ('stdout', 'stderr'):
+            pipe = getattr(proc, stream)
+            if pipe is not None:
+                pipes[name][pipe] = _Pipe(name, stream, max_line)
+                sel.register(pipe, selectors.EVENT_READ, pipes[name][pipe])
+
+    def queue(source, raw):
+        stamp, _, message = raw.partition(b' ')
+        stamp = _log_time(stamp)
+        if stamp is None:
+            # a continuation of a split line, or no timestamp at all
+            stamp, message = last[source.container], raw
+        last[source.container] = stamp
+        if search is not None and not search(message):
+            return
+        buffers[source.container].append(
+            (stamp or (0, 0), next(order), time.monotonic(), source.stream,
+             message, stamp))
+
+    try:
+        while True:
+            hold = None
+            while True:
+                heads = [buf[0] + (name,) for name, buf in buffers.items()
+                         if buf]
+                if not heads:
+                    break
+                head = min(heads)
+                name = head[-1]
+                waiting = any(pipes[n] and not buffers[n] for n in procs)
+                full = any(len(buf) >= buffer for buf in buffers.values())
+                if waiting and not full and \
+                        time.monotonic() < head[2] + delay:
+                    hold = head[2] + delay
+                    break
+                buffers[name].popleft()
+                if name in paused and len(buffers[name]) < buffer:
+                    paused.discard(name)
+                    for pipe, source in pipes[name].items():
+                        sel.register(pipe, selectors.EVENT_READ, source)
+                stamp = head[5]
+                yield TaggedLine(
+                    name, stamp[0] + stamp[1] / 1e9 if stamp else None,
+                    head[3], head[4].decode('utf-8', 'replace'))
+            if not sel.get_map():
+                if any(buffers.values()):
+                    continue
+                return
+            timeout = None
+            if hold is not None:
+                timeout = max(0, hold - time.monotonic())
+            for key, _ in sel.select(timeout):
+                source = key.data
+                if source.container in paused:
+                    # read again once resumed
+                    continue
+                data = os.read(key.fd, chunk_size)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    del pipes[source.container][key.fileobj]
+                    lines = source.flush()
+                else:
+                    lines = source.feed(data)
+                for raw in lines:
+                    queue(source, raw)
+                if len(buffers[source.container]) >= buffer:
+                    paused.add(source.container)
+                    for pipe in pipes[source.container]:
+                        sel.unregister(pipe)
+    finally:
+        sel.close()
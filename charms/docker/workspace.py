@@ -1,4 +1,8 @@
 import os
+import re
+
+from .manifest import fingerprint
+from .project import Project
 
 
 class Workspace:
@@ -18,6 +22,8 @@ class Workspace:
     def __init__(self, path, context="compose"):
         self.path = path
         self.context = context
+        self._project = None
+        self._project_stamp = None
 
     def __str__(self):
         return self.path
@@ -25,6 +31,84 @@ class Workspace:
     def __repr__(self):
         return self.path
 
+    @property
+    def compose_file(self):
+        '''
+        Path of the workspace's docker-compose.yml (or .yaml), or None.
+        '''
+        for name in ('docker-compose.yml', 'docker-compose.yaml'):
+            path = os.path.join(self.path, name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    @property
+    def project_name(self):
+        '''
+        The project name docker-compose labels this workspace's containers
+        with: $COMPOSE_PROJECT_NAME, or the directory name, lowercased and
+        stripped of anything but letters, digits, dashes and underscores.
+        '''
+        name = os.environ.get('COMPOSE_PROJECT_NAME') or \
+            os.path.basename(os.path.abspath(self.path))
+        return re.sub(r'[^-_a-z0-9]', '', name.lower())
+
+    @property
+    def project(self):
+        '''
+        The parsed compose file, as a charms.docker.project.Project. The
+        file is only parsed again when its inode, size or mtime change.
+        '''
+        path = self.compose_file
+        if path is None:
+            raise OSError("Missing yaml definition: docker-compose.yml")
+        st = os.stat(path)
+        stamp = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+        if stamp != self._project_stamp:
+            self._project = Project.load(path)
+            self._project_stamp = stamp
+        return self._project
+
+    def config(self):
+        '''
+        Parse the compose file and return its services as a dict of name to
+        service definition, for both the version 1 layout and the
+        `services:` layout of later versions.
+        '''
+        return self.project.config()
+
+    def environment(self):
+        '''
+        The variables docker-compose interpolates into the compose file:
+        those of the workspace's .env file, overridden by our environment.
+        '''
+        env = {}
+        try:
+            with open(os.path.join(self.path, '.env')) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, _, value = line.partition('=')
+            value = value.strip()
+            if len(value) > 1 and value[0] == value[-1] and \
+                    value[0] in '"\'':
+                value = value[1:-1]
+            env[key.strip()] = value
+        env.update(os.environ)
+        return env
+
+    def fingerprint(self, cache=None):
+        '''
+        Merkle hash of the workspace as a docker build context, honoring
+        its .dockerignore. See charms.docker.manifest.fingerprint for the
+        incremental `cache`.
+        '''
+        return fingerprint(self.path, cache)
+
     def validate(self):
         dcyml = os.path.isfile("{}/docker-compose.yml".format(self.path))
         dcyaml = os.path.isfile("{}/docker-compose.yaml".format(self.path))
@@ -11,7 +11,10 @@ setup(
     keywords = "docker juju charm charms",
     packages = ['charms.docker'],
     long_description = "",
+    python_requires = ">=3.7",
     classifiers = [
         "Development Status :: 3 - Alpha",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
     ],
 )
@@ -0,0 +1,410 @@
+'''
+Benchmarks of the library's own overhead, runnable offline on any Linux
+box: `docker` and `docker-compose` are stub shell scripts put first on
+PATH that replay canned output, and the Engine API is a FakeDaemon on a
+unix socket. Nothing talks to a real daemon or the network.
+
+    python -m tests.bench                run, and compare with the baseline
+    python -m tests.bench --save         run, and store the results as the
+                                         baseline
+    python -m tests.bench --check        exit 1 if anything regressed
+
+Latencies are reported in milliseconds (p50 and p95), throughput in
+operations per second, memory as the peak of Python allocations in KiB,
+traced with tracemalloc, and import times as the median milliseconds
+spent importing charms modules in a fresh interpreter. Timings depend on
+the machine, so compare against a baseline saved on the same box.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from collections import namedtuple
+
+from charmhelpers.core import unitdata
+
+from charms.docker import Compose, Docker, DockerOpts
+from charms.docker.runner import run
+
+from .fakedaemon import FakeDaemon, frame
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'bench_baseline.json')
+
+
+class Result(namedtuple('Result', ['name', 'value', 'unit', 'better'])):
+    '''
+    A single measurement.
+
+    :param better: 'lower' or 'higher', which way is an improvement
+    '''
+    __slots__ = ()
+
+
+_STUB = '''#!/bin/sh
+# Replays $BENCH_OUTPUTS/<program>.<subcommand>, after an optional delay
+name=$(basename "$0")
+delay="$BENCH_OUTPUTS/$name.$1.delay"
+[ -f "$delay" ] && sleep "$(cat "$delay")"
+out="$BENCH_OUTPUTS/$name.$1"
+[ -f "$out" ] && cat "$out"
+exit 0
+'''
+
+
+def _cli_row(i):
+    return {'ID': '{:064x}'.format(i), 'Names': 'svc_{}'.format(i),
+            'Image': 'busybox:latest', 'Command': '"sleep 3600"',
+            'CreatedAt': '2016-03-23 06:29:35 +0000 UTC', 'State': 'running',
+            'Status': 'Up 3 minutes (healthy)',
+            'Labels': 'com.docker.compose.project=bench,'
+                      'com.docker.compose.service=svc{}'.format(i),
+            'Ports': '0.0.0.0:{}->80/tcp'.format(8000 + i % 1000)}
+
+
+def _api_row(i):
+    return {'Id': '{:064x}'.format(i), 'Names': ['/svc_{}'.format(i)],
+            'Image': 'busybox:latest', 'Command': 'sleep 3600',
+            'Created': 1458714575, 'State': 'running',
+            'Status': 'Up 3 minutes (healthy)',
+            'Labels': {'com.docker.compose.project': 'bench',
+                       'com.docker.compose.service': 'svc{}'.format(i)},
+            'Ports': [{'IP': '0.0.0.0', 'PrivatePort': 80,
+                       'PublicPort': 8000 + i % 1000, 'Type': 'tcp'}]}
+
+
+class FakeEnvironment:
+    '''
+    Stub binaries, canned outputs, a compose workspace, a scratch unit
+    data store and a FakeDaemon, installed for the duration of a `with`
+    block.
+
+    :param sizes: dict overriding the number of ps rows, log lines and
+        compose services the fixtures are generated with
+    '''
+    SIZES = {'ps_rows': 50, 'ps_large': 5000, 'log_lines': 200000,
+             'services': 16, 'pull_delay': 0.05}
+
+    def __init__(self, sizes=None):
+        self.sizes = dict(self.SIZES, **(sizes or {}))
+
+    def __enter__(self):
+        self.tmp = tempfile.mkdtemp(prefix='charms-docker-bench-')
+        self.bin = os.path.join(self.tmp, 'bin')
+        self.outputs = os.path.join(self.tmp, 'outputs')
+        self.workspace = os.path.join(self.tmp, 'bench')
+        for path in (self.bin, self.outputs, self.workspace):
+            os.mkdir(path)
+        for name in ('docker', 'docker-compose'):
+            path = os.path.join(self.bin, name)
+            with open(path, 'w') as f:
+                f.write(_STUB)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        self._write_fixtures()
+
+        self._environ = dict(os.environ)
+        os.environ['PATH'] = '{}:{}'.format(self.bin, os.environ['PATH'])
+        os.environ['BENCH_OUTPUTS'] = self.outputs
+        self._kv = unitdata._KV
+        unitdata._KV = unitdata.Storage(os.path.join(self.tmp, 'unit.db'))
+
+        self.daemon = FakeDaemon().start()
+        self._routes()
+        return self
+
+    def __exit__(self, *exc):
+        self.daemon.stop()
+        unitdata._KV.close()
+        unitdata._KV = self._kv
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.tmp)
+
+    def output(self, program, subcommand, content):
+        with open(os.path.join(self.outputs, '{}.{}'.format(
+                program, subcommand)), 'wb') as f:
+            f.write(content)
+
+    def _write_fixtures(self):
+        sizes = self.sizes
+        self.output('docker', 'ps', '\n'.join(
+            json.dumps(_cli_row(i))
+            for i in range(sizes['ps_rows'])).encode('utf-8') + b'\n')
+        self.output('docker', 'logs', b''.join(
+            'line {} of the container log\n'.format(i).encode('utf-8')
+            for i in range(sizes['log_lines'])))
+        self.output('docker', 'pull', b'Status: Image is up to date\n')
+        self.output('docker-compose', 'pull.delay',
+                    str(sizes['pull_delay']).encode('ascii'))
+        services = ''.join('  svc{}:\n    image: busybox\n'.format(i)
+                           for i in range(sizes['services']))
+        with open(os.path.join(self.workspace, 'docker-compose.yml'),
+                  'w') as f:
+            f.write('version: "2"\nservices:\n' + services)
+
+    def use_large_ps(self):
+        self.output('docker', 'ps', '\n'.join(
+            json.dumps(_cli_row(i))
+            for i in range(self.sizes['ps_large'])).encode('utf-8') + b'\n')
+
+    def _routes(self):
+        sizes = self.sizes
+        self.daemon.route('GET', '/_ping', body=b'OK',
+                          headers={'Api-Version': '1.24'})
+        small = json.dumps([_api_row(i) for i in range(sizes['ps_rows'])])
+        large = json.dumps([_api_row(i) for i in range(sizes['ps_large'])])
+        bodies = {'small': small.encode('utf-8'),
+                  'large': large.encode('utf-8')}
+        self.ps_body = 'small'
+
+        def ps(request):
+            return 200, bodies[self.ps_body], {
+                'Content-Type': 'application/json'}
+
+        self.daemon.route('GET', '/containers/json', handler=ps)
+        chunks, batch = [], []
+        for i in range(sizes['log_lines']):
+            batch.append('line {} of the container log\n'.format(i))
+            if len(batch) == 1000:
+                chunks.append(frame(1, ''.join(batch).encode('utf-8')))
+                batch = []
+        if batch:
+            chunks.append(frame(1, ''.join(batch).encode('utf-8')))
+        self.daemon.route('GET', '/containers/web/logs',
+                          handler=lambda request: (200, chunks, None))
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1,
+                int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency(name, fn, iterations):
+    '''
+    Call `fn` `iterations` times, after one warm up call, and report the
+    p50 and p95 in milliseconds.
+    '''
+    fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return [Result('{}.p50'.format(name), _percentile(samples, 50), 'ms',
+                   'lower'),
+            Result('{}.p95'.format(name), _percentile(samples, 95), 'ms',
+                   'lower')]
+
+
+def throughput(name, fn, threads, iterations):
+    '''
+    Run `fn` `iterations` times on each of `threads` threads, and report
+    the calls completed per second.
+    '''
+    fn()
+    workers = [threading.Thread(target=lambda: [fn() for _ in
+                                                range(iterations)])
+               for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    return [Result(name, threads * iterations / elapsed, 'ops/s', 'higher')]
+
+
+def memory(name, fn):
+    '''
+    Report the peak of Python allocations made while `fn` runs, in KiB.
+    '''
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return [Result(name, peak / 1024.0, 'KiB', 'lower')]
+
+
+def import_time(name, statement, runs):
+    '''
+    Run `statement` in `runs` fresh interpreters under -X importtime, and
+    report the median time spent importing charms modules, in
+    milliseconds.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    samples = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                               statement], cwd=root, check=True,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE)
+        total = 0
+        for line in proc.stderr.decode('utf-8').splitlines():
+            # import time: self [us] | cumulative | imported package
+            parts = line.split('|')
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            module = parts[2][1:]
+            # only top level imports, nested ones are in their cumulative
+            if module.startswith('charms'):
+                total += int(parts[1])
+        samples.append(total / 1000.0)
+    return [Result(name, _percentile(samples, 50), 'ms', 'lower')]
+
+
+def run_benchmarks(quick=False):
+    '''
+    Run every benchmark and return a list of Results. `quick` cuts the
+    iterations and fixture sizes down, for smoke testing the suite itself.
+    '''
+    n = 3 if quick else 50
+    sizes = None
+    if quick:
+        sizes = {'ps_rows': 5, 'ps_large': 200, 'log_lines': 2000,
+                 'services': 4, 'pull_delay': 0.01}
+    results = []
+    runs = 3 if quick else 15
+    results += import_time('import.charms.docker', 'import charms.docker',
+                           runs)
+    for name in ('Compose', 'Docker', 'DockerOpts'):
+        results += import_time('import.{}'.format(name),
+                               'from charms.docker import {}'.format(name),
+                               runs)
+    with FakeEnvironment(sizes) as env:
+        cli = Docker()
+        api = Docker(socket=env.daemon.url, backend='api')
+        compose = Compose(env.workspace)
+        services = ['svc{}'.format(i) for i in range(env.sizes['services'])]
+
+        results += latency('docker.cli.ps', cli.ps, n)
+        results += latency('docker.api.ps', api.ps, n)
+        results += latency('docker.api.ping', lambda: api.ping(ttl=0), n)
+        results += latency('compose.up', lambda: compose.up('svc0'), n)
+        results += latency('runner.run', lambda: run(
+            'docker-compose ps', env.workspace), n)
+
+        results += throughput('docker.api.ps.threads8', api.ps, 8, n)
+        results += throughput('runner.run.threads8', lambda: run(
+            'docker-compose ps', env.workspace), 8, n)
+        results += throughput(
+            'compose.pull.parallel8',
+            lambda: compose.pull(services, parallelism=8), 1,
+            max(1, n // 10))
+
+        env.use_large_ps()
+        env.ps_body = 'large'
+        results += memory('docker.cli.ps.large', cli.ps)
+        results += memory('docker.api.ps.large', api.ps)
+        results += memory('docker.cli.logs', lambda: cli.logs('web'))
+        results += memory('docker.cli.logs.stream', lambda: sum(
+            1 for _ in cli.logs('web', stream=True)))
+        results += memory('docker.api.logs.stream', lambda: sum(
+            1 for _ in api.logs('web', stream=True)))
+
+        opts = DockerOpts()
+        items = [('label', 'bench-{}'.format(i)) for i in range(100)]
+        defaults = os.path.join(env.tmp, 'docker.default')
+        results += latency('dockeropts.add_many100',
+                           lambda: opts.add_many(items), n)
+        results += latency('dockeropts.render',
+                           lambda: opts.render(defaults), n)
+        api.api.close()
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    Compare results with a stored baseline. Returns a list of rows of
+    (name, unit, baseline value, current value, relative change, status),
+    where status is ok, improved, regressed or new. A change counts once
+    it exceeds `tolerance`, as a fraction of the baseline.
+    '''
+    rows = []
+    for result in results:
+        stored = baseline.get(result.name)
+        if stored is None:
+            rows.append((result.name, result.unit, None, result.value, None,
+                         'new'))
+            continue
+        base = stored['value']
+        change = (result.value - base) / base if base else 0.0
+        worse = change if result.better == 'lower' else -change
+        status = 'ok'
+        if worse > tolerance:
+            status = 'regressed'
+        elif worse < -tolerance:
+            status = 'improved'
+        rows.append((result.name, result.unit, base, result.value, change,
+                     status))
+    return rows
+
+
+def report(rows):
+    lines = ['{:<28} {:>6} {:>12} {:>12} {:>8}  {}'.format(
+        'benchmark', 'unit', 'baseline', 'current', 'change', 'status')]
+    for name, unit, base, value, change, status in rows:
+        lines.append('{:<28} {:>6} {:>12} {:>12.3f} {:>8}  {}'.format(
+            name, unit, '-' if base is None else '{:.3f}'.format(base),
+            value, '-' if change is None else '{:+.0%}'.format(change),
+            status))
+    return '\n'.join(lines)
+
+
+def load_baseline(path=BASELINE):
+    try:
+        with open(path) as f:
+            return json.load(f)['results']
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results, path=BASELINE):
+    doc = {'meta': {'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                             time.gmtime())},
+           'results': dict((r.name, {'value': round(r.value, 4),
+                                     'unit': r.unit, 'better': r.better})
+                           for r in results)}
+    with open(path, 'w') as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='exit 1 if any benchmark regressed')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--quick', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.quick)
+    rows = compare(results, load_baseline(args.baseline), args.tolerance)
+    print(report(rows))
+    if args.save:
+        save_baseline(results, args.baseline)
+    if args.check and any(row[-1] == 'regressed' for row in rows):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
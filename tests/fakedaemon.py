@@ -0,0 +1,146 @@
+'''
+A tiny stand-in for the Docker Engine API, listening on a unix socket
+(or TCP port) in a background thread. Routes are registered per method
+and path, and every request is recorded for later assertions.
+'''
+import json
+import os
+import socketserver
+import struct
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.daemon.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        daemon = self.server.daemon
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        request = {
+            'method': self.command,
+            'path': url.path,
+            'query': {k: v[-1] for k, v in parse_qs(url.query).items()},
+            'headers': dict(self.headers),
+            'body': json.loads(body.decode('utf-8')) if body else None,
+        }
+        daemon.requests.append(request)
+        route = daemon.routes.get((self.command, url.path))
+        if route is None:
+            self._reply(404, {'message': 'no route for {}'.format(url.path)})
+            return
+        status, payload, headers = route(request)
+        self._reply(status, payload, headers)
+
+    def _reply(self, status, payload, headers=None):
+        headers = dict(headers or {})
+        if isinstance(payload, dict) or (
+                isinstance(payload, list) and
+                not all(isinstance(c, bytes) for c in payload)):
+            payload = json.dumps(payload).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if isinstance(payload, bytes):
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        # Anything else is an iterable of chunks, sent chunked encoded
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in payload:
+            if not chunk:
+                continue
+            self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii'))
+            self.wfile.write(chunk + b'\r\n')
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    do_GET = do_POST = do_DELETE = do_HEAD = do_PUT = _handle
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeDaemon:
+    '''
+    ex: with FakeDaemon() as daemon:
+        daemon.route('GET', '/_ping', body=b'OK')
+        Docker(socket=daemon.url, backend='api')
+    '''
+
+    def __init__(self, tcp=False):
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+        self._tmp = None
+        if tcp:
+            self.server = _TCPServer(('127.0.0.1', 0), _Handler)
+            self.url = 'tcp://127.0.0.1:{}'.format(self.server.server_address[1])
+        else:
+            self._tmp = tempfile.mkdtemp()
+            path = os.path.join(self._tmp, 'docker.sock')
+            self.server = _UnixServer(path, _Handler)
+            self.url = 'unix://{}'.format(path)
+        self.server.daemon = self
+
+    def route(self, method, path, status=200, body=b'', headers=None,
+              handler=None):
+        '''
+        Register a canned reply, or a handler(request) returning a tuple
+        of (status, body, headers). Bodies may be bytes, JSON-able objects
+        or a list (or generator) of byte chunks to stream.
+        '''
+        if handler is None:
+            def handler(request):
+                return status, body, headers
+        self.routes[(method, path)] = handler
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._tmp:
+            path = self.url[len('unix://'):]
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rmdir(self._tmp)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def frame(stream, payload):
+    '''
+    Encode a multiplexed stream frame, as used by /logs and /attach
+    '''
+    return struct.pack('>BxxxL', stream, len(payload)) + payload
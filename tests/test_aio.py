@@ -0,0 +1,236 @@
+from charms.docker import AsyncCompose, AsyncDocker
+from charms.docker.aio import run
+from charms.docker.api import APIError
+from charms.docker.containers import Container
+from charms.docker.health import HealthResult
+from mock import AsyncMock, patch
+import asyncio
+import json
+import os
+import pytest
+import subprocess
+import time
+
+
+class TestAsyncRun:
+
+    def test_run_in_workspace(self, tmpdir):
+        out = asyncio.run(run('pwd', str(tmpdir)))
+        assert out.decode().strip() == os.path.realpath(str(tmpdir))
+
+    def test_run_leaves_cwd_alone(self, tmpdir):
+        cwd = os.getcwd()
+        asyncio.run(run(['true'], str(tmpdir)))
+        assert os.getcwd() == cwd
+
+    def test_run_failure(self):
+        with pytest.raises(subprocess.CalledProcessError) as err:
+            asyncio.run(run('false'))
+        assert err.value.returncode == 1
+
+    def test_cancel_kills_process(self, tmpdir):
+        marker = tmpdir.join('alive')
+        cmd = ['sh', '-c', 'sleep 1; touch {}'.format(marker)]
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(run(cmd), 0.3))
+        time.sleep(1.2)
+        assert not marker.check()
+
+    def test_run_concurrently(self):
+        async def many():
+            return await asyncio.gather(*[run(['echo', str(i)])
+                                          for i in range(5)])
+        out = asyncio.run(many())
+        assert [o.strip() for o in out] == [b'0', b'1', b'2', b'3', b'4']
+
+
+class TestAsyncCompose:
+
+    @pytest.fixture
+    def compose(self):
+        return AsyncCompose('files/test', strict=False)
+
+    def test_up(self, compose):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            s.return_value = b'done'
+            assert asyncio.run(compose.up('nginx')) == b'done'
+            s.assert_called_with('docker-compose up -d nginx',
+                                 compose.workspace)
+
+    def test_build(self, compose):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            asyncio.run(compose.build('web', no_cache=True))
+            s.assert_called_with('docker-compose build --force-rm '
+                                 '--no-cache web', compose.workspace)
+
+    def test_up_changed_only(self, tmpdir):
+        tmpdir.join('docker-compose.yml').write(
+            'services:\n  web:\n    image: nginx\nversion: "2"\n')
+        compose = AsyncCompose(str(tmpdir))
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            s.return_value = b'sha256:1\n'
+            plan = asyncio.run(compose.up(changed_only=True))
+            assert plan.added == ['web']
+            s.assert_any_call('docker-compose up -d web', compose.workspace)
+            assert asyncio.run(compose.up(changed_only=True)).empty
+            s.return_value = b'sha256:2\n'
+            assert asyncio.run(compose.plan()).changed == ['web']
+
+    def test_up_waves(self, tmpdir):
+        tmpdir.join('docker-compose.yml').write(
+            'version: "2"\n'
+            'services:\n'
+            '  web:\n'
+            '    depends_on: [db]\n'
+            '  db:\n'
+            '    image: postgres\n')
+        docker = AsyncMock()
+        docker.ps.return_value = [Container(
+            id='6f137adb5d27', name='x', names=['x'], image='img',
+            command='', created=None, state='running', status='Up',
+            labels={}, ports=[], health='healthy')]
+        docker.wait_healthy.return_value = {
+            '6f137adb5d27': HealthResult('6f137adb5d27', 'healthy', 0.1)}
+        compose = AsyncCompose(str(tmpdir), docker=docker)
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            results = asyncio.run(compose.up_waves())
+            s.assert_called_with('docker-compose up -d --no-deps web',
+                                 compose.workspace)
+        assert list(results) == ['db', 'web']
+        assert all(r.ok for r in results.values())
+        assert docker.wait_healthy.call_count == 2
+
+    def test_scale_rolling(self, compose):
+        ids = ['old1']
+
+        async def fake(cmd, workspace):
+            if cmd.startswith('docker rm -f'):
+                ids.remove(cmd.split()[-1])
+            elif '--scale' in cmd:
+                ids.append('new1')
+            return b''
+
+        async def ps(all, filters):
+            return [Container(
+                id=cid, name=cid, names=[cid], image='img', command='',
+                created=None, state='running', status='Up', labels={},
+                ports=[], health=None) for cid in ids]
+
+        compose.docker = AsyncMock()
+        compose.docker.ps.side_effect = ps
+        compose.docker.wait_healthy.return_value = {
+            'new1': HealthResult('new1', 'running', 0.1)}
+        with patch('charms.docker.aio.run', side_effect=fake):
+            result = asyncio.run(compose.scale('web', 1, rolling=True))
+        assert result.ok
+        assert result.started == ['new1']
+        assert ids == ['new1']
+
+    def test_scale_rolling_rolls_back_failure(self, compose):
+        ids = ['old1']
+
+        async def fake(cmd, workspace):
+            if cmd.startswith('docker rm -f'):
+                ids.remove(cmd.split()[-1])
+            elif '--scale' in cmd:
+                ids.append('new1')
+            return b''
+
+        async def ps(all, filters):
+            return [Container(
+                id=cid, name=cid, names=[cid], image='img', command='',
+                created=None, state='running', status='Up', labels={},
+                ports=[], health=None) for cid in ids]
+
+        compose.docker = AsyncMock()
+        compose.docker.ps.side_effect = ps
+        compose.docker.wait_healthy.side_effect = APIError(
+            500, 'boom', 'GET', '/events')
+        with patch('charms.docker.aio.run', side_effect=fake):
+            result = asyncio.run(compose.scale('web', 1, rolling=True))
+        assert isinstance(result.error, APIError)
+        assert result.rolled_back
+        assert ids == ['old1']
+
+    def test_gather(self, compose):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            async def both():
+                await asyncio.gather(compose.pull('db'),
+                                     compose.restart('web'))
+            asyncio.run(both())
+            assert s.call_count == 2
+
+
+class TestAsyncDocker:
+
+    @pytest.fixture
+    def docker(self):
+        return AsyncDocker()
+
+    def test_pull(self, docker):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            asyncio.run(docker.pull('tester/testing'))
+            s.assert_called_with(['docker', 'pull', 'tester/testing'])
+
+    def test_pull_many(self, docker):
+        pinned = 'nginx@sha256:' + 'a' * 64
+
+        async def fake(cmd, workspace=None):
+            if cmd[1] == 'inspect':
+                return '["{}"]'.format(pinned).encode()
+            return b'pulled'
+
+        with patch('charms.docker.aio.run', side_effect=fake) as s:
+            results = asyncio.run(docker.pull_many([pinned, 'redis',
+                                                    'redis:latest']))
+        assert results[pinned].skipped
+        assert results['redis'].output == b'pulled'
+        assert s.call_count == 2
+
+    def test_pull_many_generator(self, docker):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            s.return_value = b'pulled'
+            results = asyncio.run(docker.pull_many(
+                i for i in ['redis', 'nginx']))
+        assert sorted(results) == ['nginx', 'redis']
+
+    def test_run(self, docker):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            asyncio.run(docker.run('nginx', ['-d --name=nginx']))
+            s.assert_called_with(['docker', 'run', '-d', '--name=nginx',
+                                  'nginx'])
+
+    def test_run_failure_raises(self, docker):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            s.side_effect = subprocess.CalledProcessError(125, 'docker run')
+            with pytest.raises(subprocess.CalledProcessError):
+                asyncio.run(docker.run('nginx', ['-d']))
+
+    def test_wait_healthy(self, docker):
+        obj = {'Id': 'a' * 64, 'State': {'Running': False}}
+        event = '{"Action": "start", "Actor": {"ID": "%s"}}' % ('a' * 64)
+        exec_ = asyncio.create_subprocess_exec
+
+        async def events(*cmd, **kwargs):
+            assert cmd[:2] == ('docker', 'events')
+            return await exec_('printf', '%s\\n', event, **kwargs)
+
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s, \
+                patch('asyncio.create_subprocess_exec', side_effect=events):
+            s.return_value = json.dumps([obj]).encode()
+            result = asyncio.run(docker.wait_healthy('web', timeout=5))
+            s.assert_called_with(['docker', 'inspect', '--type',
+                                  'container', 'web'])
+        assert result.status == 'running'
+
+    def test_wait_healthy_missing(self, docker):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            s.side_effect = subprocess.CalledProcessError(1, 'docker inspect')
+            result = asyncio.run(docker.wait_healthy('gone', timeout=5))
+        assert result.status == 'missing'
+
+    def test_logs(self, docker):
+        with patch('charms.docker.aio.run', new_callable=AsyncMock) as s:
+            s.return_value = b'hello\n'
+            assert asyncio.run(docker.logs('6f137adb5d27')) == 'hello\n'
+            s.assert_called_with(['docker', 'logs', '6f137adb5d27'])
@@ -0,0 +1,210 @@
+from charms.docker import Docker
+from charms.docker.api import APIClient, APIConnectionError, APIError
+from mock import patch
+from tests.fakedaemon import FakeDaemon, frame
+import pytest
+
+
+class TestAPIClient:
+
+    @pytest.fixture
+    def daemon(self):
+        with FakeDaemon() as daemon:
+            yield daemon
+
+    def test_get_json(self, daemon):
+        daemon.route('GET', '/containers/json', body=[{'Id': 'abc'}])
+        api = APIClient(daemon.url)
+        assert api.get_json('/containers/json') == [{'Id': 'abc'}]
+
+    def test_connections_are_reused(self, daemon):
+        daemon.route('GET', '/_ping', body=b'OK')
+        api = APIClient(daemon.url)
+        for _ in range(5):
+            assert api.get('/_ping').read() == b'OK'
+        assert daemon.connections == 1
+
+    def test_params_encoding(self, daemon):
+        daemon.route('GET', '/containers/json', body=[])
+        api = APIClient(daemon.url)
+        api.get('/containers/json', params={'all': True, 'limit': None,
+                                            'filters': {'name': ['web']}})
+        query = daemon.requests[-1]['query']
+        assert query == {'all': '1', 'filters': '{"name": ["web"]}'}
+
+    def test_version_prefix(self, daemon):
+        daemon.route('GET', '/v1.24/_ping', body=b'OK')
+        api = APIClient(daemon.url, version='1.24')
+        assert api.get('/_ping').read() == b'OK'
+
+    def test_error_status(self, daemon):
+        daemon.route('GET', '/containers/nope/json', status=404,
+                     body={'message': 'No such container: nope'})
+        api = APIClient(daemon.url)
+        with pytest.raises(APIError) as err:
+            api.get('/containers/nope/json')
+        assert err.value.status == 404
+        assert err.value.message == 'No such container: nope'
+        # the errored connection is still good for the next request
+        daemon.route('GET', '/_ping', body=b'OK')
+        api.get('/_ping')
+        assert daemon.connections == 1
+
+    def test_streamed_json(self, daemon):
+        chunks = [b'{"status": "a"}\n', b'{"status"', b': "b"}\n']
+        daemon.route('POST', '/images/create', body=chunks)
+        api = APIClient(daemon.url)
+        resp = api.post('/images/create', stream=True)
+        assert [m['status'] for m in resp.iter_json()] == ['a', 'b']
+
+    def test_multiplexed_frames(self, daemon):
+        body = [frame(1, b'out\n'), frame(2, b'err\n')]
+        daemon.route('GET', '/containers/abc/logs', body=body)
+        api = APIClient(daemon.url)
+        resp = api.get('/containers/abc/logs', stream=True)
+        assert list(resp.iter_frames()) == [(1, b'out\n'), (2, b'err\n')]
+
+    def test_raw_stream_frames(self, daemon):
+        daemon.route('GET', '/containers/abc/logs', body=b'tty output\n')
+        api = APIClient(daemon.url)
+        resp = api.get('/containers/abc/logs', stream=True)
+        assert b''.join(p for s, p in resp.iter_frames()) == b'tty output\n'
+
+    def test_tcp(self):
+        with FakeDaemon(tcp=True) as daemon:
+            daemon.route('GET', '/_ping', body=b'OK')
+            assert APIClient(daemon.url).get('/_ping').read() == b'OK'
+
+    def test_connection_error(self, tmpdir):
+        api = APIClient('unix://{}/missing.sock'.format(tmpdir))
+        with pytest.raises(APIConnectionError):
+            api.get('/_ping')
+
+    def test_unsupported_scheme(self):
+        with pytest.raises(ValueError):
+            APIClient('ssh://host')
+
+
+class TestDockerAPIBackend:
+
+    @pytest.fixture
+    def daemon(self):
+        with FakeDaemon() as daemon:
+            yield daemon
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            Docker(backend='carrier-pigeon')
+
+    def test_ps(self, daemon):
+        daemon.route('GET', '/containers/json', body=[{
+            'Id': 'abc', 'Names': ['/db/alias', '/web'], 'Image': 'nginx',
+            'State': 'running', 'Labels': {'a': 'b'}, 'Created': 1}])
+        docker = Docker(socket=daemon.url, backend='api')
+        containers = docker.ps(filters={'name': 'web'}, limit=3)
+        assert containers[0].id == 'abc'
+        assert containers[0].name == 'web'
+        assert containers[0].labels == {'a': 'b'}
+        assert daemon.requests[-1]['query'] == {
+            'limit': '3', 'filters': '{"name": ["web"]}'}
+        assert docker.ps(quiet=True) == ['abc']
+        assert docker.ps(all=True, count=True) == 1
+        assert daemon.requests[-1]['query'] == {'all': '1'}
+
+    def test_logs(self, daemon):
+        body = [frame(1, b'hello '), frame(2, b'world\n')]
+        daemon.route('GET', '/containers/abc/logs', body=body)
+        docker = Docker(socket=daemon.url, backend='api')
+        assert docker.logs('abc') == 'hello world\n'
+
+    def test_logs_stream(self, daemon):
+        body = [frame(1, b'caf\xc3'), frame(2, b'oops\n'),
+                frame(1, b'\xa9\n')]
+        daemon.route('GET', '/containers/abc/logs', body=body)
+        docker = Docker(socket=daemon.url, backend='api')
+        lines = list(docker.logs('abc', follow=True, tail=5))
+        assert lines == [('stderr', 'oops'), ('stdout', 'caf\u00e9')]
+        assert daemon.requests[-1]['query'] == {
+            'stdout': '1', 'stderr': '1', 'follow': '1', 'tail': '5'}
+
+    def test_pull(self, daemon):
+        daemon.route('POST', '/images/create',
+                     body=[b'{"status": "Pulling"}\n'])
+        docker = Docker(socket=daemon.url, backend='api')
+        docker.pull('localhost:5000/app:1.0')
+        assert daemon.requests[-1]['query'] == {
+            'fromImage': 'localhost:5000/app', 'tag': '1.0'}
+
+    def test_pull_error(self, daemon):
+        daemon.route('POST', '/images/create',
+                     body=[b'{"error": "manifest unknown"}\n'])
+        docker = Docker(socket=daemon.url, backend='api')
+        with pytest.raises(APIError):
+            docker.pull('nginx')
+
+    def test_login_sends_auth_with_pulls(self, daemon):
+        daemon.route('POST', '/auth', body={'Status': 'Login Succeeded'})
+        daemon.route('POST', '/images/create', body=[b'{}\n'])
+        docker = Docker(socket=daemon.url, backend='api')
+        docker.login('cloudguru', 'XXX', 'obrien@ds9.org')
+        assert daemon.requests[-1]['body']['username'] == 'cloudguru'
+        docker.pull('nginx')
+        assert 'X-Registry-Auth' in daemon.requests[-1]['headers']
+
+    def test_run_detached(self, daemon):
+        daemon.route('POST', '/containers/create', body={'Id': 'abc'})
+        daemon.route('POST', '/containers/abc/start', status=204)
+        docker = Docker(socket=daemon.url, backend='api')
+        cid = docker.run('nginx', ['-d --name=web -p 8000:80 -e A=b',
+                                   '-v /tmp:/tmp --restart always'])
+        assert cid == 'abc'
+        create = daemon.requests[0]
+        assert create['query'] == {'name': 'web'}
+        assert create['body']['Image'] == 'nginx'
+        assert create['body']['Env'] == ['A=b']
+        host = create['body']['HostConfig']
+        assert host['Binds'] == ['/tmp:/tmp']
+        assert host['PortBindings'] == {'80/tcp': [{'HostPort': '8000'}]}
+        assert host['RestartPolicy'] == {'Name': 'always'}
+
+    def test_run_attached(self, daemon):
+        daemon.route('POST', '/containers/create', body={'Id': 'abc'})
+        daemon.route('POST', '/containers/abc/start', status=204)
+        daemon.route('GET', '/containers/abc/logs',
+                     body=[frame(1, b'file1\n'), frame(2, b'warning\n')])
+        daemon.route('POST', '/containers/abc/wait', body={'StatusCode': 0})
+        docker = Docker(socket=daemon.url, backend='api')
+        assert docker.run('ubuntu', commands=['ls']) == b'file1\n'
+        assert daemon.requests[0]['body']['Cmd'] == ['ls']
+
+    def test_run_unknown_option_uses_cli(self, daemon):
+        docker = Docker(socket=daemon.url, backend='api')
+        with patch('subprocess.check_output') as spmock:
+            docker.run('nginx', ['--cpuset-cpus=0'])
+            spmock.assert_called_with(['docker', 'run', '--cpuset-cpus=0',
+                                       'nginx'])
+        assert daemon.requests == []
+
+    @pytest.mark.parametrize('publish', [
+        '8000-8010:80-90', '80-90', '[::1]:8000:80', '8000:80/quic',
+        'localhost:http:80', '1:2:3:4'])
+    def test_run_unsupported_publish_uses_cli(self, daemon, publish):
+        docker = Docker(socket=daemon.url, backend='api')
+        with patch('subprocess.check_output') as spmock:
+            docker.run('nginx', ['-d -p {}'.format(publish)])
+            spmock.assert_called_with(['docker', 'run', '-d', '-p', publish,
+                                       'nginx'])
+        assert daemon.requests == []
+
+    def test_auto_falls_back_to_cli(self, tmpdir):
+        docker = Docker(socket='unix://{}/missing.sock'.format(tmpdir),
+                        backend='auto')
+        with patch('subprocess.check_output') as spmock:
+            docker.pull('nginx')
+            spmock.assert_called_with(['docker', 'pull', 'nginx'])
+
+    def test_api_does_not_fall_back(self, tmpdir):
+        docker = Docker(socket='unix://{}/missing.sock'.format(tmpdir),
+                        backend='api')
+        with pytest.raises(APIConnectionError):
+            docker.pull('nginx')
@@ -0,0 +1,39 @@
+from tests import bench
+import json
+import os
+
+
+class TestBench:
+
+    def test_quick_run(self):
+        environ = dict(os.environ)
+        results = bench.run_benchmarks(quick=True)
+        names = [r.name for r in results]
+        assert 'docker.cli.ps.p50' in names
+        assert 'compose.pull.parallel8' in names
+        assert 'docker.api.logs.stream' in names
+        assert 'import.charms.docker' in names
+        assert all(r.value > 0 for r in results)
+        assert dict(os.environ) == environ
+
+    def test_compare(self):
+        results = [bench.Result('a', 1.5, 'ms', 'lower'),
+                   bench.Result('b', 50.0, 'ops/s', 'higher'),
+                   bench.Result('c', 1.0, 'ms', 'lower'),
+                   bench.Result('d', 1.0, 'KiB', 'lower')]
+        baseline = {'a': {'value': 1.0}, 'b': {'value': 100.0},
+                    'c': {'value': 2.0}}
+        status = dict((row[0], row[-1])
+                      for row in bench.compare(results, baseline))
+        assert status == {'a': 'regressed', 'b': 'regressed',
+                          'c': 'improved', 'd': 'new'}
+        assert 'regressed' in bench.report(bench.compare(results, baseline))
+
+    def test_baseline_roundtrip(self, tmpdir):
+        path = str(tmpdir.join('baseline.json'))
+        assert bench.load_baseline(path) == {}
+        bench.save_baseline([bench.Result('a', 1.23456, 'ms', 'lower')],
+                            path)
+        assert bench.load_baseline(path)['a']['value'] == 1.2346
+        with open(path) as f:
+            assert 'meta' in json.load(f)
@@ -0,0 +1,96 @@
+from charms.docker import ContainerStateCache, Docker
+from tests.fakedaemon import FakeDaemon
+import json
+import pytest
+import time
+
+
+INSPECT = {
+    'Id': 'bbb', 'Name': '/worker', 'Created': '2016-03-23T06:29:35.1Z',
+    'Config': {'Image': 'worker:1', 'Cmd': ['run'],
+               'Labels': {'tier': 'back'}},
+    'State': {'Status': 'created'},
+}
+
+
+class TestContainerStateCache:
+
+    @pytest.fixture
+    def daemon(self):
+        with FakeDaemon() as daemon:
+            daemon.route('GET', '/containers/json', body=[
+                {'Id': 'aaa', 'Names': ['/web'], 'Image': 'nginx',
+                 'State': 'running', 'Status': 'Up 1 minute',
+                 'Labels': {'tier': 'front', 'app': 'site'}}])
+            daemon.route('GET', '/images/json', body=[
+                {'Id': 'sha256:1', 'RepoTags': ['nginx:latest'],
+                 'RepoDigests': ['nginx@sha256:abc']}])
+            daemon.route('GET', '/networks', body=[
+                {'Id': 'n1', 'Name': 'bridge'}])
+            daemon.route('GET', '/containers/bbb/json', body=INSPECT)
+            yield daemon
+
+    @pytest.fixture
+    def cache(self, daemon):
+        docker = Docker(socket=daemon.url, backend='api')
+        return ContainerStateCache(docker).seed()
+
+    def test_seed(self, cache):
+        assert len(cache) == 1
+        assert cache.get('web').id == 'aaa'
+        assert cache.get('aaa').name == 'web'
+        assert 'web' in cache
+        assert [c.id for c in cache.by_label('tier', 'front')] == ['aaa']
+        assert [c.id for c in cache.by_label('app')] == ['aaa']
+        assert cache.image('nginx')['Id'] == 'sha256:1'
+        assert cache.image('nginx@sha256:abc')['Id'] == 'sha256:1'
+        assert cache.network('bridge')['Id'] == 'n1'
+        assert cache.since is not None
+
+    def test_state_events(self, cache):
+        cache.apply({'Type': 'container', 'Action': 'die',
+                     'Actor': {'ID': 'aaa'}, 'timeNano': 10})
+        assert cache.get('web').state == 'exited'
+        cache.apply({'Type': 'container', 'Action': 'health_status: healthy',
+                     'Actor': {'ID': 'aaa'}})
+        assert cache.get('web').health == 'healthy'
+        cache.apply({'Type': 'container', 'Action': 'destroy',
+                     'Actor': {'ID': 'aaa'}})
+        assert cache.get('web') is None
+        assert cache.by_label('tier') == []
+
+    def test_create_inspects(self, cache):
+        cache.apply({'Type': 'container', 'Action': 'create',
+                     'Actor': {'ID': 'bbb'}})
+        worker = cache.get('worker')
+        assert worker.image == 'worker:1'
+        assert worker.state == 'created'
+        assert [c.id for c in cache.by_label('tier', 'back')] == ['bbb']
+
+    def test_image_and_network_events(self, cache):
+        cache.apply({'Type': 'image', 'Action': 'delete',
+                     'Actor': {'ID': 'sha256:1'}})
+        assert cache.image('nginx') is None
+        cache.apply({'Type': 'network', 'Action': 'destroy',
+                     'Actor': {'ID': 'n1'}})
+        assert cache.network('bridge') is None
+
+    def test_follow_events(self, daemon, cache):
+        event = {'Type': 'container', 'Action': 'create',
+                 'Actor': {'ID': 'bbb'}, 'timeNano': 1459000000000000001}
+        daemon.route('GET', '/events',
+                     body=[json.dumps(event).encode('utf-8') + b'\n'])
+        cache.reconnect_delay = 0.01
+        cache.start()
+        try:
+            deadline = time.time() + 5
+            while 'worker' not in cache and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            cache.stop()
+        assert cache.get('worker').id == 'bbb'
+        query = [r['query'] for r in daemon.requests
+                 if r['path'] == '/events'][0]
+        assert json.loads(query['filters']) == {
+            'type': ['container', 'image', 'network']}
+        assert 'until' in query
@@ -1,6 +1,12 @@
-from charms.docker import Docker
+from charms.docker import ContainerSpec, Docker
+from charms.docker.api import quote_path
+from charms.docker.docker import _stream_process
+from charms.docker.streams import LogLine
 from mock import patch
+from tests.fakedaemon import FakeDaemon
 import pytest
+import subprocess
+import time
 
 
 class TestDocker:
@@ -23,14 +29,101 @@ class TestDocker:
         docker = Docker(socket="tcp://127.0.0.1:2357")
         assert docker.socket == "tcp://127.0.0.1:2357"
 
+    def test_pull_many(self, docker):
+        pinned = 'nginx@sha256:' + 'a' * 64
+        stale = 'redis@sha256:' + 'b' * 64
+
+        def fake(cmd, **kwargs):
+            if cmd[1] == 'inspect':
+                if cmd[-1] == pinned:
+                    return '["nginx@{}"]'.format(
+                        pinned.partition('@')[2]).encode()
+                raise subprocess.CalledProcessError(1, cmd)
+            if cmd[-1] == 'broken':
+                raise subprocess.CalledProcessError(1, cmd)
+            return b'pulled ' + cmd[-1].encode()
+
+        with patch('subprocess.check_output', side_effect=fake) as spmock:
+            results = docker.pull_many(
+                ['busybox', pinned, 'busybox:latest', stale, 'broken'],
+                parallelism=2)
+        pulls = [c[0][0][-1] for c in spmock.call_args_list
+                 if c[0][0][1] == 'pull']
+        assert sorted(pulls) == sorted(['busybox', stale, 'broken'])
+        assert list(results) == ['busybox', pinned, 'busybox:latest', stale,
+                                 'broken']
+        assert results['busybox'] is results['busybox:latest']
+        assert results['busybox'].output == b'pulled busybox'
+        assert results[pinned].skipped
+        assert not results[stale].skipped and results[stale].ok
+        assert not results['broken'].ok
+        assert all(r.duration >= 0 for r in results.values())
+
+    def test_pull_many_api(self):
+        pinned = 'nginx@sha256:' + 'a' * 64
+        with FakeDaemon() as daemon:
+            daemon.route('GET', '/images/{}/json'.format(quote_path(pinned)),
+                         body={'RepoDigests': [
+                             'docker.io/library/' + pinned]})
+            daemon.route('POST', '/images/create',
+                         body=[b'{"status": "done"}'])
+            docker = Docker(socket=daemon.url, backend='api')
+            results = docker.pull_many([pinned, 'redis:3'])
+            assert results[pinned].skipped
+            assert results['redis:3'].ok
+            creates = [r for r in daemon.requests
+                       if r['path'] == '/images/create']
+            assert [r['query']['fromImage'] for r in creates] == ['redis']
+
+    def test_pull_many_generator(self, docker):
+        with patch('subprocess.check_output') as spmock:
+            spmock.return_value = b'pulled'
+            results = docker.pull_many(i for i in ['redis', 'nginx'])
+        assert sorted(results) == ['nginx', 'redis']
+
+    def test_pull_many_rejects_zero_parallelism(self, docker):
+        with pytest.raises(ValueError):
+            docker.pull_many(['redis'], parallelism=0)
+
     def test_docker_init_workspace(self):
         devel = Docker(workspace="files/tmp")
         assert "{}".format(devel.workspace) == "files/tmp"
 
-    def test_running(self, bootstrap):
-        with patch('os.path.isfile') as isfilemock:
-            isfilemock.return_value = True
+    def test_running(self):
+        with FakeDaemon() as daemon:
+            daemon.route('GET', '/_ping', body=b'OK',
+                         headers={'Api-Version': '1.24'})
+            bootstrap = Docker(socket=daemon.url)
             assert bootstrap.running() is True
+            ping = bootstrap.ping()
+            assert ping.api_version == '1.24'
+            assert ping.latency >= 0
+            # cached within the ttl
+            assert len(daemon.requests) == 1
+            bootstrap.ping(ttl=0)
+            assert len(daemon.requests) == 2
+
+    def test_running_tcp(self):
+        with FakeDaemon(tcp=True) as daemon:
+            daemon.route('GET', '/_ping', body=b'OK')
+            assert Docker(socket=daemon.url).running() is True
+
+    def test_not_running(self, bootstrap, tmpdir):
+        docker = Docker(socket='unix://{}/docker.sock'.format(tmpdir))
+        ping = docker.ping()
+        assert ping.ok is False
+        assert ping.error is not None
+        assert docker.running() is False
+
+    def test_ping_timeout(self):
+        with FakeDaemon() as daemon:
+            def slow(request):
+                time.sleep(0.5)
+                return 200, b'OK', None
+            daemon.route('GET', '/_ping', handler=slow)
+            ping = Docker(socket=daemon.url).ping(timeout=50)
+            assert ping.ok is False
+            assert ping.latency < 400
 
     def test_run(self, docker):
         with patch('subprocess.check_output') as spmock:
@@ -40,11 +133,282 @@ class TestDocker:
             spmock.assert_called_with(['docker', 'run', '-d', '--name=nginx',
                                        'nginx'])
 
+    def test_run_raise_on_failure(self, docker):
+        with patch('subprocess.check_output') as spmock:
+            spmock.side_effect = subprocess.CalledProcessError(125, 'run')
+            assert docker.run('nginx') is None
+            with pytest.raises(subprocess.CalledProcessError):
+                docker.run('nginx', raise_on_failure=True)
+
+    def test_run_many(self, docker):
+        def fake(cmd):
+            name = cmd[cmd.index('--name') + 1]
+            if name == 'worker-2':
+                raise subprocess.CalledProcessError(125, cmd)
+            return '{}-id\n'.format(name).encode()
+
+        specs = [ContainerSpec('worker', name='worker-{}'.format(i),
+                               command='serve --port 80',
+                               env={'B': '2', 'A': '1'},
+                               labels={'unit': 'w/0'},
+                               options=['-v /tmp:/tmp'])
+                 for i in range(4)]
+        with patch('subprocess.check_output', side_effect=fake) as spmock:
+            results = docker.run_many(specs, parallelism=2)
+        assert spmock.call_count == 4
+        spmock.assert_any_call(['docker', 'run', '-d', '-v', '/tmp:/tmp',
+                                '--name', 'worker-0', '-e', 'A=1',
+                                '-e', 'B=2', '--label', 'unit=w/0',
+                                'worker', 'serve', '--port', '80'])
+        assert [r.container_id for r in results] == [
+            'worker-0-id', 'worker-1-id', None, 'worker-3-id']
+        assert [r.ok for r in results] == [True, True, False, True]
+        assert results[2].spec is specs[2]
+
+    def test_run_many_rollback(self, docker):
+        def fake(cmd):
+            if cmd[-1] == 'broken':
+                raise subprocess.CalledProcessError(125, cmd)
+            return b'abc\n'
+
+        with patch('subprocess.check_output', side_effect=fake), \
+                patch('subprocess.check_call') as rm:
+            results = docker.run_many([{'image': 'nginx'},
+                                       {'image': 'broken'}], rollback=True)
+            rm.assert_called_with(['docker', 'rm', '--force', 'abc'])
+        assert results[0].rolled_back and not results[0].ok
+        assert not results[1].rolled_back and results[1].error
+
+    def test_run_many_failed_rollback(self, docker):
+        def fake(cmd):
+            if cmd[-1] == 'broken':
+                raise subprocess.CalledProcessError(125, cmd)
+            return b'abc\n'
+
+        rm_error = subprocess.CalledProcessError(1, 'docker rm')
+        with patch('subprocess.check_output', side_effect=fake), \
+                patch('subprocess.check_call', side_effect=rm_error):
+            results = docker.run_many([{'image': 'nginx'},
+                                       {'image': 'broken'}], rollback=True)
+        assert results[0].container_id == 'abc'
+        assert results[0].error is rm_error
+        assert not results[0].rolled_back and not results[0].ok
+        assert results[1].error is not rm_error
+
+    def test_run_many_api(self):
+        with FakeDaemon() as daemon:
+            daemon.route('POST', '/containers/create',
+                         body={'Id': '6f137adb5d27'})
+            daemon.route('POST', '/containers/6f137adb5d27/start',
+                         status=204)
+            docker = Docker(socket=daemon.url, backend='api')
+            results = docker.run_many([ContainerSpec(
+                'nginx', name='web', env={'A': '1'}, labels={'x': 'y'})])
+            assert results[0].container_id == '6f137adb5d27'
+            create = daemon.requests[0]
+            assert create['query']['name'] == 'web'
+            assert create['body']['Env'] == ['A=1']
+            assert create['body']['Labels'] == {'x': 'y'}
+
+    def test_rm(self, docker):
+        with patch('subprocess.check_call') as spmock:
+            docker.rm('web', volumes=True)
+            spmock.assert_called_with(['docker', 'rm', '--volumes', 'web'])
+
     def test_logs(self, docker):
         with patch('subprocess.check_output') as spmock:
             docker.logs('6f137adb5d27')
             spmock.assert_called_with(['docker', 'logs', '6f137adb5d27'])
 
+    def test_logs_decodes_utf8(self, docker):
+        with patch('subprocess.check_output') as spmock:
+            spmock.return_value = 'caf\u00e9\n'.encode('utf-8')
+            assert docker.logs('6f137adb5d27') == 'caf\u00e9\n'
+
+    def test_logs_options(self, docker):
+        with patch('subprocess.check_output') as spmock:
+            docker.logs('6f137adb5d27', since=1459000000, tail=10,
+                        timestamps=True)
+            spmock.assert_called_with(['docker', 'logs', '--since',
+                                       '1459000000', '--tail', '10',
+                                       '--timestamps', '6f137adb5d27'])
+
+    def test_logs_follow_streams(self, docker):
+        with patch('charms.docker.docker._stream_process') as spmock:
+            docker.logs('6f137adb5d27', follow=True)
+            spmock.assert_called_with(['docker', 'logs', '--follow',
+                                       '6f137adb5d27'], 65536)
+
+    def test_stream_process(self):
+        lines = _stream_process(['sh', '-c', 'echo a; echo b >&2'], 1024)
+        assert sorted(lines) == [LogLine('stderr', 'b'),
+                                 LogLine('stdout', 'a')]
+
+    def test_stream_process_failure(self):
+        lines = _stream_process(['sh', '-c', 'echo a; exit 3'], 1024)
+        assert next(lines) == LogLine('stdout', 'a')
+        with pytest.raises(subprocess.CalledProcessError):
+            next(lines)
+
+    def test_stream_process_close_kills(self):
+        lines = _stream_process(['sh', '-c', 'echo a; sleep 30'], 1024)
+        assert next(lines) == LogLine('stdout', 'a')
+        lines.close()
+
+    def test_stream_process_starts_lazily(self):
+        with patch('subprocess.Popen') as popen:
+            lines = _stream_process(['docker', 'events'], 1024)
+            del lines
+            assert not popen.called
+            with patch('charms.docker.docker._stream_process',
+                       wraps=_stream_process):
+                Docker().logs('web', follow=True)
+            assert not popen.called
+
+    def test_ps(self, docker):
+        row = ('{"ID": "6f137adb5d27", "Image": "nginx", "Command": '
+               '"\\"nginx -g\\"", "CreatedAt": '
+               '"2016-03-23 06:29:35 +0000 UTC", "Names": "web", '
+               '"Labels": "a=b,c=", "Ports": "0.0.0.0:8000->80/tcp", '
+               '"Status": "Up 3 minutes"}\n')
+        with patch('subprocess.check_output') as spmock:
+            spmock.return_value = row.encode('utf-8')
+            containers = docker.ps()
+            spmock.assert_called_with(['docker', 'ps', '--no-trunc',
+                                       '--format', '{{json .}}'])
+        c = containers[0]
+        assert c.id == '6f137adb5d27'
+        assert c.name == 'web'
+        assert c.state == 'running'
+        assert c.created == 1458714575
+        assert c.labels == {'a': 'b', 'c': ''}
+        assert c.ports == [{'IP': '0.0.0.0', 'PublicPort': 8000,
+                            'PrivatePort': 80, 'Type': 'tcp'}]
+
+    def test_ps_filters(self, docker):
+        with patch('subprocess.check_output') as spmock:
+            spmock.return_value = b'aaa\nbbb\n'
+            ids = docker.ps(all=True, limit=5, quiet=True,
+                            filters={'label': ['a=b', 'c'],
+                                     'status': 'exited'})
+            spmock.assert_called_with(['docker', 'ps', '--no-trunc', '--all',
+                                       '--filter', 'label=a=b',
+                                       '--filter', 'label=c',
+                                       '--filter', 'status=exited',
+                                       '--last', '5', '--quiet'])
+        assert ids == ['aaa', 'bbb']
+
+    def test_ps_count(self, docker):
+        with patch('subprocess.check_output') as spmock:
+            spmock.return_value = b'aaa\nbbb\n'
+            assert docker.ps(count=True) == 2
+
+    def test_inspect(self, docker):
+        with patch('subprocess.check_output') as spmock:
+            spmock.return_value = b'[{"Id": "6f137adb5d27"}]'
+            assert docker.inspect('web') == {'Id': '6f137adb5d27'}
+            spmock.assert_called_with(['docker', 'inspect', '--type',
+                                       'container', 'web'])
+
+    def test_wait_healthy(self, docker):
+        starting = {'Id': 'a' * 64, 'Config': {'Healthcheck': {
+            'Test': ['CMD', 'true']}}, 'State': {
+            'Running': True, 'Health': {'Status': 'starting'}}}
+        healthy = dict(starting, Id='b' * 64, State={
+            'Running': True, 'Health': {'Status': 'healthy'}})
+        seen = []
+
+        def events(**kwargs):
+            seen.append(kwargs)
+            yield {'Action': 'health_status: healthy',
+                   'Actor': {'ID': 'a' * 64}}
+            raise AssertionError('read past the last pending container')
+
+        with patch.object(docker, 'inspect') as inspect, \
+                patch.object(docker, 'events', side_effect=events):
+            inspect.side_effect = lambda c: {'web': starting,
+                                             'db': healthy}[c]
+            results = docker.wait_healthy(['web', 'db'], timeout=10)
+        assert results['web'].status == 'healthy'
+        assert results['db'].ok
+        assert seen[0]['filters'] == {
+            'type': 'container', 'event': ['start', 'die', 'health_status'],
+            'container': ['a' * 64]}
+        assert float(seen[0]['until']) - float(seen[0]['since']) == \
+            pytest.approx(10)
+
+    def test_wait_healthy_timeout(self, docker):
+        starting = {'Id': 'a' * 64, 'State': {'Running': False}}
+        with patch.object(docker, 'inspect', return_value=starting), \
+                patch.object(docker, 'events', return_value=(e for e in [])):
+            result = docker.wait_healthy('web', timeout=0)
+        assert result.status == 'timeout'
+        assert not result.ok
+
+    def test_wait_healthy_missing(self, docker):
+        running = {'Id': 'a' * 64, 'State': {'Running': True}}
+
+        def inspect(container):
+            if container == 'gone':
+                raise subprocess.CalledProcessError(1, 'docker inspect')
+            return running
+
+        with patch.object(docker, 'inspect', side_effect=inspect), \
+                patch.object(docker, 'events') as events:
+            results = docker.wait_healthy(['web', 'gone'], timeout=10)
+        assert results['web'].status == 'running'
+        assert results['gone'].status == 'missing'
+        assert not results['gone'].ok
+        assert not events.called
+
+    def test_tail_many(self, docker):
+        popen = subprocess.Popen
+        cmds = []
+
+        def fake(cmd, **kwargs):
+            cmds.append(cmd)
+            stamp = {'web': '12:00:02', 'db': '12:00:01'}[cmd[-1]]
+            return popen(['echo', '2016-05-06T{}Z {} up'.format(
+                stamp, cmd[-1])], **kwargs)
+
+        with patch('subprocess.Popen', side_effect=fake):
+            lines = list(docker.tail_many(['web', 'db'], since=10, tail=5,
+                                          follow=False))
+        assert [(l.container, l.text) for l in lines] == [
+            ('db', 'db up'), ('web', 'web up')]
+        assert cmds[0] == ['docker', 'logs', '--timestamps', '--since',
+                           '10', '--tail', '5', 'web']
+
+    def test_tail_many_cleans_up(self, docker):
+        popen = subprocess.Popen
+        started = []
+
+        def fake(cmd, **kwargs):
+            if cmd[-1] == 'broken':
+                raise OSError('no docker')
+            started.append(popen(['sleep', '30'], **kwargs))
+            return started[-1]
+
+        with patch('subprocess.Popen', side_effect=fake):
+            lines = docker.tail_many(['web', 'db'])
+            del lines
+            assert not started
+            with pytest.raises(OSError):
+                next(docker.tail_many(['web', 'broken']))
+        assert len(started) == 1
+        assert started[0].poll() is not None
+
+    def test_events(self, docker):
+        with patch('charms.docker.docker._stream_process') as spmock:
+            spmock.return_value = iter([LogLine('stdout', '{"Action": "x"}'),
+                                        LogLine('stdout', '')])
+            events = docker.events(since=10, filters={'type': 'container'})
+            assert list(events) == [{'Action': 'x'}]
+            spmock.assert_called_with(['docker', 'events', '--format',
+                                       '{{json .}}', '--since', '10',
+                                       '--filter', 'type=container'],
+                                      1048576)
+
     def test_login(self, docker):
         with patch('subprocess.check_call') as spmock:
             docker.login('cloudguru', 'XXX', 'obrien@ds9.org')
@@ -1,6 +1,22 @@
 from charms.docker import Compose
-from mock import patch
+from charms.docker.api import APIError
+from charms.docker.containers import Container
+from charms.docker.health import HealthResult
+from charms.docker.project import DependencyCycleError
+from charms.docker.runner import run, set_executor
+from mock import Mock, patch
+import asyncio
+import os
 import pytest
+import subprocess
+import threading
+import time
+
+
+def _container(service, health=None, state='running'):
+    return Container(id='{}_1'.format(service), name=service, names=[service],
+                     image='img', command='', created=None, state=state,
+                     status='Up', labels={}, ports=[], health=health)
 
 
 class TestCompose:
@@ -117,23 +133,478 @@ class TestCompose:
             expect = 'docker-compose stop -t 10 nginx'
             s.assert_called_with(expect, compose.workspace)
 
-    @patch('charms.docker.runner.chdir')
-    @patch('charms.docker.runner.check_output')
-    def test_run(self, ccmock, chmock):
+    def test_pull_many(self, compose):
+        with patch('charms.docker.compose.run') as s:
+            s.return_value = b'pulled'
+            results = compose.pull(['web', 'db', 'web'])
+            assert list(results) == ['web', 'db']
+            assert all(r.ok and r.output == b'pulled'
+                       for r in results.values())
+            s.assert_any_call('docker-compose pull web', compose.workspace)
+            s.assert_any_call('docker-compose pull db', compose.workspace)
+            assert s.call_count == 2
+
+    def test_build_many_collects_failures(self, compose):
+        def fake(cmd, workspace):
+            if cmd.endswith('broken'):
+                raise subprocess.CalledProcessError(1, cmd)
+            return b'built'
+
+        with patch('charms.docker.compose.run', side_effect=fake) as s:
+            results = compose.build(['web', 'broken'], no_cache=True)
+            assert results['web'].ok
+            assert not results['broken'].ok
+            assert results['broken'].error.returncode == 1
+            s.assert_any_call('docker-compose build --force-rm --no-cache web',
+                              compose.workspace)
+
+    def test_many_respects_parallelism(self, compose):
+        state = {'running': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def fake(cmd, workspace):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+
+        services = ['svc{}'.format(i) for i in range(12)]
+        with patch('charms.docker.compose.run', side_effect=fake):
+            results = compose.up(services, parallelism=3)
+        assert len(results) == 12
+        assert state['peak'] == 3
+
+    def test_restart_many(self, compose):
+        with patch('charms.docker.compose.run') as s:
+            compose.restart(('web',))
+            s.assert_called_with('docker-compose restart web',
+                                 compose.workspace)
+
+    def test_many_goes_through_the_executor(self, compose):
+        executor = Mock()
+        executor.run.return_value = b''
+        previous = set_executor(executor)
+        try:
+            results = compose.pull(['web', 'db'])
+        finally:
+            set_executor(previous)
+        assert all(r.ok for r in results.values())
+        executor.run.assert_any_call(['docker-compose', 'pull', 'web'],
+                                     cwd='files/test', timeout=None,
+                                     on_stdout=None, on_stderr=None)
+        assert executor.run.call_count == 2
+
+    def test_many_collects_timeouts(self, compose):
+        with patch('charms.docker.compose.run') as s:
+            s.side_effect = subprocess.TimeoutExpired('pull', 1)
+            results = compose.pull(['web'])
+        assert isinstance(results['web'].error, subprocess.TimeoutExpired)
+
+    def test_many_inside_a_running_loop(self, compose):
+        async def from_coroutine():
+            return compose.pull(['web', 'db'])
+
+        with patch('charms.docker.compose.run') as s:
+            results = asyncio.run(from_coroutine())
+            assert s.call_count == 2
+        assert all(r.ok for r in results.values())
+
+    def test_many_rejects_zero_parallelism(self, compose):
+        with pytest.raises(ValueError):
+            compose.pull(['web'], parallelism=0)
+
+    @pytest.fixture
+    def formation(self, tmpdir):
+        tmpdir.join('docker-compose.yml').write(
+            'version: "2"\n'
+            'services:\n'
+            '  web:\n'
+            '    build: ./web\n'
+            '  api:\n'
+            '    build:\n'
+            '      context: ./api\n'
+            '  db:\n'
+            '    image: postgres\n')
+        tmpdir.mkdir('web').join('Dockerfile').write('FROM nginx\n')
+        tmpdir.mkdir('api').join('Dockerfile').write('FROM python\n')
+        return tmpdir
+
+    def test_build_skip_unchanged(self, formation):
+        compose = Compose(str(formation))
+        with patch('charms.docker.compose.run') as s:
+            compose.build(skip_unchanged=True)
+            s.assert_called_with('docker-compose build --force-rm web api',
+                                 compose.workspace)
+            s.reset_mock()
+            assert compose.build(skip_unchanged=True) is None
+            assert not s.called
+            formation.join('api', 'app.py').write('print(1)\n')
+            compose.build(skip_unchanged=True)
+            s.assert_called_with('docker-compose build --force-rm api',
+                                 compose.workspace)
+
+    def test_build_skip_unchanged_failure_is_not_recorded(self, formation):
+        compose = Compose(str(formation))
+        with patch('charms.docker.compose.run') as s:
+            s.side_effect = subprocess.CalledProcessError(1, 'build')
+            with pytest.raises(subprocess.CalledProcessError):
+                compose.build('web', skip_unchanged=True)
+            s.side_effect = None
+            compose.build('web', skip_unchanged=True)
+            s.assert_called_with('docker-compose build --force-rm web',
+                                 compose.workspace)
+
+    def test_build_many_skip_unchanged(self, formation):
+        compose = Compose(str(formation))
+        with patch('charms.docker.compose.run') as s:
+            compose.build(['web', 'api'], skip_unchanged=True)
+            assert s.call_count == 2
+            results = compose.build(['web', 'api'], skip_unchanged=True)
+            assert s.call_count == 2
+            assert all(r.skipped for r in results.values())
+
+    def test_build_no_cache_never_skips(self, formation):
+        compose = Compose(str(formation))
+        with patch('charms.docker.compose.run') as s:
+            compose.build(skip_unchanged=True)
+            compose.build(no_cache=True, skip_unchanged=True)
+            s.assert_called_with('docker-compose build --force-rm --no-cache',
+                                 compose.workspace)
+
+    def test_compose_file_without_version(self, tmpdir):
+        tmpdir.join('docker-compose.yml').write(
+            'services:\n  web: {image: nginx}\n')
+        compose = Compose(str(tmpdir))
+        with patch('charms.docker.compose.run') as s:
+            compose.up('web')
+            s.assert_called_with('docker-compose up -d web',
+                                 compose.workspace)
+        assert compose.plan().added == ['web']
+
+    def test_unknown_service(self, formation):
+        compose = Compose(str(formation))
+        with patch('charms.docker.compose.run') as s:
+            with pytest.raises(ValueError):
+                compose.up('wbe')
+            with pytest.raises(ValueError):
+                compose.pull(['web', 'dbb'])
+            assert not s.called
+            compose.start('db')
+            assert s.called
+
+    def test_up_changed_only(self, formation):
+        compose = Compose(str(formation))
+        with patch('charms.docker.compose.run') as s:
+            s.return_value = b''
+            plan = compose.up(changed_only=True)
+            assert plan.added == ['web', 'api', 'db']
+            s.assert_any_call('docker-compose up -d web api db',
+                              compose.workspace)
+            s.reset_mock()
+            assert compose.plan().empty
+            assert compose.up(changed_only=True).unchanged == \
+                ['web', 'api', 'db']
+            assert [c.args[0] for c in s.call_args_list] == [
+                'docker image inspect --format {{.Id}} postgres'] * 2
+
+    def test_orphans_of_hyphenated_project(self, tmpdir, monkeypatch):
+        monkeypatch.delenv('COMPOSE_PROJECT_NAME', raising=False)
+        workspace = tmpdir.mkdir('my-app')
+        workspace.join('docker-compose.yml').write('web:\n  image: nginx\n')
+        compose = Compose(str(workspace))
+        assert 'label=com.docker.compose.project=my-app ' in \
+            compose._orphans_cmd('web')
+        assert compose._service_filters('web')['label'][0] == \
+            'com.docker.compose.project=my-app'
+
+    def test_up_changed_only_diff(self, formation):
+        compose = Compose(str(formation))
+        project = compose.workspace.project_name
+        with patch('charms.docker.compose.run') as s:
+            s.return_value = b''
+            compose.up(changed_only=True)
+            formation.join('docker-compose.yml').write(
+                'version: "2"\n'
+                'services:\n'
+                '  web:\n'
+                '    build: ./web\n'
+                '  db:\n'
+                '    image: postgres:9.5\n')
+            s.reset_mock()
+            s.return_value = b'6f137adb5d27\n'
+            plan = compose.up(changed_only=True)
+            assert plan.changed == ['db']
+            assert plan.removed == ['api']
+            assert plan.unchanged == ['web']
+            s.assert_any_call('docker-compose up -d db', compose.workspace)
+            s.assert_any_call(
+                'docker ps --all --quiet --no-trunc'
+                ' --filter label=com.docker.compose.project={}'
+                ' --filter label=com.docker.compose.service=api'.format(
+                    project), compose.workspace)
+            s.assert_called_with('docker rm -f 6f137adb5d27',
+                                 compose.workspace)
+
+    def test_up_changed_only_inputs(self, tmpdir, monkeypatch):
+        monkeypatch.delenv('TAG', raising=False)
+        tmpdir.join('docker-compose.yml').write(
+            'services:\n'
+            '  web:\n'
+            '    image: nginx:${TAG:-1}\n'
+            '    env_file: web.env\n')
+        tmpdir.join('web.env').write('A=1\n')
+        compose = Compose(str(tmpdir))
+        with patch('charms.docker.compose.run') as s:
+            s.return_value = b'sha256:1\n'
+            compose.up(changed_only=True)
+            assert compose.plan().empty
+            tmpdir.join('web.env').write('A=2\n')
+            assert compose.up(changed_only=True).changed == ['web']
+            tmpdir.join('.env').write('TAG=2\n')
+            assert compose.up(changed_only=True).changed == ['web']
+            monkeypatch.setenv('TAG', '3')
+            assert compose.up(changed_only=True).changed == ['web']
+            # eg: after compose.pull()
+            s.return_value = b'sha256:2\n'
+            assert compose.up(changed_only=True).changed == ['web']
+            assert compose.plan().empty
+
+    def test_up_changed_only_records_pulled_image(self, tmpdir):
+        tmpdir.join('docker-compose.yml').write('web:\n  image: nginx\n')
+        compose = Compose(str(tmpdir))
+        pulled = []
+
+        def fake(cmd, workspace, **kwargs):
+            if cmd.startswith('docker-compose up'):
+                pulled.append(True)
+            elif not pulled:
+                raise subprocess.CalledProcessError(1, cmd)
+            return b'sha256:1\n'
+
+        with patch('charms.docker.compose.run', side_effect=fake):
+            assert compose.up(changed_only=True).added == ['web']
+            assert compose.plan().empty
+
+    def test_up_changed_only_failure_is_not_recorded(self, formation):
+        compose = Compose(str(formation))
+        with patch('charms.docker.compose.run') as s:
+            s.side_effect = subprocess.CalledProcessError(1, 'up')
+            with pytest.raises(subprocess.CalledProcessError):
+                compose.up(changed_only=True)
+        assert compose.plan().added == ['web', 'api', 'db']
+
+    def test_up_changed_only_rejects_service(self, compose):
+        with pytest.raises(ValueError):
+            compose.up('web', changed_only=True)
+
+    @pytest.fixture
+    def waves(self, tmpdir):
+        tmpdir.join('docker-compose.yml').write(
+            'version: "2"\n'
+            'services:\n'
+            '  web:\n'
+            '    image: nginx\n'
+            '    depends_on: [api]\n'
+            '  api:\n'
+            '    image: python\n'
+            '    links: [db]\n'
+            '  db:\n'
+            '    image: postgres\n')
+        return tmpdir
+
+    def test_up_waves(self, waves):
+        docker = Mock()
+        docker.ps.side_effect = lambda all, filters: [
+            _container(filters['label'][1].partition('=')[2])]
+        docker.wait_healthy.side_effect = lambda ids, timeout: dict(
+            (i, HealthResult(i, 'timeout' if i == 'web_1' else 'healthy',
+                             1.0)) for i in ids)
+        compose = Compose(str(waves), docker=docker)
+        with patch('charms.docker.compose.run') as s:
+            results = compose.up_waves(timeout=30)
+            assert list(results) == ['db', 'api', 'web']
+            assert [c.args[0] for c in s.call_args_list] == [
+                'docker-compose up -d --no-deps db',
+                'docker-compose up -d --no-deps api',
+                'docker-compose up -d --no-deps web']
+        assert results['api'].ok
+        assert isinstance(results['web'].error, TimeoutError)
+        docker.wait_healthy.assert_any_call(['db_1'], 30)
+
+    def test_up_waves_stops_on_unhealthy(self, waves):
+        docker = Mock()
+        docker.ps.return_value = [_container('db')]
+        docker.wait_healthy.return_value = {
+            'db_1': HealthResult('db_1', 'unhealthy', 2.0)}
+        compose = Compose(str(waves), docker=docker)
+        with patch('charms.docker.compose.run') as s:
+            results = compose.up_waves('api')
+            assert s.call_count == 1
+        assert 'db_1 unhealthy' in str(results['db'].error)
+        assert results['api'].skipped
+
+    def test_wait_healthy(self, waves):
+        docker = Mock()
+        docker.ps.side_effect = lambda all, filters: {
+            'db': [_container('db'), _container('db2')],
+            'api': []}[filters['label'][1].partition('=')[2]]
+        docker.wait_healthy.side_effect = lambda ids, timeout: dict(
+            (i, HealthResult(i, 'healthy', 0.5)) for i in ids)
+        compose = Compose(str(waves), docker=docker)
+        health = compose.wait_healthy(['db', 'api'], timeout=5)
+        assert [h.container for h in health['db']] == ['db_1', 'db2_1']
+        assert health['api'] == []
+        project = compose.workspace.project_name
+        docker.ps.assert_any_call(all=True, filters={'label': [
+            'com.docker.compose.project={}'.format(project),
+            'com.docker.compose.service=db']})
+        docker.wait_healthy.assert_called_with(['db_1', 'db2_1'], 5)
+
+    def test_up_waves_reports_cycles_first(self, waves):
+        waves.join('docker-compose.yml').write(
+            'version: "2"\n'
+            'services:\n'
+            '  web:\n'
+            '    depends_on: [db]\n'
+            '  db:\n'
+            '    depends_on: [web]\n')
+        compose = Compose(str(waves), docker=Mock())
+        with patch('charms.docker.compose.run') as s:
+            with pytest.raises(DependencyCycleError):
+                compose.up_waves()
+            assert not s.called
+
+    def _cluster(self, replicas, broken=()):
+        '''
+        A fake service of `replicas` containers, scaled and removed through
+        patched docker-compose and docker commands.
+        '''
+        state = {'ids': list(replicas), 'next': 0, 'peak': len(replicas),
+                 'cmds': []}
+
+        def run(cmd, workspace):
+            state['cmds'].append(cmd)
+            if cmd.startswith('docker rm -f'):
+                for cid in cmd.split()[3:]:
+                    state['ids'].remove(cid)
+            elif '--scale' in cmd:
+                count = int(cmd.split()[-2].partition('=')[2])
+                while len(state['ids']) < count:
+                    state['next'] += 1
+                    state['ids'].append('new{}'.format(state['next']))
+            state['peak'] = max(state['peak'], len(state['ids']))
+            return b''
+
+        docker = Mock()
+        docker.ps.side_effect = lambda all, filters: [
+            _container(cid)._replace(id=cid) for cid in state['ids']]
+        docker.wait_healthy.side_effect = lambda ids, timeout: dict(
+            (i, HealthResult(i, 'unhealthy' if i in broken else 'healthy',
+                             0.1)) for i in ids)
+        return state, run, docker
+
+    def test_scale_rolling(self, waves):
+        state, fake, docker = self._cluster(['old1', 'old2', 'old3'])
+        compose = Compose(str(waves), docker=docker)
+        with patch('charms.docker.compose.run', side_effect=fake):
+            result = compose.scale('web', 3, rolling=True)
+        assert result.ok
+        assert result.retired == ['old1', 'old2', 'old3']
+        assert sorted(state['ids']) == ['new1', 'new2', 'new3']
+        assert state['peak'] == 4
+        assert state['cmds'][:2] == [
+            'docker-compose up -d --no-deps --no-recreate --scale web=4 web',
+            'docker rm -f old1']
+
+    def test_scale_rolling_up_without_surge(self, waves):
+        state, fake, docker = self._cluster(['old1', 'old2'])
+        compose = Compose(str(waves), docker=docker)
+        with patch('charms.docker.compose.run', side_effect=fake):
+            result = compose.scale('web', 5, rolling=True, window=2,
+                                   surge=0, recreate=False)
+        assert result.started == ['new1', 'new2', 'new3']
+        assert result.retired == []
+        assert state['peak'] == 5
+        assert docker.wait_healthy.call_count == 2
+
+    def test_scale_rolling_rolls_back(self, waves):
+        state, fake, docker = self._cluster(['old1', 'old2'],
+                                            broken={'new2'})
+        compose = Compose(str(waves), docker=docker)
+        with patch('charms.docker.compose.run', side_effect=fake):
+            result = compose.scale('web', 2, rolling=True)
+        assert not result.ok
+        assert result.rolled_back
+        assert 'new2 unhealthy' in str(result.error)
+        assert result.retired == ['old1']
+        # the started replicas are gone, and old1 replaced
+        assert sorted(state['ids']) == ['new3', 'old2']
+
+    def test_scale_rolling_rolls_back_api_error(self, waves):
+        state, fake, docker = self._cluster(['old1', 'old2'])
+        docker.wait_healthy.side_effect = [
+            {'new1': HealthResult('new1', 'healthy', 0.1)},
+            APIError(500, 'boom', 'GET', '/events')]
+        compose = Compose(str(waves), docker=docker)
+        with patch('charms.docker.compose.run', side_effect=fake):
+            result = compose.scale('web', 2, rolling=True)
+        assert isinstance(result.error, APIError)
+        assert result.rolled_back
+        assert sorted(state['ids']) == ['new3', 'old2']
+
+    def test_scale_rolling_rolls_back_timeout(self, waves):
+        state, run, docker = self._cluster(['old1'])
+
+        def fake(cmd, workspace):
+            if '--scale' in cmd and not state['cmds']:
+                state['cmds'].append(cmd)
+                state['ids'].append('new1')
+                raise subprocess.TimeoutExpired(cmd, 5)
+            return run(cmd, workspace)
+
+        compose = Compose(str(waves), docker=docker)
+        with patch('charms.docker.compose.run', side_effect=fake):
+            result = compose.scale('web', 1, rolling=True)
+        assert isinstance(result.error, subprocess.TimeoutExpired)
+        assert state['ids'] == ['old1']
+
+    def test_scale_rolling_failed_rollback(self, waves):
+        state, run, docker = self._cluster(['old1', 'old2'],
+                                           broken={'new2'})
+
+        def fake(cmd, workspace):
+            if cmd.startswith('docker rm -f new'):
+                raise subprocess.CalledProcessError(1, cmd)
+            return run(cmd, workspace)
+
+        compose = Compose(str(waves), docker=docker)
+        with patch('charms.docker.compose.run', side_effect=fake):
+            result = compose.scale('web', 2, rolling=True)
+        assert 'new2 unhealthy' in str(result.error)
+        assert not result.rolled_back
+        assert result.started == ['new1', 'new2']
+        # old1 is still replaced
+        assert state['cmds'][-1] == \
+            'docker-compose up -d --no-deps --no-recreate --scale web=2 web'
+
+    def test_scale_rolling_rejects_bad_window(self, compose):
+        with pytest.raises(ValueError):
+            compose.scale('web', 2, rolling=True, window=0)
+
+    def test_run(self):
         compose = Compose('files/workspace', strict=False)
-        compose.up('nginx')
-        chmock.assert_called_with('files/workspace')
-        ccmock.assert_called_with(['docker-compose', 'up', '-d', 'nginx'])
-
-    # This test is a little ugly but is a byproduct of testing the callstack.
-    @patch('os.getcwd')
-    def test_context_manager(self, cwdmock):
-        cwdmock.return_value = '/tmp'
+        with patch('charms.docker.runner.get_executor') as ex:
+            compose.up('nginx')
+            ex.return_value.run.assert_called_with(
+                ['docker-compose', 'up', '-d', 'nginx'], cwd='files/workspace',
+                timeout=None, on_stdout=None, on_stderr=None)
+
+    def test_run_leaves_cwd_alone(self, tmpdir):
+        cwd = os.getcwd()
         with patch('os.chdir') as chmock:
-            compose = Compose('files/workspace', strict=False)
-            with patch('charms.docker.runner.check_output'):
-                compose.up('nginx')
-                # We can only test the return called with in this manner.
-                # So check that we at least reset context
-                chmock.assert_called_with('/tmp')
-                # TODO: test that we've actually tried to change dir context
+            assert run('pwd', str(tmpdir)).decode().strip() == \
+                os.path.realpath(str(tmpdir))
+            assert not chmock.called
+        assert os.getcwd() == cwd
@@ -33,3 +33,46 @@ class TestDockerOpts:
             m.return_value = True
             w = Workspace("/tmp/docker-test")
             assert w.validate() is True
+
+    def test_config_v1_and_v2(self, tmpdir):
+        tmpdir.join('docker-compose.yaml').write('web:\n  image: nginx\n')
+        w = Workspace(str(tmpdir))
+        assert w.compose_file.endswith('docker-compose.yaml')
+        assert w.config() == {'web': {'image': 'nginx'}}
+        tmpdir.join('docker-compose.yml').write(
+            'version: "2"\nservices:\n  db:\n    image: postgres\n')
+        assert w.config() == {'db': {'image': 'postgres'}}
+
+    def test_config_missing(self, tmpdir):
+        with pytest.raises(OSError):
+            Workspace(str(tmpdir)).config()
+
+    def test_fingerprint(self, tmpdir):
+        tmpdir.join('Dockerfile').write('FROM ubuntu\n')
+        w = Workspace(str(tmpdir), context="docker")
+        before = w.fingerprint()
+        tmpdir.join('Dockerfile').write('FROM debian\n')
+        assert w.fingerprint() != before
+
+    def test_project_name(self, monkeypatch):
+        monkeypatch.delenv('COMPOSE_PROJECT_NAME', raising=False)
+        assert Workspace('files/My.App_1-x').project_name == 'myapp_1-x'
+        monkeypatch.setenv('COMPOSE_PROJECT_NAME', 'prod')
+        assert Workspace('files/My.App_1-x').project_name == 'prod'
+
+    def test_environment(self, tmpdir, monkeypatch):
+        tmpdir.join('.env').write('# tags\nTAG="1.0"\nHOST=db\n\n')
+        monkeypatch.setenv('HOST', 'cache')
+        env = Workspace(str(tmpdir)).environment()
+        assert env['TAG'] == '1.0'
+        assert env['HOST'] == 'cache'
+
+    def test_project_is_cached(self, tmpdir):
+        compose_file = tmpdir.join('docker-compose.yml')
+        compose_file.write('web:\n  image: nginx\n')
+        w = Workspace(str(tmpdir))
+        project = w.project
+        assert w.project is project
+        compose_file.write('web:\n  image: nginx\ndb:\n  image: redis\n')
+        assert w.project is not project
+        assert w.project.names == ['web', 'db']
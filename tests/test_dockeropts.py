@@ -1,4 +1,6 @@
 from charms.docker.dockeropts import DockerOpts
+from mock import patch
+import pytest
 
 
 class TestDockerOpts:
@@ -37,6 +39,22 @@ class TestDockerOpts:
         d = DockerOpts()
         assert d.data['juju'] == ['is amazing']
 
+    def test_data_is_read_only(self):
+        d = DockerOpts()
+        d.data = {}
+        d.add('label', 'a')
+        with pytest.raises(TypeError):
+            d.data['label'] = ['b']
+        with pytest.raises(TypeError):
+            d.data['label'].append('b')
+        with pytest.raises(TypeError):
+            d.data.pop('label')
+        assert d.data == {'label': ['a']}
+        data = dict(d.data)
+        data['label'] = ['b']
+        d.data = data
+        assert d.to_s() == '--label=b'
+
     def test_add_flag_only(self):
         d = DockerOpts()
         d.add('flagonly', None)
@@ -51,3 +69,166 @@ class TestDockerOpts:
         d = DockerOpts()
         d.add('strictmode', 'strict-formatting,enabled-because', strict=True)
         assert "--strictmode=strict-formatting,enabled-because" in d.to_s()
+
+    def test_strict_key_is_not_mangled(self):
+        d = DockerOpts()
+        d.data = {}
+        d.add('host', 'tcp://0.0.0.0:2376', strict=True)
+        assert d.to_s() == '--host=tcp://0.0.0.0:2376'
+        assert d.data == {'host-strict': 'tcp://0.0.0.0:2376'}
+
+    def test_remove_missing_is_noop(self):
+        d = DockerOpts()
+        d.data = {}
+        d.add('label', 'a')
+        d.remove('label', 'nope')
+        d.remove('nope', 'nope')
+        assert d.data == {'label': ['a']}
+
+    def test_remove_key(self):
+        d = DockerOpts()
+        d.data = {}
+        d.add('label', 'a, b')
+        d.remove('label')
+        assert 'label' not in d
+        d.add('label', 'a')
+        d.remove('label', 'a')
+        assert 'label' not in d
+
+    def test_contains(self):
+        d = DockerOpts()
+        d.data = {}
+        d.add('label', 'a, b')
+        d.add('flagonly', None)
+        assert d.contains('label', 'b')
+        assert not d.contains('label', 'c')
+        assert d.contains('flagonly')
+        assert 'label' in d
+
+    def test_add_is_ordered_and_deduplicated(self):
+        d = DockerOpts()
+        d.data = {}
+        for value in ['c', 'a', 'b', 'a', 'c']:
+            d.add('label', value)
+        assert d.data['label'] == ['c', 'a', 'b']
+
+    def test_migrate_legacy_record(self):
+        d = DockerOpts()
+        d.db.set('docker_opts', {
+            'label': ['a', 'b'],
+            'tlsverify': None,
+            'host': ['tcp://a:1', 'tcp://b:2'],
+            'host-strict': 'tcp://a:1,tcp://b:2',
+        })
+        migrated = DockerOpts()
+        assert migrated.to_s() == ('--label=a --label=b --tlsverify '
+                                   '--host=tcp://a:1,tcp://b:2')
+        assert migrated.db.get('docker_opts')['version'] == 2
+        assert DockerOpts().to_s() == migrated.to_s()
+
+    def test_transaction_writes_once(self):
+        d = DockerOpts()
+        with patch.object(d.db, 'set') as setmock:
+            with d.transaction():
+                d.add('txn', 'a')
+                d.add('txn', 'b')
+                d.remove('txn', 'a')
+                assert not setmock.called
+            assert setmock.call_count == 1
+        assert d.data['txn'] == ['b']
+
+    def test_transaction_rollback(self):
+        d = DockerOpts()
+        d.add('rollback', 'keep')
+        with patch.object(d.db, 'set') as setmock:
+            with pytest.raises(RuntimeError):
+                with d.batch():
+                    d.add('rollback', 'discard')
+                    raise RuntimeError()
+            assert not setmock.called
+        assert d.data['rollback'] == ['keep']
+
+    def test_nested_transaction(self):
+        d = DockerOpts()
+        with patch.object(d.db, 'set') as setmock:
+            with d.transaction():
+                d.add('outer', 'a')
+                with pytest.raises(ValueError):
+                    with d.transaction():
+                        d.add('inner', 'b')
+                        raise ValueError()
+            assert setmock.call_count == 1
+        assert 'outer' in d.data
+        assert 'inner' not in d.data
+
+    def test_add_many(self):
+        d = DockerOpts()
+        with patch.object(d.db, 'set') as setmock:
+            d.add_many([('many', 'a, b'), ('many-flag', None)])
+            d.add_many({'many-dict': 'c'})
+            assert setmock.call_count == 2
+        assert d.data['many'] == ['a', 'b']
+        assert d.data['many-flag'] is None
+        assert d.data['many-dict'] == ['c']
+
+    def test_render_writes_defaults_file(self, tmpdir):
+        path = tmpdir.join('docker')
+        path.write('# Docker defaults\nDOCKER_OPTS="--old=1"\nOTHER=x\n')
+        d = DockerOpts()
+        d.data = {}
+        d.add('bip', '192.168.22.2')
+        d.add('label', 'a, b')
+        result = d.render(str(path))
+        assert result.changed
+        assert result.added == ['bip', 'label']
+        assert result.removed == ['old']
+        assert result.restart_needed
+        assert path.read() == ('# Docker defaults\n'
+                               'DOCKER_OPTS="--bip=192.168.22.2 --label=a '
+                               '--label=b"\nOTHER=x\n')
+
+    def test_render_unchanged_skips_write(self, tmpdir):
+        path = tmpdir.join('docker')
+        d = DockerOpts()
+        d.data = {}
+        d.add('tlsverify', None)
+        first = d.render(str(path))
+        assert first.changed and first.added == ['tlsverify']
+        mtime = path.mtime()
+        with patch('charms.docker.dockeropts._atomic_write') as writemock:
+            second = d.render(str(path))
+            assert not writemock.called
+        assert not second.changed
+        assert not second.restart_needed
+        assert second.fingerprint == first.fingerprint
+        assert path.mtime() == mtime
+
+    def test_render_reports_modified(self, tmpdir):
+        path = tmpdir.join('docker')
+        path.write('export DOCKER_OPTS="--label=b --label=a --mtu=1500"\n')
+        d = DockerOpts()
+        d.data = {}
+        d.add('label', 'a, b')
+        d.add('mtu', '1400')
+        result = d.render(str(path))
+        assert result.modified == ['mtu']
+        assert result.added == [] and result.removed == []
+
+    def test_render_reorder_is_not_a_restart(self, tmpdir):
+        path = tmpdir.join('docker')
+        path.write('DOCKER_OPTS="--label=b --label=a"\n')
+        d = DockerOpts()
+        d.data = {}
+        d.add('label', 'a, b')
+        result = d.render(str(path))
+        assert result.changed
+        assert not result.restart_needed
+
+    def test_render_quotes_values(self, tmpdir):
+        path = tmpdir.join('docker')
+        d = DockerOpts()
+        d.data = {}
+        d.add('label', 'say="$hi"')
+        d.render(str(path))
+        assert path.read() == 'DOCKER_OPTS="--label=say=\\"\\$hi\\""\n'
+        assert not d.render(str(path)).changed
@@ -0,0 +1,53 @@
+from charms.docker.health import HealthWatch
+
+
+def _inspect(cid, running=True, health=None, healthcheck=True):
+    state = {'Running': running, 'Status': 'running' if running else
+             'created'}
+    if health:
+        state['Health'] = {'Status': health}
+    config = {}
+    if healthcheck:
+        config['Healthcheck'] = {'Test': ['CMD', 'true']}
+    return {'Id': cid, 'State': state, 'Config': config}
+
+
+def _event(cid, action):
+    return {'Type': 'container', 'Action': action, 'Actor': {'ID': cid}}
+
+
+class TestHealthWatch:
+
+    def test_seed_settled(self):
+        watch = HealthWatch(0)
+        watch.seed('web', _inspect('a', health='healthy'))
+        watch.seed('db', _inspect('b', healthcheck=False))
+        watch.seed('old', {'Id': 'c', 'State': {'Status': 'exited'}})
+        assert watch.results['web'].status == 'healthy'
+        assert watch.results['db'].status == 'running'
+        assert watch.results['old'].status == 'died'
+        assert not watch.pending
+
+    def test_feed(self):
+        watch = HealthWatch(0)
+        watch.seed('web', _inspect('a', health='starting'))
+        watch.seed('db', _inspect('b', running=False, healthcheck=False))
+        watch.seed('api', _inspect('c', health='starting'))
+        watch.feed(_event('a', 'health_status: starting'))
+        watch.feed(_event('z', 'die'))
+        assert set(watch.pending) == {'a', 'b', 'c'}
+        watch.feed(_event('a', 'health_status: healthy'))
+        watch.feed(_event('b', 'start'))
+        watch.feed(_event('c', 'die'))
+        assert not watch.pending
+        assert [watch.results[n].status for n in ('web', 'db', 'api')] == \
+            ['healthy', 'running', 'died']
+        assert watch.results['web'].ok
+        assert not watch.results['api'].ok
+
+    def test_expire(self):
+        watch = HealthWatch(0)
+        watch.seed('web', _inspect('a', health='starting'))
+        watch.expire()
+        assert watch.results['web'].status == 'timeout'
+        assert watch.results['web'].duration > 0
@@ -0,0 +1,100 @@
+from charms.docker.manifest import BuildManifest, DockerIgnore, fingerprint
+from mock import patch
+import os
+import pytest
+
+
+class TestDockerIgnore:
+
+    def test_simple_patterns(self):
+        ignore = DockerIgnore(['# comment', '', '*.pyc', '/build', 'a?c'])
+        assert ignore.matches('mod.pyc')
+        assert not ignore.matches('pkg/mod.pyc')
+        assert ignore.matches('build')
+        assert ignore.matches('build/deep/file.o')
+        assert ignore.matches('abc')
+        assert not ignore.matches('a/c')
+        assert not ignore.matches('src/main.py')
+
+    def test_double_star(self):
+        ignore = DockerIgnore(['**/*.pyc', 'docs/**'])
+        assert ignore.matches('mod.pyc')
+        assert ignore.matches('pkg/sub/mod.pyc')
+        assert ignore.matches('docs/a/b.rst')
+
+    def test_exceptions(self):
+        ignore = DockerIgnore(['*.md', '!README.md', 'logs', '!logs/keep'])
+        assert ignore.matches('CHANGES.md')
+        assert not ignore.matches('README.md')
+        assert ignore.matches('logs/today')
+        assert not ignore.matches('logs/keep')
+        assert ignore.has_exceptions
+
+    def test_load(self, tmpdir):
+        tmpdir.join('.dockerignore').write('*.log\n')
+        assert DockerIgnore.load(str(tmpdir)).matches('x.log')
+        assert not DockerIgnore.load(str(tmpdir.mkdir('empty'))).patterns
+
+
+class TestFingerprint:
+
+    @pytest.fixture
+    def context(self, tmpdir):
+        tmpdir.join('Dockerfile').write('FROM ubuntu\n')
+        tmpdir.mkdir('src').join('app.py').write('print("hi")\n')
+        tmpdir.join('.dockerignore').write('*.log\n')
+        return tmpdir
+
+    def test_stable(self, context):
+        assert fingerprint(str(context)) == fingerprint(str(context))
+
+    def test_content_change(self, context):
+        before = fingerprint(str(context))
+        context.join('src', 'app.py').write('print("bye")\n')
+        assert fingerprint(str(context)) != before
+
+    def test_ignored_files_do_not_count(self, context):
+        before = fingerprint(str(context))
+        context.join('debug.log').write('noise')
+        assert fingerprint(str(context)) == before
+
+    def test_mode_change(self, context):
+        before = fingerprint(str(context))
+        os.chmod(str(context.join('src', 'app.py')), 0o755)
+        assert fingerprint(str(context)) != before
+
+    def test_incremental_cache(self, context):
+        cache = {}
+        first = fingerprint(str(context), cache)
+        assert set(cache) == {'Dockerfile', '.dockerignore', 'src/app.py'}
+        with patch('charms.docker.manifest._hash_file') as hashmock:
+            assert fingerprint(str(context), cache) == first
+            assert not hashmock.called
+        context.join('src', 'app.py').remove()
+        fingerprint(str(context), cache)
+        assert 'src/app.py' not in cache
+
+
+class FakeKV(dict):
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class TestBuildManifest:
+
+    def test_changed_and_commit(self, tmpdir):
+        tmpdir.mkdir('web').join('Dockerfile').write('FROM nginx\n')
+        tmpdir.mkdir('api').join('Dockerfile').write('FROM python\n')
+        db = FakeKV()
+        builds = {'web': 'web', 'api': {'context': 'api'}}
+        manifest = BuildManifest(str(tmpdir), db=db)
+        assert manifest.changed(builds) == ['web', 'api']
+        manifest.commit(['web', 'api'])
+
+        manifest = BuildManifest(str(tmpdir), db=db)
+        assert manifest.changed(builds) == []
+        tmpdir.join('api', 'Dockerfile').write('FROM python:3\n')
+        assert manifest.changed(builds) == ['api']
+        builds['web'] = {'context': 'web', 'args': {'V': '2'}}
+        assert manifest.changed(builds) == ['web', 'api']
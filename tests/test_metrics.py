@@ -0,0 +1,134 @@
+from charms.docker import Docker
+from charms.docker import aio, metrics
+from charms.docker.metrics import (CommandEvent, Histogram, set_recorder,
+                                   to_prometheus, write_textfile)
+from charms.docker.runner import run
+from mock import Mock, patch
+import asyncio
+import pytest
+import subprocess
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+
+class TestMetrics:
+
+    @pytest.fixture
+    def recorder(self):
+        recorder = Recorder()
+        previous = set_recorder(recorder)
+        yield recorder
+        set_recorder(previous)
+
+    def test_noop_by_default(self):
+        assert metrics.get_recorder() is None
+        metrics.record('runner', 'true', 'true', None, 0.0)
+
+    def test_runner(self, recorder, tmpdir):
+        run('echo hello', str(tmpdir))
+        event = recorder.events[0]
+        assert event.source == 'runner'
+        assert event.name == 'echo hello'
+        assert event.workspace == str(tmpdir)
+        assert event.exit_code == 0
+        assert event.output_size == 6
+        assert event.duration >= 0
+
+    def test_runner_failure(self, recorder, tmpdir):
+        with pytest.raises(subprocess.CalledProcessError):
+            run('false', str(tmpdir))
+        assert recorder.events[0].exit_code == 1
+        assert recorder.events[0].name == 'false'
+
+    def test_aio(self, recorder, tmpdir):
+        asyncio.run(aio.run('echo hello', str(tmpdir)))
+        with pytest.raises(subprocess.CalledProcessError):
+            asyncio.run(aio.run(['sh', '-c', 'exit 3']))
+        ok, failed = recorder.events
+        assert (ok.source, ok.name, ok.workspace) == \
+            ('aio', 'echo hello', str(tmpdir))
+        assert ok.output_size == 6
+        assert failed.exit_code == 3
+
+    def test_running_records_once(self, recorder):
+        docker = Docker()
+        docker._api = Mock()
+        docker._api.get.return_value.read.return_value = b'OK'
+        assert docker.running(ttl=0)
+        assert [e.name for e in recorder.events] == ['Docker.ping']
+        assert recorder.events[0].output_size is None
+
+    def test_only_output_has_a_size(self, recorder):
+        with patch('subprocess.check_output') as s:
+            s.return_value = b'abc\ndef\n'
+            Docker().ps(quiet=True)
+            s.return_value = 'h\u00e9llo'
+            Docker().pull('nginx')
+        ps, pull = recorder.events
+        assert ps.output_size is None
+        assert pull.output_size == 6
+
+    def test_docker(self, recorder):
+        with patch('subprocess.check_output') as s:
+            s.return_value = b'pulled'
+            Docker(workspace='files/ws').pull('nginx')
+            s.side_effect = subprocess.CalledProcessError(2, 'docker')
+            with pytest.raises(subprocess.CalledProcessError):
+                Docker().inspect('web')
+        pull, inspect = recorder.events
+        assert pull.name == 'Docker.pull'
+        assert pull.workspace == 'files/ws'
+        assert pull.output_size == 6
+        assert inspect.exit_code == 2
+
+    def test_command_name(self):
+        assert metrics.command_name(
+            ['/usr/bin/docker-compose', 'up', '-d', 'web']) == \
+            'docker-compose up'
+        assert metrics.command_name(['docker', '-H', 'x']) == 'docker x'
+        assert metrics.command_name([]) == ''
+
+
+class TestHistogram:
+
+    def test_buckets(self):
+        h = Histogram(buckets=(0.1, 1.0))
+        for duration, code in ((0.05, 0), (0.1, 0), (0.5, 1), (3.0, 0)):
+            h.record(CommandEvent('runner', 'docker-compose up', 'up', 'ws',
+                                  duration, code, 10))
+        series = h.snapshot()[('runner', 'docker-compose up', 'ws')]
+        assert series['buckets'] == [(0.1, 2), (1.0, 3)]
+        assert series['count'] == 4
+        assert series['failures'] == 1
+        assert series['output_bytes'] == 40
+        assert series['sum'] == pytest.approx(3.65)
+
+    def test_prometheus(self, tmpdir):
+        h = Histogram(buckets=(1.0,))
+        h.record(CommandEvent('docker', 'Docker.pull', 'pull', None, 0.5, 0,
+                              None))
+        text = to_prometheus(h)
+        assert '# TYPE charms_docker_command_duration_seconds histogram' \
+            in text
+        labels = 'source="docker",command="Docker.pull",workspace=""'
+        assert 'charms_docker_command_duration_seconds_bucket{{{},le="1.0"}}' \
+            ' 1'.format(labels) in text
+        assert 'charms_docker_command_duration_seconds_bucket{{{},le="+Inf"}}' \
+            ' 1'.format(labels) in text
+        assert 'charms_docker_command_failures_total{{{}}} 0'.format(
+            labels) in text
+        path = tmpdir.join('juju.prom')
+        write_textfile(h, str(path))
+        assert path.read() == text
+        assert tmpdir.listdir() == [path]
+
+    def test_label_escaping(self):
+        h = Histogram()
+        h.record(CommandEvent('runner', 'a"b', 'a"b', 'c\\d', 0.1, 0, 1))
+        assert 'command="a\\"b",workspace="c\\\\d"' in to_prometheus(h)
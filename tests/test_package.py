@@ -0,0 +1,45 @@
+import charms.docker
+import os
+import pytest
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _loaded(statement):
+    '''
+    Run `statement` in a fresh interpreter and return the modules it left
+    loaded.
+    '''
+    code = '{}\nimport sys\nprint("\\n".join(sys.modules))'.format(statement)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return set(out.decode('utf-8').split())
+
+
+class TestPackage:
+
+    def test_import_is_cheap(self):
+        loaded = _loaded('import charms.docker')
+        for heavy in ('charmhelpers', 'yaml', 'asyncio', 'http.client',
+                      'charms.docker.docker', 'charms.docker.dockeropts'):
+            assert heavy not in loaded
+
+    def test_compose_skips_unitdata(self):
+        loaded = _loaded('from charms.docker import Compose')
+        assert 'charms.docker.compose' in loaded
+        assert 'charmhelpers.core.unitdata' not in loaded
+        assert 'asyncio' not in loaded
+
+    def test_lazy_names(self):
+        from charms.docker.docker import Docker
+        assert charms.docker.Docker is Docker
+        assert 'Docker' in dir(charms.docker)
+        assert set(charms.docker.__all__) <= set(dir(charms.docker))
+
+    def test_unknown_name(self):
+        with pytest.raises(AttributeError):
+            charms.docker.Dokcer
+        with pytest.raises(ImportError):
+            from charms.docker import Dokcer  # noqa
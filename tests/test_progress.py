@@ -0,0 +1,134 @@
+from charms.docker import Compose, Docker
+from charms.docker.aio import run as arun
+from charms.docker.progress import (BuildProgress, Progress, pull_line,
+                                    pull_message, StalledError)
+from charms.docker.runner import Executor
+from mock import patch
+from tests.fakedaemon import FakeDaemon
+import asyncio
+import pytest
+import time
+
+
+class TestParsers:
+
+    def test_pull_message(self):
+        event = pull_message({'status': 'Downloading', 'id': 'a3ed95caeb02',
+                              'progressDetail': {'current': 10,
+                                                 'total': 100},
+                              'progress': '[=>   ] 10 B/100 B'})
+        assert event == Progress('pull', 'a3ed95caeb02', 'Downloading', 10,
+                                 100, '[=>   ] 10 B/100 B')
+
+    def test_pull_line(self):
+        assert pull_line('a3ed95caeb02: Pull complete\n') == Progress(
+            'pull', 'a3ed95caeb02', 'Pull complete', None, None,
+            'a3ed95caeb02: Pull complete')
+        assert pull_line('Digest: sha256:4f2d').status == 'Digest'
+
+    def test_build_steps(self):
+        events = []
+        progress = BuildProgress(events.append)
+        for line in ['Building web', 'Step 1/2 : FROM nginx',
+                     ' ---> 6f137adb5d27', 'Step 2/2 : COPY . /srv',
+                     'Building api', 'Step 1 : FROM python',
+                     '#5 [worker 2/4] RUN make']:
+            progress(line)
+        assert [(e.id, e.current, e.total, e.text) for e in events] == [
+            ('web', 1, 2, 'FROM nginx'), ('web', 2, 2, 'COPY . /srv'),
+            ('api', 1, None, 'FROM python'), ('worker', 2, 4, 'RUN make')]
+
+
+class TestStreaming:
+
+    def test_executor_stall(self):
+        started = time.monotonic()
+        with pytest.raises(StalledError) as err:
+            Executor(kill_grace=0.5).run(
+                ['sh', '-c', 'echo start; sleep 5'], idle_timeout=0.2)
+        assert err.value.seconds == 0.2
+        assert time.monotonic() - started < 2
+
+    def test_executor_stderr_is_activity(self, capsys):
+        # BuildKit only reports progress on STDERR
+        script = 'for i in 1 2 3 4 5; do echo step $i >&2; sleep 0.1; done'
+        out = Executor().run(['sh', '-c', script], idle_timeout=0.3)
+        assert out == b''
+        assert 'step 5' in capsys.readouterr().err
+
+    def test_executor_without_capture(self):
+        lines = []
+        out = Executor().run(['sh', '-c', 'echo a; echo b'],
+                             on_stdout=lines.append, capture=False)
+        assert out == b''
+        assert lines == ['a', 'b']
+
+    def test_aio_stall(self):
+        with pytest.raises(StalledError):
+            asyncio.run(arun(['sh', '-c', 'echo start; sleep 5'],
+                             idle_timeout=0.2))
+
+    def test_aio_stderr_is_activity(self, capsys):
+        script = 'for i in 1 2 3 4 5; do echo step $i >&2; sleep 0.1; done'
+        asyncio.run(arun(['sh', '-c', script], idle_timeout=0.3))
+        assert 'step 5' in capsys.readouterr().err
+
+    def test_aio_lines(self):
+        lines = []
+        out = asyncio.run(arun(['sh', '-c', 'echo a; echo b >&2'],
+                               on_stdout=lines.append,
+                               on_stderr=lines.append, capture=False))
+        assert out == b''
+        assert sorted(lines) == ['a', 'b']
+
+    def test_api_pull_progress(self):
+        with FakeDaemon() as daemon:
+            daemon.route('POST', '/images/create', body=[
+                b'{"status": "Pulling fs layer", "id": "a3ed95caeb02"}\n',
+                b'{"status": "Downloading", "id": "a3ed95caeb02", '
+                b'"progressDetail": {"current": 5, "total": 10}}\n'])
+            events = []
+            docker = Docker(socket=daemon.url, backend='api')
+            assert docker.pull('nginx', on_progress=events.append) is None
+            assert [(e.status, e.current) for e in events] == [
+                ('Pulling fs layer', None), ('Downloading', 5)]
+
+    def test_api_pull_stall(self):
+        def slow(request):
+            def body():
+                yield b'{"status": "Pulling from library/nginx"}\n'
+                time.sleep(1)
+                yield b'{"status": "Done"}\n'
+            return 200, body(), None
+
+        with FakeDaemon() as daemon:
+            daemon.route('POST', '/images/create', handler=slow)
+            docker = Docker(socket=daemon.url, backend='api')
+            with pytest.raises(StalledError):
+                docker.pull('nginx', on_progress=lambda e: None,
+                            stall_timeout=0.2)
+
+    def test_cli_pull_progress(self):
+        with patch('charms.docker.docker.get_executor') as ex:
+            events = []
+            Docker().pull('nginx', on_progress=events.append,
+                          stall_timeout=30)
+            kwargs = ex.return_value.run.call_args[1]
+            assert kwargs['idle_timeout'] == 30
+            assert kwargs['capture'] is False
+            kwargs['on_stdout']('a3ed95caeb02: Download complete')
+            kwargs['on_stdout']('')
+            assert [e.id for e in events] == ['a3ed95caeb02']
+
+    def test_compose_build_progress(self):
+        compose = Compose('files/workspace', strict=False)
+        events = []
+        with patch('charms.docker.compose.run') as s:
+            compose.build('web', on_progress=events.append,
+                          stall_timeout=60)
+            kwargs = s.call_args[1]
+            assert kwargs['idle_timeout'] == 60
+            assert kwargs['capture'] is False
+            kwargs['on_stdout']('Step 1/3 : FROM nginx')
+        assert events == [Progress('build', 'web', 'Step', 1, 3,
+                                   'FROM nginx')]
@@ -0,0 +1,103 @@
+import pytest
+
+from charms.docker.project import DependencyCycleError, Project
+
+
+class TestProject:
+
+    def test_v1_layout(self):
+        project = Project({'web': {'image': 'nginx', 'links': ['db:database']},
+                           'db': {'image': 'postgres'}})
+        assert project.version == '1'
+        assert sorted(project.names) == ['db', 'web']
+        assert project.services['web'].dependencies == ['db']
+        assert project.images() == {'web': 'nginx', 'db': 'postgres'}
+
+    def test_v2_layout(self):
+        project = Project({
+            'version': '2.1',
+            'services': {
+                'web': {
+                    'build': './web',
+                    'depends_on': {'db': {'condition': 'service_healthy'}},
+                    'volumes_from': ['data:ro', 'container:other'],
+                    'networks': {'front': {'aliases': ['www']}},
+                    'volumes': ['static:/srv'],
+                },
+                'db': {
+                    'image': 'postgres',
+                    'healthcheck': {'test': ['CMD', 'pg_isready']},
+                },
+                'data': {'image': 'busybox',
+                         'healthcheck': {'disable': True}},
+            },
+            'volumes': {'static': None},
+            'networks': {'front': None},
+        })
+        web = project.services['web']
+        assert web.build == {'context': './web'}
+        assert web.depends_on == ['db']
+        assert web.dependencies == ['db', 'data']
+        assert web.networks == ['front']
+        assert web.volumes == ['static:/srv']
+        assert project.services['db'].healthcheck['test'][0] == 'CMD'
+        assert project.services['data'].healthcheck is None
+        assert project.builds() == {'web': {'context': './web'}}
+        assert project.volumes == ['static']
+        assert project.networks == ['front']
+
+    def test_spec_layout_without_version(self):
+        project = Project({'services': {'web': {'image': 'nginx'}},
+                           'volumes': {'data': None}})
+        assert project.version is None
+        assert project.names == ['web']
+        assert project.volumes == ['data']
+
+    def test_variables_and_env_files(self):
+        project = Project({'services': {'web': {
+            'image': 'nginx:${TAG:-latest}',
+            'environment': {'URL': 'http://$HOST:${PORT}', 'COST': '$$5'},
+            'env_file': ['a.env', {'path': 'b.env', 'required': False}],
+        }}})
+        web = project.services['web']
+        assert web.variables == ['HOST', 'PORT', 'TAG']
+        assert web.env_files == ['a.env', 'b.env']
+        assert Project({'db': {'env_file': 'db.env'}}).services[
+            'db'].env_files == ['db.env']
+
+    def test_unknown(self):
+        project = Project({'version': '2', 'services': {'web': {}}})
+        assert 'web' in project
+        assert project.unknown(['web', 'wbe']) == ['wbe']
+
+    def test_empty(self):
+        assert len(Project(None)) == 0
+
+    def test_waves(self):
+        project = Project({'version': '2', 'services': {
+            'web': {'depends_on': ['api'], 'links': ['cache']},
+            'api': {'depends_on': {'db': {'condition': 'service_healthy'}}},
+            'db': {},
+            'cache': {},
+            'docs': {},
+        }})
+        assert project.waves() == [['db', 'cache', 'docs'], ['api'], ['web']]
+        assert project.waves(['api']) == [['db'], ['api']]
+
+    def test_waves_cycle(self):
+        project = Project({'version': '2', 'services': {
+            'web': {'depends_on': ['api']},
+            'api': {'volumes_from': ['worker']},
+            'worker': {'links': ['api']},
+            'db': {},
+        }})
+        with pytest.raises(DependencyCycleError) as err:
+            project.waves()
+        assert err.value.cycle == ['api', 'worker', 'api']
+        assert 'api -> worker -> api' in str(err.value)
+
+    def test_waves_undefined_dependency(self):
+        project = Project({'version': '2', 'services': {
+            'web': {'depends_on': ['db']}}})
+        with pytest.raises(ValueError):
+            project.waves()
@@ -0,0 +1,102 @@
+from charms.docker.runner import (chdir, Executor, get_executor, run,
+                                  set_executor)
+from mock import patch
+import os
+import pytest
+import subprocess
+import threading
+import time
+
+
+class TestExecutor:
+
+    def test_run_in_cwd(self, tmpdir):
+        out = Executor().run(['pwd'], cwd=str(tmpdir))
+        assert out.decode().strip() == os.path.realpath(str(tmpdir))
+
+    def test_failure(self):
+        with pytest.raises(subprocess.CalledProcessError) as err:
+            Executor().run(['sh', '-c', 'echo out; exit 3'])
+        assert err.value.returncode == 3
+        assert err.value.output == b'out\n'
+
+    def test_streams_lines(self):
+        out, err = [], []
+        result = Executor().run(
+            ['sh', '-c', 'echo one; echo two >&2; printf three'],
+            on_stdout=out.append, on_stderr=err.append)
+        assert result == b'one\nthree'
+        assert out == ['one', 'three']
+        assert err == ['two']
+
+    def test_timeout_kills_process_group(self, tmpdir):
+        marker = tmpdir.join('alive')
+        started = time.monotonic()
+        with pytest.raises(subprocess.TimeoutExpired):
+            Executor(kill_grace=0.5).run(
+                ['sh', '-c', '(sleep 1; touch {}) & wait'.format(marker)],
+                timeout=0.2)
+        assert time.monotonic() - started < 1
+        time.sleep(1.2)
+        assert not marker.check()
+
+    def test_timeout_kills_group_after_leader_exits(self, tmpdir):
+        marker = tmpdir.join('alive')
+        with pytest.raises(subprocess.TimeoutExpired):
+            Executor(kill_grace=0.5).run(
+                ['sh', '-c', '(sleep 1; touch {}) & exit 0'.format(marker)],
+                timeout=0.3)
+        time.sleep(1.2)
+        assert not marker.check()
+
+    def test_max_concurrency(self):
+        ex = Executor(max_concurrency=2)
+        lock = threading.Lock()
+        state = {'now': 0, 'peak': 0}
+        real = ex._run
+
+        def counting(*args):
+            with lock:
+                state['now'] += 1
+                state['peak'] = max(state['peak'], state['now'])
+            try:
+                return real(*args)
+            finally:
+                with lock:
+                    state['now'] -= 1
+
+        ex._run = counting
+        threads = [threading.Thread(target=ex.run, args=(['sleep', '0.1'],))
+                   for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert state['peak'] == 2
+
+    def test_rejects_zero_concurrency(self):
+        with pytest.raises(ValueError):
+            Executor(max_concurrency=0)
+
+
+class TestRunner:
+
+    def test_set_executor(self):
+        recorder = Executor()
+        previous = set_executor(recorder)
+        try:
+            assert get_executor() is recorder
+            with patch.object(recorder, 'run') as r:
+                run('docker-compose ps', 'files/workspace', timeout=5)
+                r.assert_called_with(['docker-compose', 'ps'],
+                                     cwd='files/workspace', timeout=5,
+                                     on_stdout=None, on_stderr=None)
+        finally:
+            set_executor(previous)
+
+    def test_chdir_restores_on_error(self, tmpdir):
+        cwd = os.getcwd()
+        with pytest.raises(RuntimeError):
+            with chdir(str(tmpdir)):
+                raise RuntimeError()
+        assert os.getcwd() == cwd
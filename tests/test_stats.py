@@ -0,0 +1,126 @@
+from charms.docker import Docker
+from charms.docker.stats import (Aggregate, Ring, Sample, StatsSampler,
+                                 sample_from_api, sample_from_cli)
+from charms.docker.api import APIError
+from mock import Mock, patch
+import json
+import pytest
+import subprocess
+import time
+
+
+def _sample(t, cpu, rx=0):
+    return Sample(t, cpu, 1024, 1.0, rx, 0, 0, 0)
+
+
+class TestRing:
+
+    def test_wraps(self):
+        ring = Ring(3)
+        for value in (1, 2, 3, 4, 5):
+            ring.append(value)
+        assert len(ring) == 3
+        assert list(ring.values()) == [3.0, 4.0, 5.0]
+        assert list(ring.values(2)) == [4.0, 5.0]
+        assert ring.values().itemsize == 8
+
+    def test_partial(self):
+        ring = Ring(4)
+        ring.append(7)
+        assert list(ring.values()) == [7.0]
+        assert list(ring.values(10)) == [7.0]
+
+
+class TestStatsSampler:
+
+    def test_aggregate(self):
+        sampler = StatsSampler(['web'], Docker(), size=100)
+        for i in range(1, 101):
+            sampler.apply('web', _sample(1000 + i, float(i)))
+        assert sampler.aggregate('web', 'cpu_percent') == \
+            Aggregate(100, 50.0, 95.0, 100.0)
+        assert sampler.aggregate('web', 'cpu_percent', window=9) == \
+            Aggregate(10, 95.0, 100.0, 100.0)
+        assert sampler.latest('web').cpu_percent == 100.0
+
+    def test_empty(self):
+        sampler = StatsSampler(['web'], Docker())
+        assert sampler.aggregate('web', 'memory') == \
+            Aggregate(0, None, None, None)
+        assert sampler.rate('web', 'net_rx') is None
+
+    def test_rate(self):
+        sampler = StatsSampler(['web'], Docker(), size=3)
+        for t, rx in ((0, 0), (1, 500), (2, 1000), (4, 5000)):
+            sampler.apply('web', _sample(t, 0, rx))
+        assert sampler.rate('web', 'net_rx') == 1500.0
+        assert sampler.rate('web', 'net_rx', window=2) == 2000.0
+
+    def test_api_closes_opened_on_failure(self):
+        docker = Docker(backend='api')
+        web = Mock()
+
+        def get(path, **kwargs):
+            if path == '/containers/gone/stats':
+                raise APIError(404, 'No such container', 'GET', path)
+            return web
+
+        docker._api = Mock()
+        docker._api.get.side_effect = get
+        sampler = StatsSampler(['web', 'gone'], docker)
+        with pytest.raises(APIError):
+            sampler.start()
+        web.close.assert_called_once_with()
+        assert sampler._threads == []
+
+    def test_cli(self):
+        line = json.dumps({'Container': 'web', 'CPUPerc': '12.50%',
+                           'MemUsage': '1.5MiB / 1GiB', 'MemPerc': '0.15%',
+                           'NetIO': '648B / 1.2kB', 'BlockIO': '0B / 4MB'})
+        popen = subprocess.Popen
+        cmds = []
+
+        def fake(cmd, **kwargs):
+            cmds.append(cmd)
+            return popen(['printf', '\x1b[2J\x1b[H%s\\n', line], **kwargs)
+
+        with patch('subprocess.Popen', side_effect=fake):
+            sampler = Docker().stats(['web'])
+            deadline = time.monotonic() + 5
+            while sampler.latest('web') is None and \
+                    time.monotonic() < deadline:
+                time.sleep(0.01)
+            sampler.stop()
+        assert cmds == [['docker', 'stats', '--format', '{{json .}}', 'web']]
+        sample = sampler.latest('web')
+        assert sample.cpu_percent == 12.5
+        assert sample.memory == 1.5 * 1024 ** 2
+        assert (sample.net_rx, sample.net_tx) == (648, 1200)
+        assert sample.block_write == 4000000
+
+
+class TestSamples:
+
+    def test_from_cli_stopped(self):
+        assert sample_from_cli({'CPUPerc': '--', 'MemUsage': '-- / --',
+                                'MemPerc': '--', 'NetIO': '--',
+                                'BlockIO': '--'}) is None
+
+    def test_from_api(self):
+        sample = sample_from_api({
+            'cpu_stats': {'cpu_usage': {'total_usage': 300},
+                          'system_cpu_usage': 2000, 'online_cpus': 2},
+            'precpu_stats': {'cpu_usage': {'total_usage': 100},
+                             'system_cpu_usage': 1000},
+            'memory_stats': {'usage': 2000, 'limit': 10000,
+                             'stats': {'inactive_file': 1000}},
+            'networks': {'eth0': {'rx_bytes': 10, 'tx_bytes': 20},
+                         'eth1': {'rx_bytes': 1, 'tx_bytes': 2}},
+            'blkio_stats': {'io_service_bytes_recursive': [
+                {'op': 'Read', 'value': 5}, {'op': 'write', 'value': 7},
+                {'op': 'Total', 'value': 12}]},
+        }, now=1)
+        assert sample == Sample(1, 40.0, 1000, 10.0, 11, 22, 5, 7)
+
+    def test_from_api_stopped(self):
+        assert sample_from_api({'memory_stats': {}}) is None
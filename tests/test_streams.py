@@ -0,0 +1,108 @@
+from charms.docker.streams import LineDecoder, LogLine, iter_frames, \
+    iter_pipes, merge_logs
+import subprocess
+import time
+
+
+def _logs(script):
+    return subprocess.Popen(['sh', '-c', script], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+
+class TestLineDecoder:
+
+    def test_split_lines(self):
+        d = LineDecoder()
+        assert d.feed(b'one\ntwo\nthr') == ['one', 'two']
+        assert d.feed(b'ee\n') == ['three']
+        assert d.flush() == []
+
+    def test_multibyte_across_chunks(self):
+        d = LineDecoder()
+        assert d.feed(b'caf\xc3') == []
+        assert d.feed(b'\xa9\n') == ['café']
+
+    def test_invalid_bytes_are_replaced(self):
+        d = LineDecoder()
+        assert d.feed(b'bad \xff byte\n') == ['bad � byte']
+
+    def test_partial_line_is_bounded(self):
+        d = LineDecoder(max_line=4)
+        assert d.feed(b'abcdefghij') == ['abcd', 'efgh']
+        assert d.flush() == ['ij']
+
+
+class TestStreams:
+
+    def test_iter_frames_splits_streams(self):
+        frames = [(1, b'out one\nout'), (2, b'err\n'), (1, b' two\n')]
+        assert list(iter_frames(frames)) == [
+            LogLine('stdout', 'out one'),
+            LogLine('stderr', 'err'),
+            LogLine('stdout', 'out two'),
+        ]
+
+    def test_iter_pipes(self):
+        proc = subprocess.Popen(['sh', '-c', 'echo out; echo err >&2; '
+                                 'printf tail'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        lines = list(iter_pipes(proc))
+        proc.wait()
+        assert sorted(lines) == [LogLine('stderr', 'err'),
+                                 LogLine('stdout', 'out'),
+                                 LogLine('stdout', 'tail')]
+
+
+class TestMergeLogs:
+
+    def test_timestamp_order(self):
+        procs = {
+            'web': _logs('echo "2016-05-06T12:00:01.5Z GET /"; '
+                         'echo "2016-05-06T12:00:03Z GET /a"'),
+            'db': _logs('echo "2016-05-06T12:00:01.25Z ready" >&2; '
+                        'sleep 0.2; echo "2016-05-06T12:00:02Z query"'),
+        }
+        lines = list(merge_logs(procs, delay=5))
+        assert [(l.container, l.stream, l.text) for l in lines] == [
+            ('db', 'stderr', 'ready'),
+            ('web', 'stdout', 'GET /'),
+            ('db', 'stdout', 'query'),
+            ('web', 'stdout', 'GET /a'),
+        ]
+        assert lines[0].time == 1462536001.25
+
+    def test_pattern_before_decoding(self):
+        procs = {'web': _logs(
+            r'printf "2016-05-06T12:00:01Z ERROR \\377\\n'
+            r'2016-05-06T12:00:02Z ok\\n"')}
+        lines = list(merge_logs(procs, pattern=rb'ERROR'))
+        assert [l.text for l in lines] == ['ERROR \ufffd']
+
+    def test_quiet_container_does_not_block(self):
+        procs = {'web': _logs('echo "2016-05-06T12:00:01Z up"'),
+                 'db': _logs('sleep 5')}
+        lines = merge_logs(procs, delay=0.1)
+        try:
+            assert next(lines).text == 'up'
+        finally:
+            lines.close()
+            for proc in procs.values():
+                proc.kill()
+                proc.wait()
+
+    def test_full_buffer_is_released(self):
+        procs = {'web': _logs('for i in 1 2 3 4 5 6; do '
+                              'echo "2016-05-06T12:00:0${i}Z $i"; done'),
+                 'db': _logs('sleep 2')}
+        started = time.monotonic()
+        lines = merge_logs(procs, buffer=2, delay=5)
+        try:
+            assert [next(lines).text for _ in range(5)] == \
+                ['1', '2', '3', '4', '5']
+            assert time.monotonic() - started < 1.5
+        finally:
+            lines.close()
+            for proc in procs.values():
+                proc.kill()
+                proc.wait()